@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the per-request authentication overhead.
+
+Compares a full jwt.decode (what every request paid before the token cache)
+with verify_token on a warm cache, for a configurable number of distinct users.
+
+Usage: python benchmarks/bench_auth.py [--users 50] [--number 20000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+warnings.filterwarnings("ignore")
+
+import server  # noqa: E402
+
+
+def per_call_us(func, tokens, number):
+    calls = iter(range(number))
+    timer = timeit.Timer(lambda: func(tokens[next(calls) % len(tokens)]))
+    best = min(timer.repeat(repeat=5, number=number // 5))
+    return best / (number // 5) * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="distinct tokens in rotation")
+    parser.add_argument("--number", type=int, default=20000, help="calls per measurement")
+    args = parser.parse_args()
+
+    tokens = [server.create_token(f"user-{i}") for i in range(args.users)]
+
+    before = per_call_us(server.decode_token, tokens, args.number)
+    for token in tokens:
+        server.verify_token(token)
+    after = per_call_us(server.verify_token, tokens, args.number)
+
+    print(json.dumps({
+        "users": args.users,
+        "jwt_decode_us": round(before, 2),
+        "cached_verify_us": round(after, 2),
+        "speedup": round(before / after, 1)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark.
+
+Each repetition runs in a fresh interpreter and measures:
+  - import_ms: `import server`
+  - startup_ms: the lifespan startup, i.e. until uvicorn would accept requests
+  - ready_ms: until /api/health/ready returns 200 (warm-up finished)
+The first repetition runs against an empty scratch database, so it pays for
+index creation and seeding. Later repetitions find the stored schema version
+and skip both steps. With --in-memory every repetition starts from an empty
+database, so only the import and connection costs are comparable.
+With --importtime, the slowest top-level imports from `python -X importtime`
+are listed as well.
+
+Usage:
+    python benchmarks/bench_startup.py                 # local mongod (MONGO_URL)
+    python benchmarks/bench_startup.py --in-memory     # needs mongomock-motor
+    python benchmarks/bench_startup.py --repeat 10 --importtime
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Runs in the child interpreter; prints one JSON line of timings
+CHILD = r"""
+import asyncio, json, os, sys, time, warnings
+warnings.filterwarnings("ignore")
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+
+async def main():
+    if os.environ.get("BENCH_IN_MEMORY"):
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        shared = AsyncMongoMockClient()
+        motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: shared
+    lifespan = server.app.router.lifespan_context(server.app)
+    await lifespan.__aenter__()
+    started = time.perf_counter()
+    while not server.app_ready:
+        await asyncio.sleep(0.001)
+    ready = time.perf_counter()
+    await lifespan.__aexit__(None, None, None)
+    print(json.dumps({
+        "import_ms": round((imported - start) * 1000, 1),
+        "startup_ms": round((started - start) * 1000, 1),
+        "ready_ms": round((ready - start) * 1000, 1)
+    }))
+
+asyncio.run(main())
+"""
+
+
+def run_child(env):
+    output = subprocess.check_output([sys.executable, "-c", CHILD], cwd=BACKEND_DIR, env=env, text=True, stderr=subprocess.DEVNULL)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, env=env, text=True, capture_output=True
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        # Only direct imports of server.py (one level below it)
+        if len(name) - len(name.lstrip()) != 3:
+            continue
+        imports.append({"module": name.strip(), "cumulative_ms": round(int(cumulative_us) / 1000, 1)})
+    return sorted(imports, key=lambda item: item["cumulative_ms"], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default="empresas_web_startup_bench", help="scratch database, dropped afterwards")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of mongod")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true", help="list the slowest imports")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = {**os.environ, "MONGO_URL": args.mongo_url, "MONGO_DB_NAME": args.database}
+    if args.in_memory:
+        env["BENCH_IN_MEMORY"] = "1"
+
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            runs.append(run_child(env))
+    finally:
+        if not args.in_memory:
+            from pymongo import MongoClient
+            MongoClient(args.mongo_url).drop_database(args.database)
+
+    report = {
+        "backend": "in-memory" if args.in_memory else "mongod",
+        "first_start": runs[0],
+        "warm_starts": runs[1:],
+    }
+    if len(runs) > 1:
+        report["warm_start_median"] = {
+            key: sorted(run[key] for run in runs[1:])[(len(runs) - 2) // 2] for key in runs[0]
+        }
+    if args.importtime:
+        report["slowest_imports"] = slowest_imports(env, args.top)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    """Fail a compared run when a benchmark regresses past BENCHMARK_MAX_REGRESSION (default median:25%)"""
+    if not config.pluginmanager.hasplugin("benchmark"):
+        return
+    if config.getoption("benchmark_compare") and not config.getoption("benchmark_compare_fail"):
+        from pytest_benchmark.utils import parse_compare_fail
+        threshold = os.environ.get("BENCHMARK_MAX_REGRESSION", "median:25%")
+        config.option.benchmark_compare_fail = [parse_compare_fail(threshold)]
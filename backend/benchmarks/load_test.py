@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+In-process load benchmark for the message hot path.
+
+Starts the FastAPI app inside this process (no network hop) against a local
+mongod or an in-memory stand-in, serves completions from the fake LLM
+provider (LLM_PROVIDER=fake) and drives the hot endpoints at a configurable concurrency.
+Throughput and p50/p95/p99 latency per scenario are reported as JSON so
+results can be compared between commits.
+
+Usage:
+    python benchmarks/load_test.py                       # local mongod (MONGO_URL)
+    python benchmarks/load_test.py --in-memory           # needs mongomock-motor
+    python benchmarks/load_test.py --concurrency 64 --requests 5000 --output bench.json
+    python benchmarks/load_test.py --llm-config fake_llm.json   # per-model latency/errors/timeouts
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+import warnings
+from datetime import datetime
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+warnings.filterwarnings("ignore")
+
+SCENARIOS = ["whatsapp_message", "crm_data", "list_contacts", "list_departments", "list_transfers", "list_conversations"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default="empresas_web_bench", help="scratch database, dropped afterwards")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of mongod")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--contacts", type=int, default=200, help="distinct phone numbers")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="fixed latency of the fake LLM")
+    parser.add_argument("--llm-config", help="FakeLlmProvider JSON config file, overrides --llm-latency-ms")
+    parser.add_argument("--llm-seed", type=int, default=42)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--output", help="write the JSON report to this file as well")
+    return parser.parse_args()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def summarize(name, latencies, errors, elapsed):
+    latencies.sort()
+    ms = [value * 1000 for value in latencies]
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": round(sum(ms) / len(ms), 2) if ms else None,
+            "p50": round(percentile(ms, 50), 2) if ms else None,
+            "p95": round(percentile(ms, 95), 2) if ms else None,
+            "p99": round(percentile(ms, 99), 2) if ms else None,
+            "max": round(ms[-1], 2) if ms else None
+        }
+    }
+
+
+def build_request(scenario, i, args):
+    phone = f"55119{i % args.contacts:08d}"
+    if scenario == "whatsapp_message":
+        return "POST", "/api/whatsapp/message", {
+            "phone_number": phone,
+            "message": f"Olá, preciso de ajuda com a minha empresa ({i})",
+            "message_id": uuid.uuid4().hex,
+            "timestamp": int(time.time())
+        }
+    if scenario == "crm_data":
+        contact_id = f"bench-contact-{i % args.contacts}"
+        return "POST", "/api/chrome-extension/crm-data", {
+            "contacts": {contact_id: {"id": contact_id, "name": f"Contato {i}", "phone_number": phone}},
+            "deals": {f"bench-deal-{i % args.contacts}": {"title": "Abertura de empresa", "stage": "lead", "contact_id": contact_id}}
+        }
+    if scenario == "list_contacts":
+        return "GET", "/api/contacts", None
+    if scenario == "list_departments":
+        return "GET", "/api/departments", None
+    if scenario == "list_transfers":
+        return "GET", "/api/transfers", None
+    if scenario == "list_conversations":
+        return "GET", f"/api/conversations/{phone}", None
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_scenario(http, scenario, args, headers):
+    latencies = []
+    errors = 0
+    counter = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, path, body = build_request(scenario, i, args)
+            start = time.perf_counter()
+            response = await http.request(method, path, json=body, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return summarize(scenario, latencies, errors, time.perf_counter() - start)
+
+
+def configure_fake_llm(args):
+    os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["FAKE_LLM_SEED"] = str(args.llm_seed)
+    if args.llm_config:
+        os.environ["FAKE_LLM_CONFIG_FILE"] = args.llm_config
+    else:
+        os.environ["FAKE_LLM_CONFIG"] = json.dumps({"*": {"latency_ms": {"distribution": "fixed", "value": args.llm_latency_ms}}})
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+async def main():
+    args = parse_args()
+
+    # Benchmark traffic comes from one IP and a few contacts; keep it out of the rate limiter
+    for scope in ("PHONE", "IP", "DEPARTMENT"):
+        os.environ[f"RATE_LIMIT_{scope}_PER_MINUTE"] = "0"
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["MONGO_DB_NAME"] = args.database
+    configure_fake_llm(args)
+
+    import httpx
+    import server
+
+    if args.in_memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("--in-memory requires the mongomock-motor package")
+        server.client = AsyncMongoMockClient()
+        server.database = server.client[args.database]
+        await server.warm_up(server.database)
+        lifespan = None
+    else:
+        lifespan = server.app.router.lifespan_context(server.app)
+        await lifespan.__aenter__()
+
+    headers = {"Authorization": f"Bearer {server.create_token('admin')}"}
+    transport = httpx.ASGITransport(app=server.app)
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "backend": "in-memory" if args.in_memory else "mongod",
+        "concurrency": args.concurrency,
+        "requests_per_scenario": args.requests,
+        "llm_config": server.llm_provider.config,
+        "results": []
+    }
+
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as http:
+            for scenario in args.scenarios.split(","):
+                report["results"].append(await run_scenario(http, scenario.strip(), args, headers))
+    finally:
+        await server.client.drop_database(args.database)
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    report["llm_usage"] = server.llm_provider.usage
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
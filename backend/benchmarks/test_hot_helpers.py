@@ -0,0 +1,150 @@
+"""
+Microbenchmarks for the pure-Python helpers that run on every request.
+
+Uses pytest-benchmark. Results are stored in benchmarks/.benchmarks. A
+compared run fails when a helper regresses past BENCHMARK_MAX_REGRESSION
+(default median:25%, see conftest.py).
+
+Usage (from backend/benchmarks):
+    pytest test_hot_helpers.py --benchmark-save=baseline    # record a baseline
+    pytest test_hot_helpers.py --benchmark-compare          # compare with the latest saved run
+    pytest test_hot_helpers.py --benchmark-compare=0001     # compare with a specific run
+
+Baselines only mean something on the machine that recorded them. Record a
+new one when the benchmark host changes.
+"""
+
+import os
+import sys
+import uuid
+import warnings
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+warnings.filterwarnings("ignore")
+
+import server  # noqa: E402
+from bson import ObjectId  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def conversation_page():
+    """A conversation history as returned by find(): 1000 raw Mongo documents"""
+    start = datetime(2024, 1, 1, 9, 0)
+    docs = []
+    for i in range(1000):
+        docs.append({
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "phone_number": "5511999990000",
+            "message": f"Mensagem {i}: gostaria de saber o valor da abertura de empresa e quais documentos preciso enviar",
+            "is_from_user": i % 2 == 0,
+            "ai_generated": i % 2 == 1,
+            "message_id": uuid.uuid4().hex,
+            "department_id": None,
+            "timestamp": (start + timedelta(minutes=i)).isoformat(),
+            "created_at": start + timedelta(minutes=i)
+        })
+    return docs
+
+
+@pytest.fixture(scope="module")
+def tokens():
+    return [server.create_token(f"user-{i}") for i in range(50)]
+
+
+AI_RESPONSES = {
+    "no_transfer": (
+        "Olá! Para abrir sua empresa precisamos do RG, CPF, comprovante de endereço e da definição "
+        "das atividades (CNAE). O prazo médio é de 10 a 15 dias úteis. Posso ajudar com mais alguma coisa?"
+    ) * 3,
+    "transfer": (
+        "Entendi, essa é uma questão de cobrança. Vou transferir você para o departamento financeiro, "
+        "que vai verificar o seu boleto e retornar ainda hoje."
+    ),
+    "indicator_without_department": (
+        "Vou transferir você para um especialista do departamento de abertura de empresas."
+    )
+}
+
+
+@pytest.fixture(scope="module")
+def companies():
+    return [
+        {"id": str(uuid.uuid4()), "name": f"Empresa {i} Ltda", "whatsapp_number": f"55119{i:08d}"}
+        for i in range(20)
+    ]
+
+
+def test_convert_mongo_document_list(benchmark, conversation_page):
+    result = benchmark(server.convert_mongo_document, conversation_page)
+    assert len(result) == len(conversation_page)
+    assert "_id" not in result[0]
+
+
+def test_create_token(benchmark):
+    token = benchmark(server.create_token, "admin")
+    assert server.decode_token(token)["user_id"] == "admin"
+
+
+def test_verify_token_uncached(benchmark, monkeypatch, tokens):
+    # A zero-sized cache evicts every entry on insert, so each call decodes the JWT
+    monkeypatch.setattr(server, "token_cache", server.TokenCache(0))
+    calls = iter(range(10 ** 9))
+    assert benchmark(lambda: server.verify_token(tokens[next(calls) % len(tokens)])) is not None
+
+
+def test_verify_token_cached(benchmark, tokens):
+    for token in tokens:
+        server.verify_token(token)
+    calls = iter(range(10 ** 9))
+    assert benchmark(lambda: server.verify_token(tokens[next(calls) % len(tokens)])) is not None
+
+
+@pytest.mark.parametrize("kind", sorted(AI_RESPONSES))
+def test_detect_transfer_department(benchmark, kind):
+    detected = benchmark(server.detect_transfer_department, AI_RESPONSES[kind])
+    assert (detected == "financeiro") == (kind == "transfer")
+
+
+def test_build_system_message(benchmark):
+    context = "Departamento: Abertura de Empresa - Constituição, MEI, CNPJ, documentação"
+    instructions = "Sempre peça o CNAE pretendido antes de informar valores. " * 20
+    message = benchmark(server.build_system_message, context, instructions)
+    assert context in message
+
+
+def test_build_extension_config(benchmark, companies):
+    config = benchmark(server.build_extension_config, companies)
+    assert len(config["companies"]) == len(companies)
+
+
+INBOUND_MESSAGES = {
+    "trivial": "Oi, bom dia! Tudo bem?",
+    "keyword": "Preciso emitir uma NFe para um cliente de outro estado",
+    "model": "Vocês ajudam a organizar o fluxo de caixa e as contas a receber?"
+}
+
+
+@pytest.fixture(scope="module")
+def trained_router():
+    router = server.IntentRouter()
+    texts = [f"{d['name']} {d['description']} {d['manual_instructions']}" for d in server.DEFAULT_DEPARTMENTS]
+    router.fit(texts, [d["slug"] for d in server.DEFAULT_DEPARTMENTS])
+    return router
+
+
+@pytest.mark.parametrize("kind", sorted(INBOUND_MESSAGES))
+def test_trivial_intent(benchmark, kind):
+    intent = benchmark(server.IntentRouter.trivial_intent, INBOUND_MESSAGES[kind])
+    assert (intent == "greeting") == (kind == "trivial")
+
+
+@pytest.mark.parametrize("kind", ["keyword", "model"])
+def test_classify_department(benchmark, trained_router, kind):
+    assert benchmark(trained_router.classify, INBOUND_MESSAGES[kind]) is not None
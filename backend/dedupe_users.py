@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Resolve duplicate users so the unique indexes on `users` (username, email,
+id) can be built. While duplicates exist, warm-up lists those indexes under
+`blocked_indexes` in `app_metadata` and the server runs without them.
+
+For each duplicated value the oldest user (by `created_at`, then `_id`) keeps
+it. The others are renamed and point at the kept user in `duplicate_of`, so
+no account is deleted:
+
+- username – becomes `<username>.duplicate-<n>`; the user can no longer log in
+  with the old name.
+- email – is moved to `duplicate_email`.
+- id – gets a new id; the old one is kept in `previous_id`.
+
+Running it again finds nothing left to change.
+
+Usage (from backend/):
+    python dedupe_users.py --dry-run    # list the duplicates
+    python dedupe_users.py              # rename them
+"""
+
+import argparse
+import json
+import os
+import uuid
+
+from pymongo import MongoClient
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB_NAME", "empresas_web"), help="shared database")
+    parser.add_argument("--dry-run", action="store_true", help="only report the duplicates")
+    return parser.parse_args()
+
+
+def duplicate_groups(db, field):
+    """Yield the users sharing each duplicated value of field, oldest first"""
+    pipeline = [
+        {"$match": {field: {"$type": "string"}}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    for group in db.users.aggregate(pipeline, allowDiskUse=True):
+        yield list(db.users.find({field: group["_id"]}).sort([("created_at", 1), ("_id", 1)]))
+
+
+def renamed(field, user, kept, n):
+    """$set/$unset update moving a duplicate out of the way of the kept user"""
+    if field == "username":
+        return {"$set": {"username": f"{user['username']}.duplicate-{n}", "duplicate_of": kept.get("id")}}
+    if field == "email":
+        return {"$set": {"duplicate_email": user["email"], "duplicate_of": kept.get("id")}, "$unset": {"email": ""}}
+    return {"$set": {"id": str(uuid.uuid4()), "previous_id": user["id"], "duplicate_of": kept.get("id")}}
+
+
+def dedupe_field(db, field, args):
+    report = {"field": field, "values": 0, "users": 0, "changes": []}
+    for users in duplicate_groups(db, field):
+        kept, duplicates = users[0], users[1:]
+        report["values"] += 1
+        report["users"] += len(duplicates)
+        for n, user in enumerate(duplicates, start=1):
+            update = renamed(field, user, kept, n)
+            report["changes"].append({"_id": str(user["_id"]), field: user[field], "update": update})
+            if not args.dry_run:
+                db.users.update_one({"_id": user["_id"]}, update)
+    return report
+
+
+def main():
+    args = parse_args()
+    db = MongoClient(args.mongo_url)[args.database]
+    reports = [dedupe_field(db, field, args) for field in ("id", "username", "email")]
+    print(json.dumps({"dry_run": args.dry_run, "fields": reports}, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Move conversation records from `conversations` (one document per message)
+into `conversation_buckets` (one document per contact per day), the storage
+used with CONVERSATION_STORAGE=buckets.
+
+Migrated messages go to buckets of their own (`migrated: true`, numbered by
+`seq`). Live appends never touch those buckets. Each run merges a day's
+legacy records with the messages already migrated for that day, matched on
+the record `id`, and rewrites the day's migrated buckets. Running it again,
+or after an interrupted run, does not duplicate messages.
+
+Every database is migrated: the shared one and each one in TENANT_DATABASES.
+
+Usage (from backend/):
+    python migrate_conversations.py --dry-run           # count records, days and buckets
+    python migrate_conversations.py                     # copy into buckets
+    python migrate_conversations.py --delete-source     # copy, then delete the copied records
+
+Run a copy while the server still uses documents. Switch to
+CONVERSATION_STORAGE=buckets, then run again with --delete-source to move
+the records written in between.
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+
+from pymongo import MongoClient, UpdateOne
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+warnings.filterwarnings("ignore")
+
+import server  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017/"))
+    parser.add_argument("--database", default=os.environ.get("MONGO_DB_NAME", "empresas_web"), help="shared database")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be migrated")
+    parser.add_argument("--delete-source", action="store_true", help="delete legacy records once they are in buckets")
+    return parser.parse_args()
+
+
+def legacy_days(db):
+    """Yield (company_id, contact_phone, day, records) for every contact day in `conversations`"""
+    cursor = db.conversations.find(
+        {"contact_phone": {"$type": "string"}, "timestamp": {"$type": "string"}}
+    ).sort([("company_id", 1), ("contact_phone", 1), ("timestamp", 1), ("_id", 1)])
+    key, records = None, []
+    for record in cursor:
+        record_key = (record.get("company_id") or server.DEFAULT_COMPANY_ID, record["contact_phone"], record["timestamp"][:10])
+        if record_key != key:
+            if records:
+                yield (*key, records)
+            key, records = record_key, []
+        records.append(record)
+    if records:
+        yield (*key, records)
+
+
+def migrate_day(db, company_id, contact_phone, day, records, args):
+    """Rewrite the migrated buckets of a contact day with its legacy records merged in; returns the bucket count"""
+    day_filter = {"company_id": company_id, "contact_phone": contact_phone, "day": day, "migrated": True}
+    messages = {}
+    for bucket in db.conversation_buckets.find(day_filter).sort("seq", 1):
+        for message in bucket["messages"]:
+            messages[message["id"]] = message
+    for record in records:
+        message = server.bucket_message(record)
+        message.setdefault("id", str(record["_id"]))
+        messages.setdefault(message["id"], message)
+    ordered = sorted(messages.values(), key=lambda message: message["timestamp"])
+
+    size = server.CONVERSATION_BUCKET_MAX_MESSAGES
+    chunks = [ordered[start:start + size] for start in range(0, len(ordered), size)]
+    if args.dry_run:
+        return len(chunks)
+
+    writes = []
+    for seq, chunk in enumerate(chunks):
+        bucket = {"count": len(chunk), "messages": chunk}
+        update = {"$set": bucket}
+        message_ids = [message["message_id"] for message in chunk if message.get("message_id")]
+        if message_ids:
+            bucket["message_ids"] = message_ids
+        else:
+            update["$unset"] = {"message_ids": ""}
+        writes.append(UpdateOne({**day_filter, "seq": seq}, update, upsert=True))
+    db.conversation_buckets.bulk_write(writes)
+
+    if args.delete_source:
+        db.conversations.delete_many({"_id": {"$in": [record["_id"] for record in records]}})
+    return len(chunks)
+
+
+def migrate_database(db, args):
+    report = {"database": db.name, "records": 0, "days": 0, "buckets": 0}
+    for company_id, contact_phone, day, records in legacy_days(db):
+        report["buckets"] += migrate_day(db, company_id, contact_phone, day, records, args)
+        report["records"] += len(records)
+        report["days"] += 1
+    return report
+
+
+def main():
+    args = parse_args()
+    client = MongoClient(args.mongo_url)
+    databases = [args.database] + sorted(set(server.TENANT_DATABASES.values()))
+    reports = [migrate_database(client[name], args) for name in databases]
+    print(json.dumps({"dry_run": args.dry_run, "delete_source": args.delete_source, "databases": reports}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
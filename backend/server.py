@@ -1,19 +1,43 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.routing import APIRoute
+from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 from typing import Optional, List
 import os
+import abc
 from datetime import datetime, timedelta
 import jwt
-import httpx
 import uuid
+import asyncio
+import hashlib
+import hmac
+import time
+import socket
+import random
+import math
+import json
+import re
+import unicodedata
+import threading
+import zlib
 import motor.motor_asyncio
-from contextlib import asynccontextmanager
+from pymongo import UpdateOne, ReturnDocument, CursorType, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, CollectionInvalid, OperationFailure
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.write_concern import WriteConcern
+import bson
+from bson import ObjectId
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 import logging
 from dotenv import load_dotenv
 import base64
-import qrcode
 from io import BytesIO
 
 # Load environment variables
@@ -28,101 +52,875 @@ async def lifespan(app: FastAPI):
     # Startup
     global client, database
     mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/')
-    client = motor.motor_asyncio.AsyncIOMotorClient(mongo_url)
-    database = client.empresas_web
+    client = motor.motor_asyncio.AsyncIOMotorClient(
+        mongo_url,
+        event_listeners=[mongo_command_metrics, slow_query_log],
+        **mongo_client_options()
+    )
+    database = client[os.environ.get("MONGO_DB_NAME", "empresas_web")]
+    
+    # Revocations must be known before the first authenticated request
+    await load_revoked_tokens(database)
     
-    # Initialize default departments
-    await initialize_default_departments(database)
+    # Indexes and default departments are checked in the background; /api/health/ready flips once done
+    warmup_task = asyncio.create_task(warm_up(database))
+    await start_background_jobs(database)
     
     yield
-    # Shutdown
+    # Shutdown: stop taking messages and let in-flight work finish before closing Mongo
+    warmup_task.cancel()
+    await drain(database, SHUTDOWN_DRAIN_TIMEOUT)
+    if whatsapp_http is not None:
+        await whatsapp_http.aclose()
     client.close()
+    password_executor.shutdown(wait=False)
+
+def mongo_client_options() -> dict:
+    """Connection pool, timeout and compression settings for the Motor client"""
+    options = {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000")),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "20000")),
+    }
+    if os.environ.get("MONGO_SOCKET_TIMEOUT_MS"):
+        options["socketTimeoutMS"] = int(os.environ["MONGO_SOCKET_TIMEOUT_MS"])
+    if os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS"):
+        options["waitQueueTimeoutMS"] = int(os.environ["MONGO_WAIT_QUEUE_TIMEOUT_MS"])
+    # e.g. "zstd,snappy,zlib" (zstd needs the zstandard package, snappy needs python-snappy)
+    if os.environ.get("MONGO_COMPRESSORS"):
+        options["compressors"] = os.environ["MONGO_COMPRESSORS"]
+    return options
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def read_preference_from_env(operation_class: str, default_mode: str):
+    """Read preference for a class of operations, e.g. MONGO_READ_PREFERENCE_ANALYTICS=secondaryPreferred"""
+    mode = os.environ.get(f"MONGO_READ_PREFERENCE_{operation_class.upper()}", default_mode)
+    if mode == "primary":
+        return Primary()
+    # Bounded staleness (MongoDB requires at least 90 seconds, -1 disables)
+    max_staleness = int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", "120"))
+    return READ_PREFERENCE_MODES[mode](max_staleness=max_staleness)
+
+# Heavy reads that tolerate slightly stale data are routed away from the primary
+OPERATION_READ_PREFERENCES = {
+    "analytics": read_preference_from_env("analytics", "secondaryPreferred"),
+    "exports": read_preference_from_env("exports", "secondaryPreferred"),
+    "dashboard": read_preference_from_env("dashboard", "secondaryPreferred"),
+}
+
+def parse_write_concern_w(value: str):
+    return int(value) if value.isdigit() else value
+
+# w=0 is accepted but disables message_id deduplication (duplicate key errors are never reported)
+CONVERSATION_WRITE_CONCERN = WriteConcern(
+    w=parse_write_concern_w(os.environ.get("MONGO_CONVERSATION_WRITE_CONCERN", "1")),
+    j=True if os.environ.get("MONGO_CONVERSATION_JOURNAL", "false").lower() == "true" else None
+)
+
+def collection_for(db, name: str, operation_class: str):
+    """Collection handle using the read preference configured for an operation class"""
+    return db.get_collection(name, read_preference=OPERATION_READ_PREFERENCES[operation_class])
+
+def conversation_log(db):
+    """Conversations collection with the configured write concern for message logging"""
+    return db.get_collection("conversations", write_concern=CONVERSATION_WRITE_CONCERN)
+
+# Conversation storage mode:
+# - "documents" (default): one document per message in `conversations`
+# - "buckets": one document per contact per day in `conversation_buckets`, messages appended with $push.
+#   A chat read touches one document per day, and only incoming message ids and reply links are indexed.
+# Existing messages are moved to buckets with migrate_conversations.py.
+CONVERSATION_STORAGE = os.environ.get("CONVERSATION_STORAGE", "documents")
+# A bucket that reaches this size is closed; further messages of that day open a new one
+CONVERSATION_BUCKET_MAX_MESSAGES = int(os.environ.get("CONVERSATION_BUCKET_MAX_MESSAGES", "200"))
+# Stored once per bucket instead of on every message
+BUCKET_KEY_FIELDS = ("_id", "company_id", "contact_phone")
+
+def conversation_buckets(db):
+    """Conversation buckets collection with the configured write concern for message logging"""
+    return db.get_collection("conversation_buckets", write_concern=CONVERSATION_WRITE_CONCERN)
+
+def bucket_message(record: dict) -> dict:
+    """A conversation record as it is embedded in its bucket"""
+    return {key: value for key, value in record.items() if key not in BUCKET_KEY_FIELDS}
+
+def bucket_append(record: dict) -> tuple:
+    """(filter, update) of the upsert that appends a conversation record to the open bucket of its contact and day"""
+    query = {
+        "company_id": record["company_id"],
+        "contact_phone": record["contact_phone"],
+        "day": record["timestamp"][:10],
+        "migrated": {"$ne": True},
+        "count": {"$lt": CONVERSATION_BUCKET_MAX_MESSAGES}
+    }
+    update = {"$push": {"messages": bucket_message(record)}, "$inc": {"count": 1}}
+    if record.get("message_id"):
+        # A retry whose message is already in the open bucket misses the filter, so the upsert
+        # inserts a second bucket and the unique message_ids index rejects it as a duplicate
+        query["message_ids"] = {"$ne": record["message_id"]}
+        update["$push"]["message_ids"] = record["message_id"]
+    return query, update
+
+def unbucket(bucket: dict) -> List[dict]:
+    """The conversation records of a bucket, with the bucket key fields restored"""
+    return [
+        {"company_id": bucket["company_id"], "contact_phone": bucket["contact_phone"], **message}
+        for message in bucket["messages"]
+    ]
+
+async def store_conversation(db, record: dict):
+    """Store one conversation record; raises DuplicateKeyError if its message_id is already stored"""
+    if CONVERSATION_STORAGE == "buckets":
+        await conversation_buckets(db).update_one(*bucket_append(record), upsert=True)
+    else:
+        await conversation_log(db).insert_one(record)
+
+async def store_conversations(db, records: List[dict], ordered: bool = True):
+    """Store several conversation records; duplicates are reported per record index in a BulkWriteError"""
+    if CONVERSATION_STORAGE == "buckets":
+        await conversation_buckets(db).bulk_write(
+            [UpdateOne(*bucket_append(record), upsert=True) for record in records],
+            ordered=ordered
+        )
+    else:
+        await conversation_log(db).insert_many(records, ordered=ordered)
+
+async def load_hot_conversation(db, company_id: str, phone_number: str, limit: int, before: Optional[str] = None) -> List[dict]:
+    """The `limit` most recent records of a contact in the hot collection before `before`, oldest first"""
+    if CONVERSATION_STORAGE != "buckets":
+        query = {"company_id": company_id, "contact_phone": phone_number}
+        if before:
+            query["timestamp"] = {"$lt": before}
+        records = await db.conversations.find(query).sort("timestamp", -1).to_list(length=limit)
+        records.reverse()
+        return records
+    
+    # A day can span several buckets (full or migrated ones), so whole days are read before sorting
+    query = {"company_id": company_id, "contact_phone": phone_number}
+    if before:
+        query["day"] = {"$lte": before[:10]}
+    records = []
+    last_day = None
+    cursor = db.conversation_buckets.find(query, {"_id": 0, "message_ids": 0}).sort("day", -1)
+    async for bucket in cursor:
+        if len(records) >= limit and bucket["day"] != last_day:
+            break
+        last_day = bucket["day"]
+        records.extend(record for record in unbucket(bucket) if not before or (record.get("timestamp") or "") < before)
+    records.sort(key=lambda record: record.get("timestamp") or "")
+    return records[-limit:]
+
+async def load_conversation(db, company_id: str, phone_number: str, limit: int = 100, before: Optional[str] = None) -> List[dict]:
+    """The `limit` most recent conversation records of a contact before `before` (ISO timestamp), oldest first
+
+    Pages that reach past the hot collection continue in the archive.
+    """
+    records = await load_hot_conversation(db, company_id, phone_number, limit, before)
+    if len(records) < limit:
+        boundary = records[0]["timestamp"] if records else before
+        hot_ids = {record.get("id") for record in records}
+        archived = await load_archived_conversation(db, company_id, phone_number, limit - len(records), boundary)
+        records = [record for record in archived if record.get("id") not in hot_ids] + records
+    return records
+
+async def count_conversation_messages(db, company_id: str, operation_class: str, since: Optional[datetime] = None) -> int:
+    """Number of stored conversation records of a company, optionally only those from `since` on"""
+    if CONVERSATION_STORAGE != "buckets":
+        query = {"company_id": company_id}
+        if since is not None:
+            query["timestamp"] = {"$gte": since.isoformat()}
+        count = await collection_for(db, "conversations", operation_class).count_documents(query)
+    else:
+        match = {"company_id": company_id}
+        if since is not None:
+            # Buckets hold whole days, so the count is exact for midnight boundaries
+            match["day"] = {"$gte": since.date().isoformat()}
+        count = await sum_counts(collection_for(db, "conversation_buckets", operation_class), match)
+    # Windows are recent, so only totals include the archive
+    if since is None:
+        count += await sum_counts(collection_for(db, "conversation_archives", operation_class), {"company_id": company_id})
+    return count
+
+async def sum_counts(collection, match: dict) -> int:
+    """Sum of the `count` field of the matching documents"""
+    cursor = collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+    ])
+    result = await cursor.to_list(length=1)
+    return result[0]["count"] if result else 0
 
-async def initialize_default_departments(db):
-    """Initialize 7 specialized departments for business services"""
+# Conversation archive
+# Records older than CONVERSATION_ARCHIVE_AFTER_DAYS leave the hot collections (`conversations`
+# and `conversation_buckets`) for one compressed `conversation_archives` document per contact
+# per month. Compressed with zstd when the zstandard package is installed, else with zlib.
+CONVERSATION_ARCHIVE_AFTER_DAYS = int(os.environ.get("CONVERSATION_ARCHIVE_AFTER_DAYS", "90"))  # 0 disables archiving
+CONVERSATION_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("CONVERSATION_ARCHIVE_INTERVAL_SECONDS", "3600"))
+# Records moved per round trip
+CONVERSATION_ARCHIVE_BATCH_SIZE = int(os.environ.get("CONVERSATION_ARCHIVE_BATCH_SIZE", "5000"))
+
+def compress_archive(records: List[dict]) -> tuple:
+    """(codec, payload) of a list of archive records encoded as BSON"""
+    data = bson.encode({"records": records})
+    try:
+        import zstandard
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    except ImportError:
+        return "zlib", zlib.compress(data, 9)
+
+def decompress_archive(archive: dict) -> List[dict]:
+    """The records of an archive document, with the contact key fields restored"""
+    if archive["codec"] == "zstd":
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(archive["data"])
+    else:
+        data = zlib.decompress(archive["data"])
+    return unbucket({**archive, "messages": bson.decode(data)["records"]})
+
+def archive_record(record: dict) -> dict:
+    """A hot conversation record as it is stored in the archive"""
+    message = bucket_message(record)
+    message.setdefault("id", str(record.get("_id")))
+    return message
+
+async def append_to_archive(db, company_id: str, contact_phone: str, month: str, records: List[dict]):
+    """Merge records into the archive of a contact month (records already archived are matched on id)"""
+    key = {"company_id": company_id, "contact_phone": contact_phone, "month": month}
+    existing = await db.conversation_archives.find_one(key)
+    merged = {record["id"]: bucket_message(record) for record in (decompress_archive(existing) if existing else [])}
+    for record in records:
+        record = archive_record(record)
+        merged.setdefault(record["id"], record)
+    ordered = sorted(merged.values(), key=lambda record: record["timestamp"])
+    codec, payload = compress_archive(ordered)
+    await db.conversation_archives.update_one(key, {"$set": {
+        "codec": codec,
+        "data": payload,
+        "count": len(ordered),
+        "first_timestamp": ordered[0]["timestamp"],
+        "last_timestamp": ordered[-1]["timestamp"],
+        "archived_at": datetime.utcnow()
+    }}, upsert=True)
+
+async def archive_conversation_batch(db, company_id: str, cutoff: datetime) -> int:
+    """Move one batch of a company's records older than `cutoff` to the archive; returns the hot documents removed"""
+    cutoff_timestamp = cutoff.isoformat()
+    documents = await db.conversations.find({
+        "company_id": company_id,
+        "contact_phone": {"$type": "string"},
+        "timestamp": {"$lt": cutoff_timestamp}
+    }).to_list(length=CONVERSATION_ARCHIVE_BATCH_SIZE)
+    buckets = await db.conversation_buckets.find(
+        {"company_id": company_id, "day": {"$lt": cutoff_timestamp[:10]}}
+    ).to_list(length=max(1, CONVERSATION_ARCHIVE_BATCH_SIZE // CONVERSATION_BUCKET_MAX_MESSAGES))
+    
+    months = {}
+    for record in documents + [record for bucket in buckets for record in unbucket(bucket)]:
+        months.setdefault((record["contact_phone"], record["timestamp"][:7]), []).append(record)
+    for (contact_phone, month), records in months.items():
+        await append_to_archive(db, company_id, contact_phone, month, records)
+    
+    # Deleted only once archived; a crash in between is repaired by the id merge on the next run
+    if documents:
+        await db.conversations.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+    if buckets:
+        await db.conversation_buckets.delete_many({"_id": {"$in": [bucket["_id"] for bucket in buckets]}})
+    return len(documents) + len(buckets)
+
+async def load_archived_conversation(db, company_id: str, phone_number: str, limit: int, before: Optional[str] = None) -> List[dict]:
+    """The `limit` most recent archived records of a contact before `before`, oldest first"""
+    query = {"company_id": company_id, "contact_phone": phone_number}
+    if before:
+        query["month"] = {"$lte": before[:7]}
+    records = []
+    async for archive in db.conversation_archives.find(query).sort("month", -1):
+        records = [record for record in decompress_archive(archive) if not before or record["timestamp"] < before] + records
+        if len(records) >= limit:
+            break
+    return records[-limit:]
+
+# Multi-tenancy
+# Every tenant-owned document carries company_id and every query filters on it.
+# Data from before multi-tenancy, and users without a company, belong to the default company.
+DEFAULT_COMPANY_ID = os.environ.get("DEFAULT_COMPANY_ID", "default")
+TENANT_COLLECTIONS = [
+    "contacts", "conversations", "conversation_buckets", "conversation_archives", "conversation_summaries", "deals", "departments", "transfers",
+    "appointments", "scheduled_messages", "mass_campaigns"
+]
+# Large tenants can get a dedicated database, e.g. TENANT_DATABASES='{"acme": "empresas_web_acme"}'.
+# Users, tokens, companies and coordination collections always stay in the shared database.
+TENANT_DATABASES = json.loads(os.environ.get("TENANT_DATABASES", "{}"))
+
+def tenant_database(company_id: str):
+    """Database holding a tenant's data: its dedicated database when mapped, else the shared one"""
+    db_name = TENANT_DATABASES.get(company_id)
+    return client[db_name] if db_name else database
+
+def tenant_keys(*keys) -> list:
+    """Compound index keys led by company_id"""
+    return [("company_id", ASCENDING)] + [key if isinstance(key, tuple) else (key, ASCENDING) for key in keys]
+
+# Fields login reads from a user, looked up through the unique username index
+LOGIN_USER_FIELDS = ["username", "id", "role", "name", "email", "company_id", "password_hash", "password"]
+
+# Indexes the API relies on: (collection, keys, options)
+# Indexes of tenant collections lead with company_id so every query stays within one tenant's range
+INDEXES = [
+    # Inbound WhatsApp messages are deduplicated on the bridge message_id
+    ("conversations", tenant_keys("message_id"), {"unique": True, "partialFilterExpression": {"message_id": {"$type": "string"}}}),
+    ("conversations", tenant_keys("reply_to"), {"partialFilterExpression": {"reply_to": {"$type": "string"}}}),
+    ("conversations", tenant_keys("ai_followup_pending"), {"partialFilterExpression": {"ai_followup_pending": True}}),
+    ("conversations", tenant_keys("contact_phone", "timestamp"), {}),
+    ("conversations", tenant_keys("id"), {}),
+    ("conversations", tenant_keys("timestamp"), {}),
+    
+    # Bucketed storage: chat reads by contact and day, retries deduplicated on incoming message ids
+    ("conversation_buckets", tenant_keys("contact_phone", "day"), {}),
+    ("conversation_buckets", tenant_keys("day"), {}),
+    ("conversation_buckets", tenant_keys("message_ids"), {"unique": True, "partialFilterExpression": {"message_ids": {"$exists": True}}}),
+    ("conversation_buckets", tenant_keys("messages.reply_to"), {"partialFilterExpression": {"messages.reply_to": {"$exists": True}}}),
+    ("conversation_buckets", tenant_keys("messages.ai_followup_pending"), {"partialFilterExpression": {"messages.ai_followup_pending": True}}),
+    
+    # Archive: one compressed document per contact per month
+    ("conversation_archives", tenant_keys("contact_phone", "month"), {"unique": True}),
+    ("conversation_summaries", tenant_keys("contact_phone"), {"unique": True}),
+    
+    ("contacts", tenant_keys("phone_number"), {}),
+    ("contacts", tenant_keys("id"), {}),
+    ("contacts", tenant_keys("created_at"), {}),
+    ("deals", tenant_keys("id"), {}),
+    ("deals", tenant_keys("stage"), {}),
+    ("departments", tenant_keys("id"), {}),
+    ("appointments", tenant_keys("created_by"), {}),
+    ("scheduled_messages", tenant_keys("created_by"), {}),
+    ("mass_campaigns", tenant_keys("created_at"), {}),
+    
+    # Transfers work queue: listing per department/status and oldest-first claims
+    ("transfers", tenant_keys("id"), {}),
+    ("transfers", tenant_keys("to_department", "status", "created_at"), {}),
+    ("transfers", tenant_keys("status", ("created_at", DESCENDING)), {}),
+    ("transfers", tenant_keys("claimed_at"), {"partialFilterExpression": {"claimed_at": {"$type": "string"}}}),
+    
+    # Revoked tokens are only kept until the token would have expired anyway
+    ("revoked_tokens", "token_hash", {"unique": True}),
+    ("revoked_tokens", "expires_at", {"expireAfterSeconds": 0}),
+    
+    # Registration relies on these to reject duplicates in a single insert
+    # (deployments with duplicate users run dedupe_users.py before they can be built)
+    ("users", "username", {"unique": True}),
+    ("users", "email", {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}}),
+    ("users", "id", {"unique": True}),
+    
+    # Seeding upserts default departments by slug
+    ("departments", tenant_keys("slug"), {"unique": True, "partialFilterExpression": {"slug": {"$type": "string"}}}),
+]
+
+# Indexes that are no longer created. The single-tenant ones were replaced by the company_id-led
+# ones above (the unique ones would stop two companies from using the same message_id or department
+# slug); the login covering index copied password hashes into the index for one document fetch.
+OBSOLETE_INDEXES = [
+    ("conversations", "message_id_1"),
+    ("conversations", "reply_to_1"),
+    ("conversations", "ai_followup_pending_1"),
+    ("departments", "slug_1"),
+    ("transfers", "id_1"),
+    ("transfers", "to_department_1_status_1_created_at_1"),
+    ("transfers", "status_1_created_at_-1"),
+    ("transfers", "claimed_at_1"),
+    ("users", "username_1_id_1_role_1_name_1_email_1_company_id_1_password_hash_1_password_1"),
+]
+
+async def ensure_indexes(db) -> tuple:
+    """Create the indexes the API relies on (no-op when they already exist)
+
+    Returns (ok, blocked): ok is False when a build failed and should be retried; blocked names the
+    unique indexes that cannot be built until duplicate documents are removed.
+    """
+    ok, blocked = True, []
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            if e.code == 11000:
+                blocked.append(f"{collection}: {keys}")
+                logging.error(f"Index {keys} on {collection} cannot be built, existing documents hold duplicate keys: {str(e)}")
+            else:
+                ok = False
+                logging.error(f"Error creating index {keys} on {collection}: {str(e)}")
+        except Exception as e:
+            ok = False
+            logging.error(f"Error creating index {keys} on {collection}: {str(e)}")
+    return ok, blocked
+
+# Default departments, keyed by a stable slug so seeding is idempotent across workers
+DEFAULT_DEPARTMENTS = [
+    {
+        "slug": "abertura-de-empresa",
+        "name": "Abertura de Empresa",
+        "description": "Abertura de empresa, MEI, CNPJ e documentação legal",
+        "signature": "---\n🏢 Abertura de Empresa - Empresas Web\n📧 abertura@empresasweb.com\n📞 (11) 99999-1001\n\nEspecialistas em abertura de empresas e MEI!",
+        "avatar_url": "/avatars/abertura-empresa.png",
+        "manual_instructions": "Você é especialista em abertura de empresas, MEI, CNPJ e documentação legal. Ajude com: constituição de empresas, escolha de regime tributário, documentação necessária, prazos e custos.",
+        "active": True
+    },
+    {
+        "slug": "duvidas-contabeis",
+        "name": "Dúvidas Contábeis",
+        "description": "Contabilidade geral, balanços e demonstrações",
+        "signature": "---\n📊 Contabilidade - Empresas Web\n📧 contabil@empresasweb.com\n📞 (11) 99999-1002\n\nContabilidade precisa para seu negócio!",
+        "avatar_url": "/avatars/contabilidade.png",
+        "manual_instructions": "Você é especialista em contabilidade. Ajude com: escrituração contábil, balanços, demonstrações financeiras, análise de custos, orientações sobre registros contábeis.",
+        "active": True
+    },
+    {
+        "slug": "rh-e-folha",
+        "name": "RH e Folha",
+        "description": "Recursos humanos, folha de pagamento e trabalhista",
+        "signature": "---\n👥 RH e Folha - Empresas Web\n📧 rh@empresasweb.com\n📞 (11) 99999-1003\n\nGestão completa de pessoas!",
+        "avatar_url": "/avatars/rh-folha.png",
+        "manual_instructions": "Você é especialista em RH e folha de pagamento. Ajude com: admissão e demissão, cálculos trabalhistas, férias, 13º salário, eSocial, obrigações trabalhistas.",
+        "active": True
+    },
+    {
+        "slug": "tributos-e-impostos",
+        "name": "Tributos e Impostos",
+        "description": "Impostos, tributos, Simples Nacional e planejamento tributário",
+        "signature": "---\n🧾 Tributos - Empresas Web\n📧 tributos@empresasweb.com\n📞 (11) 99999-1004\n\nPlanejamento tributário inteligente!",
+        "avatar_url": "/avatars/tributos.png",
+        "manual_instructions": "Você é especialista em tributos e impostos. Ajude com: Simples Nacional, Lucro Presumido, Lucro Real, planejamento tributário, apuração de impostos, obrigações acessórias.",
+        "active": True
+    },
+    {
+        "slug": "emissao-de-notas-fiscais",
+        "name": "Emissão de Notas Fiscais",
+        "description": "Notas fiscais, NFe, NFSe e certificados digitais",
+        "signature": "---\n📋 Notas Fiscais - Empresas Web\n📧 nfe@empresasweb.com\n📞 (11) 99999-1005\n\nEmissão rápida e segura!",
+        "avatar_url": "/avatars/notas-fiscais.png",
+        "manual_instructions": "Você é especialista em emissão de notas fiscais. Ajude com: NFe, NFSe, certificados digitais, SPED, configuração de emissores, correção de notas.",
+        "active": True
+    },
+    {
+        "slug": "outros-assuntos",
+        "name": "Outros Assuntos",
+        "description": "Consultoria geral e outros assuntos empresariais",
+        "signature": "---\n💼 Consultoria Geral - Empresas Web\n📧 consultoria@empresasweb.com\n📞 (11) 99999-1006\n\nSoluções empresariais completas!",
+        "avatar_url": "/avatars/consultoria.png",
+        "manual_instructions": "Você é consultor empresarial geral. Ajude com: orientações gerais, consultoria estratégica, processos empresariais, questões diversas não cobertas pelos outros departamentos.",
+        "active": True
+    },
+    {
+        "slug": "financeiro",
+        "name": "Financeiro",
+        "description": "Questões financeiras, pagamentos e cobrança",
+        "signature": "---\n💰 Financeiro - Empresas Web\n📧 financeiro@empresasweb.com\n📞 (11) 99999-1007\n\nGestão financeira eficiente!",
+        "avatar_url": "/avatars/financeiro.png",
+        "manual_instructions": "Você é especialista financeiro. Ajude com: contas a pagar/receber, fluxo de caixa, cobrança, negociações, questões de pagamento e faturamento.",
+        "active": True
+    }
+]
+
+async def initialize_default_departments(db, company_id: str) -> bool:
+    """Initialize 7 specialized departments for business services (safe to run from every worker)"""
     try:
         departments_collection = db.departments
-        existing_count = await departments_collection.count_documents({})
         
-        if existing_count == 0:
-            specialized_departments = [
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Abertura de Empresa",
-                    "description": "Abertura de empresa, MEI, CNPJ e documentação legal",
-                    "signature": "---\n🏢 Abertura de Empresa - Empresas Web\n📧 abertura@empresasweb.com\n📞 (11) 99999-1001\n\nEspecialistas em abertura de empresas e MEI!",
-                    "avatar_url": "/avatars/abertura-empresa.png",
-                    "manual_instructions": "Você é especialista em abertura de empresas, MEI, CNPJ e documentação legal. Ajude com: constituição de empresas, escolha de regime tributário, documentação necessária, prazos e custos.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Dúvidas Contábeis",
-                    "description": "Contabilidade geral, balanços e demonstrações",
-                    "signature": "---\n📊 Contabilidade - Empresas Web\n📧 contabil@empresasweb.com\n📞 (11) 99999-1002\n\nContabilidade precisa para seu negócio!",
-                    "avatar_url": "/avatars/contabilidade.png",
-                    "manual_instructions": "Você é especialista em contabilidade. Ajude com: escrituração contábil, balanços, demonstrações financeiras, análise de custos, orientações sobre registros contábeis.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "RH e Folha",
-                    "description": "Recursos humanos, folha de pagamento e trabalhista",
-                    "signature": "---\n👥 RH e Folha - Empresas Web\n📧 rh@empresasweb.com\n📞 (11) 99999-1003\n\nGestão completa de pessoas!",
-                    "avatar_url": "/avatars/rh-folha.png",
-                    "manual_instructions": "Você é especialista em RH e folha de pagamento. Ajude com: admissão e demissão, cálculos trabalhistas, férias, 13º salário, eSocial, obrigações trabalhistas.",
-                    "active": True,  
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Tributos e Impostos",
-                    "description": "Impostos, tributos, Simples Nacional e planejamento tributário",
-                    "signature": "---\n🧾 Tributos - Empresas Web\n📧 tributos@empresasweb.com\n📞 (11) 99999-1004\n\nPlanejamento tributário inteligente!",
-                    "avatar_url": "/avatars/tributos.png",
-                    "manual_instructions": "Você é especialista em tributos e impostos. Ajude com: Simples Nacional, Lucro Presumido, Lucro Real, planejamento tributário, apuração de impostos, obrigações acessórias.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Emissão de Notas Fiscais",
-                    "description": "Notas fiscais, NFe, NFSe e certificados digitais",
-                    "signature": "---\n📋 Notas Fiscais - Empresas Web\n📧 nfe@empresasweb.com\n📞 (11) 99999-1005\n\nEmissão rápida e segura!",
-                    "avatar_url": "/avatars/notas-fiscais.png",
-                    "manual_instructions": "Você é especialista em emissão de notas fiscais. Ajude com: NFe, NFSe, certificados digitais, SPED, configuração de emissores, correção de notas.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Outros Assuntos",
-                    "description": "Consultoria geral e outros assuntos empresariais",
-                    "signature": "---\n💼 Consultoria Geral - Empresas Web\n📧 consultoria@empresasweb.com\n📞 (11) 99999-1006\n\nSoluções empresariais completas!",
-                    "avatar_url": "/avatars/consultoria.png",
-                    "manual_instructions": "Você é consultor empresarial geral. Ajude com: orientações gerais, consultoria estratégica, processos empresariais, questões diversas não cobertas pelos outros departamentos.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                },
-                {
-                    "id": str(uuid.uuid4()),
-                    "name": "Financeiro",
-                    "description": "Questões financeiras, pagamentos e cobrança",
-                    "signature": "---\n💰 Financeiro - Empresas Web\n📧 financeiro@empresasweb.com\n📞 (11) 99999-1007\n\nGestão financeira eficiente!",
-                    "avatar_url": "/avatars/financeiro.png",
-                    "manual_instructions": "Você é especialista financeiro. Ajude com: contas a pagar/receber, fluxo de caixa, cobrança, negociações, questões de pagamento e faturamento.",
-                    "active": True,
-                    "created_at": datetime.utcnow().isoformat()
-                }
-            ]
-            
-            await departments_collection.insert_many(specialized_departments)
-            logging.info("7 specialized business departments initialized with AI assistants")
+        # Departments seeded before slugs existed are matched by name once
+        await departments_collection.bulk_write([
+            UpdateOne(
+                {"company_id": company_id, "name": department["name"], "slug": {"$exists": False}},
+                {"$set": {"slug": department["slug"]}}
+            )
+            for department in DEFAULT_DEPARTMENTS
+        ], ordered=False)
+        
+        now = datetime.utcnow().isoformat()
+        result = await departments_collection.bulk_write([
+            UpdateOne(
+                {"company_id": company_id, "slug": department["slug"]},
+                {"$setOnInsert": {**department, "company_id": company_id, "id": str(uuid.uuid4()), "created_at": now}},
+                upsert=True
+            )
+            for department in DEFAULT_DEPARTMENTS
+        ], ordered=False)
+        
+        if result.upserted_count:
+            logging.info(f"{result.upserted_count} specialized business departments initialized with AI assistants")
+        return True
             
+    except BulkWriteError as e:
+        # Another worker seeded the same departments concurrently
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            logging.error(f"Error initializing specialized departments: {str(e)}")
+            return False
+        return True
     except Exception as e:
         logging.error(f"Error initializing specialized departments: {str(e)}")
+        return False
+
+# Fingerprint of the indexes and seed data this build expects. Startup skips index creation
+# and seeding when the database already records it, so restarts cost a single find_one.
+SCHEMA_VERSION = hashlib.sha1(json.dumps([INDEXES, DEFAULT_DEPARTMENTS], sort_keys=True, default=str).encode()).hexdigest()[:12]
+WARMUP_RETRY_SECONDS = float(os.environ.get("WARMUP_RETRY_SECONDS", "5"))
+app_ready = False
+
+async def backfill_company_id(db, company_id: str):
+    """Assign documents written before multi-tenancy to a company"""
+    for collection in TENANT_COLLECTIONS + ["users"]:
+        result = await db[collection].update_many({"company_id": {"$exists": False}}, {"$set": {"company_id": company_id}})
+        if result.modified_count:
+            logging.info(f"Assigned {result.modified_count} {collection} documents to company {company_id}")
+    for collection, index_name in OBSOLETE_INDEXES:
+        try:
+            await db[collection].drop_index(index_name)
+        except Exception:
+            pass  # already dropped or never created
+
+async def ensure_schema(db, company_ids: List[str]) -> bool:
+    """Backfill, create indexes and seed default departments unless this schema version is already applied
+
+    Companies added after the version was applied are seeded on their own.
+    """
+    applied = await db.app_metadata.find_one({"_id": "schema"}, {"version": 1, "seeded_companies": 1})
+    if applied and applied.get("version") == SCHEMA_VERSION:
+        seeded = set(applied.get("seeded_companies", []))
+        for company_id in company_ids:
+            if company_id in seeded:
+                continue
+            if not await initialize_default_departments(db, company_id):
+                return False
+            await db.app_metadata.update_one({"_id": "schema"}, {"$addToSet": {"seeded_companies": company_id}})
+        return True
+    
+    logging.info(f"Applying schema {SCHEMA_VERSION} (database has {applied.get('version') if applied else None})")
+    await backfill_company_id(db, company_ids[0])
+    ok, blocked = await ensure_indexes(db)
+    if not ok:
+        return False
+    for company_id in company_ids:
+        if not await initialize_default_departments(db, company_id):
+            return False
+    if blocked:
+        # Serve without them rather than never becoming ready; the version stays unapplied,
+        # so the next warm-up retries the builds once the duplicates are removed
+        await db.app_metadata.update_one(
+            {"_id": "schema"},
+            {"$set": {"blocked_indexes": blocked, "checked_at": datetime.utcnow().isoformat(), "checked_by": WORKER_ID}},
+            upsert=True
+        )
+        return True
+    await db.app_metadata.update_one(
+        {"_id": "schema"},
+        {
+            "$set": {
+                "version": SCHEMA_VERSION,
+                "seeded_companies": company_ids,
+                "applied_at": datetime.utcnow().isoformat(),
+                "applied_by": WORKER_ID
+            },
+            "$unset": {"blocked_indexes": ""}
+        },
+        upsert=True
+    )
+    return True
+
+async def tenant_schema_targets(db) -> list:
+    """(database, company ids) pairs to apply the schema to: the shared database and every dedicated one"""
+    shared_companies = [DEFAULT_COMPANY_ID]
+    async for company in db.companies.find({}, {"_id": 0, "id": 1}):
+        if company.get("id") and company["id"] not in TENANT_DATABASES and company["id"] not in shared_companies:
+            shared_companies.append(company["id"])
+    targets = [(db, shared_companies)]
+    for company_id, db_name in TENANT_DATABASES.items():
+        targets.append((db.client[db_name], [company_id]))
+    return targets
+
+async def warm_up(db):
+    """Apply the schema (retrying until MongoDB cooperates), then mark the worker ready"""
+    global app_ready
+    while True:
+        try:
+            results = [await ensure_schema(target_db, company_ids) for target_db, company_ids in await tenant_schema_targets(db)]
+            if all(results):
+                break
+        except Exception as e:
+            logging.error(f"Error during warm-up: {str(e)}")
+        await asyncio.sleep(WARMUP_RETRY_SECONDS)
+    app_ready = True
+    logging.info("Warm-up complete, worker ready")
+
+# Multi-worker coordination
+# Set MULTI_WORKER=true when running several processes (see DEPLOYMENT.md)
+MULTI_WORKER = os.environ.get("MULTI_WORKER", "false").lower() == "true"
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+LEADER_LEASE_GRACE_SECONDS = int(os.environ.get("LEADER_LEASE_GRACE_SECONDS", "30"))
+# A running job renews its lease this often, well within the grace period
+LEADER_LEASE_RENEW_SECONDS = max(1, LEADER_LEASE_GRACE_SECONDS // 3)
+CACHE_INVALIDATION_FEED_SIZE = 1024 * 1024
+CACHE_INVALIDATION_MAX_BACKOFF_SECONDS = 60
+
+# Background jobs that must run on a single worker: (name, interval seconds, coroutine function)
+SINGLETON_JOBS = []
+# Handlers applying invalidations published by other workers, keyed by cache name
+CACHE_INVALIDATION_HANDLERS = {}
+background_jobs = []
+
+def singleton_job(name: str, interval_seconds: int):
+    """Register a periodic job that only the current lease holder runs"""
+    def register(func):
+        SINGLETON_JOBS.append((name, interval_seconds, func))
+        return func
+    return register
+
+async def acquire_lease(db, name: str, ttl_seconds: int) -> bool:
+    """Take or renew the named lease; False while another worker holds an unexpired lease"""
+    now = datetime.utcnow()
+    try:
+        await db.leader_leases.update_one(
+            {"_id": name, "$or": [{"holder": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": WORKER_ID, "expires_at": now + timedelta(seconds=ttl_seconds), "renewed_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_lease(db, name: str):
+    await db.leader_leases.delete_one({"_id": name, "holder": WORKER_ID})
+
+async def renew_lease_until_lost(db, name: str, ttl_seconds: int):
+    """Keep renewing a held lease; returns once it cannot be renewed"""
+    while True:
+        await asyncio.sleep(LEADER_LEASE_RENEW_SECONDS)
+        try:
+            if not await acquire_lease(db, name, ttl_seconds):
+                return
+        except Exception as e:
+            logging.error(f"Error renewing lease {name}: {str(e)}")
+            return
+
+async def run_leased_job(db, name: str, ttl_seconds: int, func):
+    """Run a job while renewing its lease; the job is cancelled once the lease may have passed to another worker"""
+    job = asyncio.create_task(func(db))
+    renewal = asyncio.create_task(renew_lease_until_lost(db, name, ttl_seconds))
+    try:
+        await asyncio.wait({job, renewal}, return_when=asyncio.FIRST_COMPLETED)
+        if not job.done():
+            logging.warning(f"Lost the lease of background job {name}, stopping it")
+            job.cancel()
+            await asyncio.gather(job, return_exceptions=True)
+            return
+        await job
+    finally:
+        renewal.cancel()
+        job.cancel()
+
+async def run_singleton_job(db, name: str, interval_seconds: int, func):
+    while not draining:
+        try:
+            ttl_seconds = interval_seconds + LEADER_LEASE_GRACE_SECONDS
+            if await acquire_lease(db, name, ttl_seconds):
+                with inflight_work.track("job", name):
+                    await run_leased_job(db, name, ttl_seconds, func)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error running background job {name}: {str(e)}")
+        await asyncio.sleep(interval_seconds)
+
+async def publish_cache_invalidation(db, cache: str, key: str, **data):
+    """Tell the other workers to drop or update an entry of a per-worker cache"""
+    if not MULTI_WORKER:
+        return
+    try:
+        await db.cache_invalidations.insert_one({
+            "cache": cache,
+            "key": key,
+            "data": data,
+            "origin": WORKER_ID,
+            "created_at": datetime.utcnow()
+        })
+    except Exception as e:
+        logging.error(f"Error publishing cache invalidation for {cache}: {str(e)}")
+
+async def ensure_invalidation_feed(db):
+    """Create the capped invalidation collection, converting a plain one so it can be tailed"""
+    try:
+        await db.create_collection("cache_invalidations", capped=True, size=CACHE_INVALIDATION_FEED_SIZE)
+        return
+    except (CollectionInvalid, OperationFailure):
+        pass  # already created, by another worker (NamespaceExists) or an earlier run
+    options = await db.cache_invalidations.options()
+    if not options.get("capped"):
+        logging.warning("cache_invalidations is not a capped collection, converting it")
+        await db.command("convertToCapped", "cache_invalidations", size=CACHE_INVALIDATION_FEED_SIZE)
+
+async def follow_cache_invalidations(db):
+    """Tail the capped invalidation collection and apply events from other workers"""
+    last_id = ObjectId.from_datetime(datetime.utcnow())
+    feed_ready = False
+    failures = 0
+    while True:
+        try:
+            if not feed_ready:
+                await ensure_invalidation_feed(db)
+                feed_ready = True
+            cursor = db.cache_invalidations.find({"_id": {"$gt": last_id}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for event in cursor:
+                    last_id = event["_id"]
+                    handler = CACHE_INVALIDATION_HANDLERS.get(event.get("cache"))
+                    if handler and event.get("origin") != WORKER_ID:
+                        handler(event["key"], event.get("data") or {})
+                failures = 0
+                await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failures += 1
+            feed_ready = False
+            logging.error(f"Error following cache invalidations ({failures} in a row): {str(e)}")
+        # The tailable cursor dies on an empty collection; reopen it, backing off while errors repeat
+        await asyncio.sleep(min(2 ** failures, CACHE_INVALIDATION_MAX_BACKOFF_SECONDS) if failures else 1)
+
+async def start_background_jobs(db):
+    for name, interval_seconds, func in SINGLETON_JOBS:
+        background_jobs.append(asyncio.create_task(run_singleton_job(db, name, interval_seconds, func)))
+    if MULTI_WORKER:
+        background_jobs.append(asyncio.create_task(follow_cache_invalidations(db)))
+
+async def stop_background_jobs(db):
+    for task in background_jobs:
+        task.cancel()
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+    background_jobs.clear()
+    for name, _, _ in SINGLETON_JOBS:
+        try:
+            await release_lease(db, name)
+        except Exception as e:
+            logging.error(f"Error releasing lease {name}: {str(e)}")
+
+# Companies created while the server runs get their default departments within this interval
+COMPANY_SEED_INTERVAL_SECONDS = int(os.environ.get("COMPANY_SEED_INTERVAL_SECONDS", "60"))
+
+@singleton_job("seed_new_companies", COMPANY_SEED_INTERVAL_SECONDS)
+async def seed_new_companies(db):
+    """Seed the default departments of companies added since the schema was applied"""
+    for target_db, company_ids in await tenant_schema_targets(db):
+        await ensure_schema(target_db, company_ids)
+
+@singleton_job("archive_conversations", CONVERSATION_ARCHIVE_INTERVAL_SECONDS)
+async def archive_conversations(db):
+    """Move conversation records past the archive age out of the hot collections"""
+    if not CONVERSATION_ARCHIVE_AFTER_DAYS:
+        return
+    cutoff = datetime.utcnow() - timedelta(days=CONVERSATION_ARCHIVE_AFTER_DAYS)
+    for target_db, company_ids in await tenant_schema_targets(db):
+        for company_id in company_ids:
+            moved = 0
+            while not draining:
+                batch = await archive_conversation_batch(target_db, company_id, cutoff)
+                if not batch:
+                    break
+                moved += batch
+            if moved:
+                logging.info(f"Archived {moved} conversation documents of company {company_id}")
+
+# Graceful shutdown
+# Seconds the shutdown waits for in-flight messages, LLM calls, jobs and tracked tasks
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+# Set once shutdown starts: inbound messages get 503 and readiness fails
+draining = False
+# Fire-and-forget writes started with spawn_tracked; awaited (or reported) on shutdown
+pending_tasks = set()
+
+class InflightWork:
+    """Registry of in-flight work that shutdown waits for"""
+
+    def __init__(self):
+        self._active = {}  # token -> (kind, label, monotonic start)
+
+    def begin(self, kind: str, label) -> object:
+        token = object()
+        self._active[token] = (kind, label, time.monotonic())
+        return token
+
+    def end(self, token: object):
+        self._active.pop(token, None)
+
+    @contextmanager
+    def track(self, kind: str, label):
+        token = self.begin(kind, label)
+        try:
+            yield
+        finally:
+            self.end(token)
+
+    def count(self) -> int:
+        return len(self._active)
+
+    def snapshot(self) -> list:
+        now = time.monotonic()
+        return [
+            {"kind": kind, "label": label, "age_seconds": round(now - started, 1)}
+            for kind, label, started in self._active.values()
+        ]
+
+inflight_work = InflightWork()
+
+def spawn_tracked(coro, name: str) -> asyncio.Task:
+    """Run a coroutine in the background without losing it on shutdown"""
+    task = asyncio.create_task(coro, name=name)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+    return task
+
+def reject_if_draining():
+    if draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down", headers={"Retry-After": "5"})
+
+async def drain(db, timeout: float):
+    """Stop accepting messages, wait up to timeout for in-flight work, then report what was abandoned"""
+    global draining
+    draining = True
+    deadline = time.monotonic() + timeout
+    logging.info(f"Draining: {inflight_work.count()} in-flight, {len(pending_tasks)} pending tasks")
+    
+    while (inflight_work.count() or pending_tasks) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    
+    abandoned_work = inflight_work.snapshot()
+    abandoned_tasks = [task.get_name() for task in pending_tasks]
+    for task in list(pending_tasks):
+        task.cancel()
+    await asyncio.gather(*pending_tasks, return_exceptions=True)
+    await stop_background_jobs(db)
+    
+    if not abandoned_work and not abandoned_tasks:
+        logging.info("Drain complete, nothing abandoned")
+        return
+    
+    report = {
+        "worker": WORKER_ID,
+        "created_at": datetime.utcnow().isoformat(),
+        "timeout_seconds": timeout,
+        "abandoned_work": abandoned_work,
+        "abandoned_tasks": abandoned_tasks
+    }
+    logging.warning(f"Drain timed out after {timeout}s, abandoned: {abandoned_work} tasks: {abandoned_tasks}")
+    try:
+        # Incoming messages listed here were stored without a reply
+        await db.shutdown_reports.insert_one(report)
+    except Exception as e:
+        logging.error(f"Error storing shutdown report: {str(e)}")
 
 app = FastAPI(title="Empresas Web CRM API", lifespan=lifespan)
 
@@ -135,6 +933,234 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics (Prometheus)
+HTTP_REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency per route", ["method", "route", "status"]
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served per route", ["method", "route"],
+    multiprocess_mode="livesum"
+)
+LLM_CALL_LATENCY = Histogram(
+    "llm_call_duration_seconds", "LLM call latency per provider/model and outcome", ["provider", "model", "outcome"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+MONGO_OPERATION_LATENCY = Histogram(
+    "mongo_operation_duration_seconds", "MongoDB command latency per collection and command", ["collection", "command", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+TRANSFERS_DETECTED = Counter(
+    "transfers_detected_total", "Department transfers detected in AI replies", ["department"]
+)
+FALLBACK_REPLIES = Counter(
+    "fallback_replies_total", "Replies served without a successful LLM completion", ["reason"]
+)
+CAMPAIGN_SENDS = Counter(
+    "campaign_sends_total", "Messages queued by mass message campaigns"
+)
+LLM_SLOT_WAIT = Histogram(
+    "llm_slot_wait_seconds", "Time spent waiting for an LLM concurrency slot", ["scope"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+LLM_SLOT_REJECTIONS = Counter(
+    "llm_slot_rejections_total", "LLM calls shed because no concurrency slot was free", ["scope", "reason"]
+)
+LLM_SLOTS_IN_USE = Gauge(
+    "llm_slots_in_use", "LLM concurrency slots currently held", ["scope"],
+    multiprocess_mode="livesum"
+)
+LLM_SLOT_QUEUE_DEPTH = Gauge(
+    "llm_slot_queue_depth", "Requests waiting for an LLM concurrency slot", ["scope"],
+    multiprocess_mode="livesum"
+)
+STREAM_FIRST_CHUNK = Histogram(
+    "whatsapp_stream_first_chunk_seconds", "Time from receiving a message to pushing the first reply chunk to the bridge",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30)
+)
+WHATSAPP_PUSH_ERRORS = Counter(
+    "whatsapp_push_errors_total", "Reply chunks the WhatsApp bridge did not accept"
+)
+INTENT_ROUTER_DECISIONS = Counter(
+    "intent_router_decisions_total", "Inbound messages answered from a template, routed to a department or passed on", ["outcome"]
+)
+
+class InstrumentedRoute(APIRoute):
+    """API route recording latency and in-flight requests labelled with the route template"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def instrumented_handler(request: Request):
+            in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(request.method, route)
+            in_flight.inc()
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            finally:
+                HTTP_REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.perf_counter() - start)
+                in_flight.dec()
+
+        return instrumented_handler
+
+app.router.route_class = InstrumentedRoute
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """PyMongo command listener feeding the per-collection latency histogram"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore carries the cursor id here and the collection in a separate field
+            target = event.command.get("collection", "")
+        self._collections[(event.connection_id, event.request_id)] = target
+
+    def succeeded(self, event):
+        self._observe(event, "success")
+
+    def failed(self, event):
+        self._observe(event, "failure")
+
+    def _observe(self, event, outcome: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_OPERATION_LATENCY.labels(collection, event.command_name, outcome).observe(event.duration_micros / 1_000_000)
+
+mongo_command_metrics = MongoCommandMetrics()
+
+def normalize_query_shape(value):
+    """Replace literal values with '?' so queries differing only in their values share a shape"""
+    if isinstance(value, dict):
+        return {key: normalize_query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        # $and/$or clauses and aggregation pipelines keep their structure
+        return [normalize_query_shape(item) for item in value]
+    return "?"
+
+def command_query_shape(command_name: str, command: dict) -> str:
+    if command_name == "find":
+        parts = {"filter": command.get("filter", {}), "sort": command.get("sort")}
+    elif command_name == "aggregate":
+        parts = {"pipeline": command.get("pipeline", [])}
+    elif command_name in ("count", "distinct"):
+        parts = {"filter": command.get("query", {})}
+    elif command_name == "findAndModify":
+        parts = {"filter": command.get("query", {}), "sort": command.get("sort")}
+    elif command_name == "update":
+        parts = {"filter": [update.get("q", {}) for update in command.get("updates", [])[:1]]}
+    elif command_name == "delete":
+        parts = {"filter": [delete.get("q", {}) for delete in command.get("deletes", [])[:1]]}
+    else:
+        return command_name
+    # Sort directions are part of the shape, not literal values
+    sort = parts.pop("sort", None)
+    shape = normalize_query_shape(parts)
+    if sort:
+        shape["sort"] = dict(sort)
+    return json.dumps(shape, sort_keys=True, default=str)
+
+class SlowQueryLog(monitoring.CommandListener):
+    """Keeps Mongo commands slower than a threshold in a ring buffer, with totals per query shape"""
+
+    def __init__(self, threshold_ms: float, max_entries: int, max_shapes: int):
+        self.threshold_ms = threshold_ms
+        self.max_shapes = max_shapes
+        self.entries = deque(maxlen=max_entries)
+        self._shapes = OrderedDict()
+        self._pending = {}
+        # Listener callbacks run on Motor's worker threads
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        self._pending[(event.connection_id, event.request_id)] = (event.command, event.database_name)
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
+
+    def _finish(self, event, outcome: str):
+        started = self._pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if started is None or duration_ms < self.threshold_ms:
+            return
+        
+        command, database_name = started
+        collection = command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = command.get("collection", "")
+        shape = command_query_shape(event.command_name, command)
+        
+        with self._lock:
+            self.entries.append({
+                "at": datetime.utcnow().isoformat(),
+                "database": database_name,
+                "collection": collection,
+                "command": event.command_name,
+                "duration_ms": round(duration_ms, 2),
+                "outcome": outcome,
+                "shape": shape
+            })
+            key = (collection, event.command_name, shape)
+            stats = self._shapes.pop(key, None) or {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            self._shapes[key] = stats
+            if len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+
+    def report(self, limit: int) -> dict:
+        with self._lock:
+            recent = list(self.entries)[-limit:][::-1]
+            shapes = [
+                {
+                    "collection": collection,
+                    "command": command_name,
+                    "shape": shape,
+                    "count": stats["count"],
+                    "total_ms": round(stats["total_ms"], 2),
+                    "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+                    "max_ms": round(stats["max_ms"], 2)
+                }
+                for (collection, command_name, shape), stats in self._shapes.items()
+            ]
+        shapes.sort(key=lambda item: item["total_ms"], reverse=True)
+        return {"threshold_ms": self.threshold_ms, "recent": recent, "shapes": shapes[:limit]}
+
+    def reset(self):
+        with self._lock:
+            self.entries.clear()
+            self._shapes.clear()
+
+slow_query_log = SlowQueryLog(
+    float(os.environ.get("MONGO_SLOW_QUERY_MS", "100")),
+    int(os.environ.get("MONGO_SLOW_QUERY_LOG_SIZE", "500")),
+    int(os.environ.get("MONGO_SLOW_QUERY_MAX_SHAPES", "1000"))
+)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Multi-worker mode: aggregate the samples written by every worker process
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # Security
 security = HTTPBearer()
 SECRET_KEY = "empresas-web-secret-key-2025"
@@ -155,10 +1181,23 @@ class WhatsAppMessage(BaseModel):
     message: str
     message_id: str
     timestamp: int
+    department_id: Optional[str] = None
+    company_id: str = DEFAULT_COMPANY_ID
 
 class MessageResponse(BaseModel):
     reply: Optional[str] = None
     success: bool = True
+    # The reply was already pushed to the bridge chunk by chunk and must not be sent again
+    streamed: bool = False
+
+class MessageResult(BaseModel):
+    message_id: str
+    reply: Optional[str] = None
+    success: bool = True
+
+class BatchMessageResponse(BaseModel):
+    results: List[MessageResult]
+    success: bool = True
 
 class ContactCreate(BaseModel):
     name: str
@@ -225,28 +1264,192 @@ class ScheduledMessageCreate(BaseModel):
     campaign_type: str = "individual"
 
 # Utility functions
-def create_token(user_id: str):
+def create_token(user_id: str, company_id: str = DEFAULT_COMPANY_ID):
     payload = {
         "user_id": user_id,
+        "company_id": company_id,
         "exp": datetime.utcnow() + timedelta(days=7)
     }
     return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
 
-def verify_token(token: str):
+# Password hashing runs in a bounded thread pool so logins never block the event loop
+# Hashes with fewer rounds than PASSWORD_HASH_ROUNDS are upgraded on the next login
+PASSWORD_HASH_ROUNDS = int(os.environ.get("PASSWORD_HASH_ROUNDS", "29000"))
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=PASSWORD_HASH_ROUNDS,
+    pbkdf2_sha256__min_rounds=PASSWORD_HASH_ROUNDS
+)
+password_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "4")),
+    thread_name_prefix="password-hash"
+)
+# Requests beyond the limit wait here instead of piling up in the executor queue
+password_semaphore = asyncio.Semaphore(int(os.environ.get("PASSWORD_HASH_CONCURRENCY", "8")))
+
+async def hash_password(password: str) -> str:
+    async with password_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, pwd_context.hash, password)
+
+async def verify_password(password: str, password_hash: str):
+    """Return (valid, new_hash); new_hash is set when the stored hash uses outdated settings"""
+    async with password_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, pwd_context.verify_and_update, password, password_hash)
+
+async def check_user_password(user: dict, password: str, users_collection) -> bool:
+    """Verify a user's password, transparently rehashing legacy plaintext or outdated hashes"""
+    if user.get("password_hash"):
+        valid, new_hash = await verify_password(password, user["password_hash"])
+    else:
+        # Legacy record created before hashing was introduced
+        valid = user.get("password") is not None and hmac.compare_digest(user["password"].encode(), password.encode())
+        new_hash = await hash_password(password) if valid else None
+    
+    if valid and new_hash:
+        await users_collection.update_one(
+            {"id": user["id"]},
+            {"$set": {"password_hash": new_hash}, "$unset": {"password": ""}}
+        )
+    return valid
+
+def decode_token(token: str):
+    """Fully verify a token and return its payload (None when invalid, expired or without an expiry)"""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload.get("user_id")
+        # The cache and the revocation list keep a token until its exp, so it must have one
+        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"], options={"require": ["exp"]})
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class TokenCache:
+    """Bounded LRU of verified tokens keyed by token hash, plus an in-memory revocation list"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._verified = OrderedDict()  # token hash -> ((user_id, company_id), exp timestamp)
+        self._revoked = {}  # token hash -> exp timestamp
+
+    def get(self, token_hash: str, now: float) -> Optional[tuple]:
+        entry = self._verified.get(token_hash)
+        if entry is None:
+            return None
+        principal, exp = entry
+        if exp <= now:
+            del self._verified[token_hash]
+            return None
+        self._verified.move_to_end(token_hash)
+        return principal
+
+    def put(self, token_hash: str, principal: tuple, exp: float):
+        self._verified[token_hash] = (principal, exp)
+        self._verified.move_to_end(token_hash)
+        if len(self._verified) > self.max_size:
+            self._verified.popitem(last=False)
+
+    def is_revoked(self, token_hash: str) -> bool:
+        return token_hash in self._revoked
+
+    def revoke(self, token_hash: str, exp: float):
+        self._verified.pop(token_hash, None)
+        self._revoked[token_hash] = exp
+        # Drop revocations of tokens that have expired on their own
+        now = time.time()
+        for expired_hash in [h for h, h_exp in self._revoked.items() if h_exp <= now]:
+            del self._revoked[expired_hash]
+
+token_cache = TokenCache(int(os.environ.get("TOKEN_CACHE_MAX", "10000")))
+
+def verify_token_principal(token: str) -> Optional[tuple]:
+    """(user_id, company_id) of a valid token; tokens issued before multi-tenancy map to the default company"""
+    token_hash = hash_token(token)
+    if token_cache.is_revoked(token_hash):
+        return None
+    
+    principal = token_cache.get(token_hash, time.time())
+    if principal:
+        return principal
+    
+    payload = decode_token(token)
+    if not payload or not payload.get("user_id"):
+        return None
+    principal = (payload["user_id"], payload.get("company_id") or DEFAULT_COMPANY_ID)
+    token_cache.put(token_hash, principal, payload["exp"])
+    return principal
+
+def verify_token(token: str):
+    principal = verify_token_principal(token)
+    return principal[0] if principal else None
+
+async def revoke_token(token: str, db):
+    """Revoke a token in memory and persist the revocation until the token expires"""
+    payload = decode_token(token)
+    if not payload:
+        return
+    token_hash = hash_token(token)
+    token_cache.revoke(token_hash, payload["exp"])
+    await db.revoked_tokens.update_one(
+        {"token_hash": token_hash},
+        {"$set": {"token_hash": token_hash, "expires_at": datetime.utcfromtimestamp(payload["exp"])}},
+        upsert=True
+    )
+    await publish_cache_invalidation(db, "revoked_tokens", token_hash, exp=payload["exp"])
+
+CACHE_INVALIDATION_HANDLERS["revoked_tokens"] = lambda token_hash, data: token_cache.revoke(token_hash, data["exp"])
+
+async def load_revoked_tokens(db):
+    """Load persisted revocations into the in-memory list"""
+    try:
+        cursor = db.revoked_tokens.find({"expires_at": {"$gt": datetime.utcnow()}})
+        async for record in cursor:
+            token_cache.revoke(record["token_hash"], (record["expires_at"] - datetime(1970, 1, 1)).total_seconds())
+    except Exception as e:
+        logging.error(f"Error loading revoked tokens: {str(e)}")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     user_id = verify_token(credentials.credentials)
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid token")
     return user_id
 
+async def get_current_company(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Company of the authenticated user; every tenant query is scoped to it"""
+    principal = verify_token_principal(credentials.credentials)
+    if not principal:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return principal[1]
+
+# Credentials of the WhatsApp bridges, one per company, e.g. WHATSAPP_BRIDGE_KEYS='{"acme": "<secret>"}'.
+# Inbound messages belong to the company whose key is sent in X-Bridge-Key; the message body
+# cannot choose it. Without keys, inbound messages only reach the default company.
+WHATSAPP_BRIDGE_KEYS = json.loads(os.environ.get("WHATSAPP_BRIDGE_KEYS", "{}"))
+bridge_key_companies = {
+    hashlib.sha256(key.encode()).hexdigest(): company_id for company_id, key in WHATSAPP_BRIDGE_KEYS.items()
+}
+
+def get_bridge_company(request: Request) -> str:
+    """Company of the WhatsApp bridge sending an inbound message, identified by its X-Bridge-Key"""
+    if not bridge_key_companies:
+        return DEFAULT_COMPANY_ID
+    key = request.headers.get("X-Bridge-Key")
+    company_id = bridge_key_companies.get(hashlib.sha256(key.encode()).hexdigest()) if key else None
+    if company_id is None:
+        raise HTTPException(status_code=401, detail="Invalid bridge key")
+    return company_id
+
+def assign_bridge_company(messages: List[WhatsAppMessage], company_id: str):
+    """Put inbound messages in the bridge's company; a message naming another company is rejected"""
+    for message in messages:
+        if "company_id" in message.model_fields_set and message.company_id != company_id:
+            raise HTTPException(status_code=403, detail="Message company does not match the bridge")
+        message.company_id = company_id
+
 def convert_mongo_document(doc):
     """Convert MongoDB document to JSON-serializable format"""
     if doc is None:
@@ -274,11 +1477,37 @@ def mongo_to_dict(doc):
 def get_database():
     return database
 
+def get_tenant_database(company_id: str = Depends(get_current_company)):
+    return tenant_database(company_id)
+
+async def get_admin_user(current_user: str = Depends(get_current_user), db=Depends(get_database)):
+    if current_user != "admin":
+        user = await db.users.find_one({"id": current_user}, {"_id": 0, "role": 1})
+        if not user or user.get("role") != "admin":
+            raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
 # Routes
 @app.get("/")
 async def root():
     return {"message": "Empresas Web CRM API", "status": "running"}
 
+@app.get("/api/health/live")
+async def liveness():
+    """Liveness probe: the process is up and serving"""
+    return {"status": "alive", "worker": WORKER_ID}
+
+@app.get("/api/health/ready")
+async def readiness(response: Response):
+    """Readiness probe: 503 until warm-up (schema check, indexes, seeding) has finished and once draining"""
+    if draining:
+        response.status_code = 503
+        return {"status": "draining", "schema_version": SCHEMA_VERSION}
+    if not app_ready:
+        response.status_code = 503
+        return {"status": "starting", "schema_version": SCHEMA_VERSION}
+    return {"status": "ready", "schema_version": SCHEMA_VERSION}
+
 @app.post("/api/auth/login")
 async def login(request: LoginRequest, db=Depends(get_database)):
     # Check admin credentials first (accept both "admin" and email formats)
@@ -290,24 +1519,30 @@ async def login(request: LoginRequest, db=Depends(get_database)):
             "user": {
                 "id": "admin",
                 "username": "admin",
-                "role": "admin"
+                "role": "admin",
+                "company_id": DEFAULT_COMPANY_ID
             }
         }
     
     # Check database for regular users
     users_collection = db.users
-    user = await users_collection.find_one({"username": request.username})
+    user = await users_collection.find_one(
+        {"username": request.username},
+        {"_id": 0, **{field: 1 for field in LOGIN_USER_FIELDS}}
+    )
     
-    if user and user.get("password") == request.password:
-        token = create_token(user["id"])
+    if user and await check_user_password(user, request.password, users_collection):
+        company_id = user.get("company_id") or DEFAULT_COMPANY_ID
+        token = create_token(user["id"], company_id)
         return {
             "token": token,
             "user": {
                 "id": user["id"],
                 "username": user["username"],
-                "role": user.get("role", "user"),
+                "role": user.get("role") or "user",
                 "name": user.get("name"),
-                "email": user.get("email")
+                "email": user.get("email"),
+                "company_id": company_id
             }
         }
     else:
@@ -319,33 +1554,29 @@ async def register(request: RegisterRequest, db=Depends(get_database)):
     try:
         users_collection = db.users
         
-        # Check if username already exists
-        existing_user = await users_collection.find_one({"username": request.username})
-        if existing_user:
-            raise HTTPException(status_code=400, detail="Username already exists")
-        
-        # Check if email already exists (if provided)
-        if request.email:
-            existing_email = await users_collection.find_one({"email": request.email})
-            if existing_email:
-                raise HTTPException(status_code=400, detail="Email already registered")
-        
         # Create new user
         user_data = {
             "id": str(uuid.uuid4()),
             "username": request.username,
-            "password": request.password,  # In production, hash this password
+            "password_hash": await hash_password(request.password),
             "email": request.email,
             "name": request.name or request.username,
             "role": "user",
+            "company_id": DEFAULT_COMPANY_ID,
             "created_at": datetime.utcnow().isoformat(),
             "active": True
         }
         
-        await users_collection.insert_one(user_data)
+        # Unique indexes on username and email reject duplicates atomically
+        try:
+            await users_collection.insert_one(user_data)
+        except DuplicateKeyError as e:
+            if "email" in (e.details or {}).get("keyPattern", {}):
+                raise HTTPException(status_code=400, detail="Email already registered")
+            raise HTTPException(status_code=400, detail="Username already exists")
         
         # Create token for immediate login
-        token = create_token(user_data["id"])
+        token = create_token(user_data["id"], user_data["company_id"])
         
         return {
             "token": token,
@@ -354,7 +1585,8 @@ async def register(request: RegisterRequest, db=Depends(get_database)):
                 "username": user_data["username"],
                 "role": user_data["role"],
                 "name": user_data["name"],
-                "email": user_data["email"]
+                "email": user_data["email"],
+                "company_id": user_data["company_id"]
             },
             "message": "User registered successfully"
         }
@@ -366,162 +1598,1136 @@ async def register(request: RegisterRequest, db=Depends(get_database)):
         raise HTTPException(status_code=500, detail="Error creating user account")
 
 @app.get("/api/auth/verify")
-async def verify_auth(current_user: str = Depends(get_current_user)):
-    return {"valid": True, "user_id": current_user}
+async def verify_auth(current_user: str = Depends(get_current_user), company_id: str = Depends(get_current_company)):
+    return {"valid": True, "user_id": current_user, "company_id": company_id}
+
+@app.post("/api/auth/logout")
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: str = Depends(get_current_user),
+    db=Depends(get_database)
+):
+    """Revoke the token used for this request"""
+    await revoke_token(credentials.credentials, db)
+    return {"success": True}
+
+# WhatsApp Routes
+WHATSAPP_SERVICE_URL = os.environ.get("WHATSAPP_SERVICE_URL", "http://localhost:3001")
+
+# Streaming mode: replies are pushed to the bridge (POST {WHATSAPP_SERVICE_URL}/send) sentence by
+# sentence while the LLM generates them, instead of being returned once complete
+WHATSAPP_STREAMING = os.environ.get("WHATSAPP_STREAMING", "false").lower() == "true"
+# Shortest chunk pushed on its own; shorter sentences wait for the next one
+WHATSAPP_STREAM_MIN_CHARS = int(os.environ.get("WHATSAPP_STREAM_MIN_CHARS", "60"))
+WHATSAPP_PUSH_TIMEOUT_SECONDS = float(os.environ.get("WHATSAPP_PUSH_TIMEOUT_SECONDS", "5"))
+# Paragraph breaks, and whitespace after the end of a sentence
+CHUNK_BOUNDARY = re.compile(r"\n\s*\n|(?<=[.!?…])\s+")
+whatsapp_http = None
+
+def whatsapp_client():
+    """Shared HTTP client for the WhatsApp bridge (httpx is imported on first use)"""
+    global whatsapp_http
+    if whatsapp_http is None:
+        import httpx
+        whatsapp_http = httpx.AsyncClient(base_url=WHATSAPP_SERVICE_URL, timeout=WHATSAPP_PUSH_TIMEOUT_SECONDS)
+    return whatsapp_http
+
+def chunk_boundary(text: str, start: int, min_chars: int) -> Optional[int]:
+    """End of the longest prefix of text[start:] that ends at a boundary and holds at least min_chars"""
+    end = None
+    for match in CHUNK_BOUNDARY.finditer(text, start):
+        if match.start() - start >= min_chars:
+            end = match.end()
+    return end
+
+async def push_whatsapp_message(message_data: WhatsAppMessage, text: str, last: bool) -> bool:
+    """Send a reply chunk to the contact through the WhatsApp bridge"""
+    try:
+        response = await whatsapp_client().post("/send", json={
+            "company_id": message_data.company_id,
+            "phone_number": message_data.phone_number,
+            "reply_to": message_data.message_id,
+            "message": text,
+            "last": last
+        })
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        WHATSAPP_PUSH_ERRORS.inc()
+        logging.error(f"Error pushing reply chunk to the WhatsApp bridge: {str(e) or type(e).__name__}")
+        return False
+
+class ReplyStream:
+    """Pushes a reply to the bridge in sentence/paragraph chunks while it is generated"""
+
+    def __init__(self, message_data: WhatsAppMessage):
+        self.message_data = message_data
+        self.started = time.perf_counter()
+        self.text = ""  # everything generated so far
+        self.sent = 0  # length of self.text already pushed
+        self.chunks_sent = 0
+
+    async def push(self, text: str, last: bool = False):
+        if await push_whatsapp_message(self.message_data, text, last):
+            if not self.chunks_sent:
+                STREAM_FIRST_CHUNK.observe(time.perf_counter() - self.started)
+            self.chunks_sent += 1
+
+    def reset(self):
+        """Drop the text of a model that failed before any of it reached the contact"""
+        self.text = ""
+        self.sent = 0
+
+    async def consume(self, deltas) -> str:
+        """Push every complete chunk of a provider stream; the last one is held back for the signature"""
+        async for delta in deltas:
+            self.text += delta
+            end = chunk_boundary(self.text, self.sent, WHATSAPP_STREAM_MIN_CHARS)
+            if end is not None:
+                chunk = self.text[self.sent:end].strip()
+                self.sent = end
+                await self.push(chunk)
+        return self.text
+
+    async def finish(self, department_id: Optional[str], company_id: str) -> str:
+        """Push the rest of the reply with the department signature; returns the full signed reply
+
+        The final frame is always sent, with an empty message when everything was pushed already,
+        so the bridge knows the reply is complete.
+        """
+        rest = self.text[self.sent:].strip()
+        signed = await add_department_signature(rest, department_id, company_id)
+        self.sent = len(self.text)
+        await self.push(signed.strip(), last=True)
+        return self.text.strip() + signed[len(rest):]
+
+class RecentMessageCache:
+    """Bounded LRU of recently answered WhatsApp message ids and their replies"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._replies = OrderedDict()
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._replies
+
+    def get(self, message_id: str) -> Optional[str]:
+        self._replies.move_to_end(message_id)
+        return self._replies[message_id]
+
+    def add(self, message_id: str, reply: Optional[str]):
+        self._replies[message_id] = reply
+        self._replies.move_to_end(message_id)
+        if len(self._replies) > self.max_size:
+            self._replies.popitem(last=False)
+
+recent_messages = RecentMessageCache(int(os.environ.get("RECENT_MESSAGE_IDS_MAX", "10000")))
+
+class TokenBucketLimiter:
+    """In-process token buckets per key; idle (already full) buckets are evicted in LRU order"""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 100000):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst)
+        self.max_keys = max_keys
+        self.enabled = per_minute > 0 and burst > 0
+        self._buckets = OrderedDict()  # key -> (tokens, last update)
+
+    def allow(self, key: str, now: Optional[float] = None) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic() if now is None else now
+        
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float):
+        # A bucket idle for capacity/rate seconds is full again, so forgetting it changes nothing
+        refill_seconds = self.capacity / self.rate
+        while self._buckets:
+            oldest_key, (_, last_update) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - last_update < refill_seconds:
+                break
+            del self._buckets[oldest_key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+# Rate limits on the AI path (requests per minute / burst size, 0 disables)
+phone_rate_limiter = TokenBucketLimiter(
+    float(os.environ.get("RATE_LIMIT_PHONE_PER_MINUTE", "20")),
+    int(os.environ.get("RATE_LIMIT_PHONE_BURST", "10"))
+)
+# Off unless configured: every inbound message arrives from the bridge's IP, so a limit
+# sized for one client would throttle all contacts at once
+ip_rate_limiter = TokenBucketLimiter(
+    float(os.environ.get("RATE_LIMIT_IP_PER_MINUTE", "0")),
+    int(os.environ.get("RATE_LIMIT_IP_BURST", "100"))
+)
+department_rate_limiter = TokenBucketLimiter(
+    float(os.environ.get("RATE_LIMIT_DEPARTMENT_PER_MINUTE", "300")),
+    int(os.environ.get("RATE_LIMIT_DEPARTMENT_BURST", "60"))
+)
+
+THROTTLED_REPLY = "Recebemos sua mensagem! Nossa equipe responderá em instantes. 🙏"
+
+def ai_rate_limit_allows(message_data: WhatsAppMessage) -> bool:
+    """Check the per-contact and per-department buckets for a message headed to the AI"""
+    return (
+        phone_rate_limiter.allow(f"{message_data.company_id}:{message_data.phone_number}")
+        and department_rate_limiter.allow(f"{message_data.company_id}:{message_data.department_id or 'general'}")
+    )
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+class StageTimer:
+    """Accumulates wall-clock milliseconds per pipeline stage for one message"""
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def finish(self) -> dict:
+        self.stages["total"] = (time.perf_counter() - self.started) * 1000
+        return self.stages
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages.items())
+
+# Timer of the message being processed, so helpers deep in the pipeline can report their stage
+current_stage_timer: ContextVar[Optional[StageTimer]] = ContextVar("current_stage_timer", default=None)
+
+@contextmanager
+def pipeline_stage(name: str):
+    """Time a block as a stage of the current message (no-op outside the message pipeline)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_pipeline_stage(name, time.perf_counter() - start)
+
+def record_pipeline_stage(name: str, seconds: float):
+    timer = current_stage_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+class PipelineTimingWindow:
+    """Sliding window of per-message stage timings for percentile reports"""
+
+    def __init__(self, window_seconds: int, max_samples: int):
+        self.window_seconds = window_seconds
+        self._samples = deque(maxlen=max_samples)  # (monotonic time, stages)
+
+    def record(self, stages: dict):
+        self._samples.append((time.monotonic(), stages))
+
+    def percentiles(self, percentiles=(50, 95, 99)) -> dict:
+        cutoff = time.monotonic() - self.window_seconds
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        
+        values_by_stage = {}
+        for _, stages in self._samples:
+            for name, ms in stages.items():
+                values_by_stage.setdefault(name, []).append(ms)
+        
+        report = {}
+        for name, values in values_by_stage.items():
+            values.sort()
+            report[name] = {"count": len(values)}
+            for percentile in percentiles:
+                # Nearest-rank percentile
+                rank = max(1, -(-percentile * len(values) // 100))
+                report[name][f"p{percentile}"] = round(values[rank - 1], 2)
+        return report
+
+pipeline_timings = PipelineTimingWindow(
+    int(os.environ.get("PIPELINE_TIMING_WINDOW_SECONDS", "900")),
+    int(os.environ.get("PIPELINE_TIMING_MAX_SAMPLES", "20000"))
+)
+# Fraction of conversation records that keep their stage breakdown
+PIPELINE_TIMING_SAMPLE_RATE = float(os.environ.get("PIPELINE_TIMING_SAMPLE_RATE", "0.01"))
+
+def sample_pipeline_timings(timer: StageTimer, reply_record: dict):
+    """Attach the stage breakdown so far to a sampled subset of reply records"""
+    if random.random() < PIPELINE_TIMING_SAMPLE_RATE:
+        timings = {name: round(ms, 2) for name, ms in timer.stages.items()}
+        timings["total"] = round((time.perf_counter() - timer.started) * 1000, 2)
+        reply_record["timings"] = timings
+
+# Max number of contacts answered concurrently while processing a batch
+WHATSAPP_BATCH_CONCURRENCY = int(os.environ.get("WHATSAPP_BATCH_CONCURRENCY", "8"))
+# How long a message may stay unanswered before a retry regenerates its reply,
+# and how long a retry waits for a reply this worker is still generating
+WHATSAPP_REPLY_PENDING_SECONDS = int(os.environ.get("WHATSAPP_REPLY_PENDING_SECONDS", "120"))
+WHATSAPP_REPLY_RETRY_AFTER_SECONDS = int(os.environ.get("WHATSAPP_REPLY_RETRY_AFTER_SECONDS", "5"))
+
+# Replies this worker is generating, keyed like recent_messages; a retry of the
+# same message awaits the future instead of answering again
+reply_futures = {}
+
+def reject_reply_pending():
+    """409 telling the bridge to retry a message whose reply is not stored yet"""
+    raise HTTPException(
+        status_code=409,
+        detail="Reply still being generated",
+        headers={"Retry-After": str(WHATSAPP_REPLY_RETRY_AFTER_SECONDS)}
+    )
+
+async def wait_for_pending_reply(future: asyncio.Future) -> Optional[str]:
+    """The reply an in-flight attempt produces, or None if it fails or takes too long"""
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), WHATSAPP_REPLY_PENDING_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+
+@app.post("/api/whatsapp/message", response_model=MessageResponse)
+async def handle_whatsapp_message(
+    message_data: WhatsAppMessage, request: Request, response: Response, company_id: str = Depends(get_bridge_company)
+):
+    """Process incoming WhatsApp messages and generate AI responses"""
+    reject_if_draining()
+    assign_bridge_company([message_data], company_id)
+    db = tenant_database(message_data.company_id)
+    cache_key = recent_message_key(message_data)
+    timer = StageTimer()
+    timer_token = current_stage_timer.set(timer)
+    inflight_token = inflight_work.begin("message", message_data.message_id or message_data.phone_number)
+    future = None
+    awaiting_reply = False
+    try:
+        # Retried webhook for a message we already answered
+        if cache_key in recent_messages:
+            return MessageResponse(reply=recent_messages.get(cache_key))
+        # Retried webhook for a message this worker is still answering
+        if cache_key in reply_futures:
+            reply = await wait_for_pending_reply(reply_futures[cache_key])
+            if reply is None:
+                reject_reply_pending()
+            return MessageResponse(reply=reply)
+        future = reply_futures[cache_key] = asyncio.get_running_loop().create_future()
+
+        # Store message in conversation history (the unique message_id index rejects retries)
+        try:
+            with timer.stage("store_incoming"):
+                await store_conversation(db, build_incoming_conversation(message_data))
+        except DuplicateKeyError:
+            replies = await find_original_replies(db, message_data.company_id, [message_data.message_id])
+            if message_data.message_id in replies:
+                return MessageResponse(reply=replies[message_data.message_id])
+            # No reply stored: answer again only if the earlier attempt failed or stalled
+            if not await claim_unanswered_message(db, message_data.company_id, message_data.message_id):
+                reject_reply_pending()
+        awaiting_reply = True
+
+        # Get or create contact
+        with timer.stage("contact"):
+            contacts_collection = db.contacts
+            contact = await contacts_collection.find_one({"company_id": message_data.company_id, "phone_number": message_data.phone_number})
+            
+            if not contact:
+                # Create new contact
+                contact_data = {
+                    "id": str(uuid.uuid4()),
+                    "company_id": message_data.company_id,
+                    "name": f"Contact {message_data.phone_number}",
+                    "phone_number": message_data.phone_number,
+                    "email": None,
+                    "company": None,
+                    "created_at": datetime.utcnow().isoformat(),
+                    "last_message": datetime.utcnow().isoformat()
+                }
+                await contacts_collection.insert_one(contact_data)
+                contact = contact_data
+            else:
+                # Update last message time
+                await contacts_collection.update_one(
+                    {"company_id": message_data.company_id, "phone_number": message_data.phone_number},
+                    {"$set": {"last_message": datetime.utcnow().isoformat()}}
+                )
+
+        # Throttled senders get a canned reply instead of an LLM call
+        throttled = not (ip_rate_limiter.allow(client_ip(request)) and ai_rate_limit_allows(message_data))
+        reply_stream = None
+        if throttled:
+            FALLBACK_REPLIES.labels("throttled").inc()
+            ai_response = THROTTLED_REPLY
+        else:
+            reply_stream = ReplyStream(message_data) if WHATSAPP_STREAMING else None
+            ai_response = await generate_message_reply(message_data, db, reply_stream)
+        
+        if ai_response:
+            # Store AI response
+            reply_record = build_reply_conversation(message_data, ai_response, throttled=throttled)
+            sample_pipeline_timings(timer, reply_record)
+            with timer.stage("store_reply"):
+                await store_conversation(db, reply_record)
+            await mark_reply_outcome(db, message_data.company_id, [message_data.message_id], [])
+        else:
+            await mark_reply_outcome(db, message_data.company_id, [], [message_data.message_id])
+        awaiting_reply = False
+        pipeline_timings.record(timer.finish())
+        recent_messages.add(cache_key, ai_response)
+        future.set_result(ai_response)
+
+        return MessageResponse(reply=ai_response, streamed=bool(reply_stream and reply_stream.chunks_sent))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error processing WhatsApp message: {str(e)}")
+        if awaiting_reply:
+            await mark_reply_outcome(db, message_data.company_id, [], [message_data.message_id])
+        return MessageResponse(
+            reply="Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?",
+            success=False
+        )
+    finally:
+        if future is not None:
+            reply_futures.pop(cache_key, None)
+            if not future.done():
+                future.set_result(None)
+        current_stage_timer.reset(timer_token)
+        inflight_work.end(inflight_token)
+        if timer.stages:
+            response.headers["Server-Timing"] = timer.server_timing()
+
+@app.post("/api/whatsapp/messages/batch", response_model=BatchMessageResponse)
+async def handle_whatsapp_message_batch(
+    messages: List[WhatsAppMessage], request: Request, response: Response, company_id: str = Depends(get_bridge_company)
+):
+    """Process a batch of incoming WhatsApp messages (e.g. queued messages replayed after a reconnect)"""
+    reject_if_draining()
+    if not messages:
+        return BatchMessageResponse(results=[])
+    # A batch comes from one bridge session, which belongs to a single company
+    assign_bridge_company(messages, company_id)
+    db = tenant_database(company_id)
+    
+    inflight_token = inflight_work.begin("batch", [message.message_id for message in messages])
+    try:
+        return await process_whatsapp_message_batch(messages, request, response, db)
+    finally:
+        inflight_work.end(inflight_token)
+
+async def process_whatsapp_message_batch(messages: List[WhatsAppMessage], request: Request, response: Response, db) -> BatchMessageResponse:
+    company_id = messages[0].company_id
+    results: List[Optional[MessageResult]] = [None] * len(messages)
+
+    # Retried messages we already answered are served from memory; repeated ids
+    # inside the batch resolve to the result of their first occurrence
+    first_index = {}
+    pending = []
+    waiting = []
+    for index, message in enumerate(messages):
+        if recent_message_key(message) in recent_messages:
+            results[index] = MessageResult(
+                message_id=message.message_id,
+                reply=recent_messages.get(recent_message_key(message))
+            )
+        elif message.message_id not in first_index:
+            first_index[message.message_id] = index
+            if recent_message_key(message) in reply_futures:
+                # Still being answered by another request of this worker
+                waiting.append((index, message, reply_futures[recent_message_key(message)]))
+            else:
+                pending.append((index, message))
+
+    futures = {}
+    for _, message in pending:
+        futures[message.message_id] = reply_futures[recent_message_key(message)] = asyncio.get_running_loop().create_future()
+    try:
+        return await answer_whatsapp_message_batch(messages, results, first_index, pending, waiting, futures, request, response, db)
+    finally:
+        for message_id, future in futures.items():
+            reply_futures.pop(f"{company_id}:{message_id}", None)
+            if not future.done():
+                future.set_result(None)
+
+async def answer_whatsapp_message_batch(messages, results, first_index, pending, waiting, futures, request: Request, response: Response, db) -> BatchMessageResponse:
+    company_id = messages[0].company_id
+
+    batch_timer = StageTimer()
+    try:
+        now = datetime.utcnow().isoformat()
+
+        # Upsert every affected contact in a single round trip
+        phone_numbers = list(dict.fromkeys(message.phone_number for message in messages))
+        with batch_timer.stage("contact"):
+            await db.contacts.bulk_write([
+                UpdateOne(
+                    {"company_id": company_id, "phone_number": phone_number},
+                    {
+                        "$set": {"last_message": now},
+                        "$setOnInsert": {
+                            "id": str(uuid.uuid4()),
+                            "name": f"Contact {phone_number}",
+                            "email": None,
+                            "company": None,
+                            "created_at": now
+                        }
+                    },
+                    upsert=True
+                )
+                for phone_number in phone_numbers
+            ], ordered=False)
+
+        # Store all incoming messages with a single insert; duplicates of messages
+        # stored by an earlier request are rejected by the unique message_id index.
+        # Records are stamped in the order the bridge received the messages, so history reads in sending order.
+        duplicate_ids = []
+        if pending:
+            arrival = sorted((message for _, message in pending), key=lambda message: message.timestamp)
+            stored_at = datetime.utcnow()
+            try:
+                with batch_timer.stage("store_incoming"):
+                    await store_conversations(
+                        db,
+                        [
+                            build_incoming_conversation(message, (stored_at + timedelta(microseconds=position)).isoformat())
+                            for position, message in enumerate(arrival)
+                        ],
+                        ordered=False
+                    )
+            except BulkWriteError as e:
+                write_errors = e.details.get("writeErrors", [])
+                if any(error.get("code") != 11000 for error in write_errors):
+                    raise
+                duplicate_ids = [arrival[error["index"]].message_id for error in write_errors]
+
+        if duplicate_ids:
+            replies = await find_original_replies(db, company_id, duplicate_ids)
+            unanswered = [message_id for message_id in duplicate_ids if message_id not in replies]
+            # Messages without a stored reply are answered again only if their earlier attempt failed or stalled
+            claimed = await asyncio.gather(*(claim_unanswered_message(db, company_id, message_id) for message_id in unanswered))
+            claimed_ids = {message_id for message_id, ok in zip(unanswered, claimed) if ok}
+            for message_id in duplicate_ids:
+                if message_id in claimed_ids:
+                    continue
+                index = first_index[message_id]
+                results[index] = MessageResult(
+                    message_id=message_id, reply=replies.get(message_id), success=message_id in replies
+                )
+
+    except Exception as e:
+        logging.error(f"Error storing WhatsApp message batch: {str(e)}")
+        return BatchMessageResponse(
+            results=[
+                MessageResult(
+                    message_id=message.message_id,
+                    reply="Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?",
+                    success=False
+                )
+                for message in messages
+            ],
+            success=False
+        )
+
+    # Group new messages per contact, keeping the order in which they were sent
+    messages_by_contact = {}
+    for index, message in pending:
+        if results[index] is None:
+            messages_by_contact.setdefault(message.phone_number, []).append((index, message))
+
+    reply_records = []  # stored together once the batch is answered
+    stored_ids = []  # replies stored as soon as they were generated
+    failed_ids = []
+    semaphore = asyncio.Semaphore(WHATSAPP_BATCH_CONCURRENCY)
+    # The source IP is charged once per request, contacts and departments once per message
+    ip_allowed = ip_rate_limiter.allow(client_ip(request))
+
+    async def reply_to_contact(contact_messages):
+        # Replies for a single contact are generated sequentially so the conversation stays in order
+        async with semaphore:
+            ordered = sorted(contact_messages, key=lambda item: item[1].timestamp)
+            for position, (index, message) in enumerate(ordered):
+                timer = StageTimer()
+                timer_token = current_stage_timer.set(timer)
+                # The whole batch is stored already; the context must not see messages sent after this one
+                excluded_token = context_excluded_messages.set(frozenset(later.message_id for _, later in ordered[position + 1:]))
+                try:
+                    throttled = not (ip_allowed and ai_rate_limit_allows(message))
+                    if throttled:
+                        FALLBACK_REPLIES.labels("throttled").inc()
+                        ai_response = THROTTLED_REPLY
+                    else:
+                        ai_response = await generate_message_reply(message, db)
+                    if ai_response:
+                        reply_record = build_reply_conversation(message, ai_response, throttled=throttled)
+                        sample_pipeline_timings(timer, reply_record)
+                        if position + 1 < len(ordered):
+                            # The contact's later messages are answered with this reply in their context
+                            with timer.stage("store_reply"):
+                                await store_conversation(db, reply_record)
+                            stored_ids.append(message.message_id)
+                        else:
+                            reply_records.append(reply_record)
+                    else:
+                        failed_ids.append(message.message_id)
+                    pipeline_timings.record(timer.finish())
+                    results[index] = MessageResult(message_id=message.message_id, reply=ai_response)
+                except Exception as e:
+                    logging.error(f"Error replying to WhatsApp message {message.message_id}: {str(e)}")
+                    failed_ids.append(message.message_id)
+                    results[index] = MessageResult(
+                        message_id=message.message_id,
+                        reply="Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?",
+                        success=False
+                    )
+                finally:
+                    current_stage_timer.reset(timer_token)
+                    context_excluded_messages.reset(excluded_token)
+
+    with batch_timer.stage("replies"):
+        await asyncio.gather(*(reply_to_contact(items) for items in messages_by_contact.values()))
+
+    answered_ids = stored_ids + [record["reply_to"] for record in reply_records]
+    if reply_records:
+        try:
+            with batch_timer.stage("store_reply"):
+                await store_conversations(db, reply_records)
+        except Exception as e:
+            logging.error(f"Error storing AI replies for WhatsApp message batch: {str(e)}")
+            failed_ids += [record["reply_to"] for record in reply_records]
+            answered_ids = stored_ids
+    await mark_reply_outcome(db, company_id, answered_ids, failed_ids)
+    # Only replies that were stored are served to retries
+    for message_id in answered_ids:
+        index = first_index[message_id]
+        recent_messages.add(f"{company_id}:{message_id}", results[index].reply)
+        futures[message_id].set_result(results[index].reply)
+
+    if waiting:
+        replies = await asyncio.gather(*(wait_for_pending_reply(future) for _, _, future in waiting))
+        for (index, message, _), reply in zip(waiting, replies):
+            results[index] = MessageResult(message_id=message.message_id, reply=reply, success=reply is not None)
+    
+    batch_timer.finish()
+    response.headers["Server-Timing"] = batch_timer.server_timing()
+
+    for index, message in enumerate(messages):
+        if results[index] is None:
+            first = results[first_index[message.message_id]]
+            results[index] = MessageResult(message_id=message.message_id, reply=first.reply, success=first.success)
+
+    return BatchMessageResponse(results=results, success=all(result.success for result in results))
+
+def build_incoming_conversation(message_data: WhatsAppMessage, timestamp: Optional[str] = None) -> dict:
+    """Build the conversation record for an incoming WhatsApp message, stamped now unless a timestamp is given"""
+    return {
+        "id": str(uuid.uuid4()),
+        "company_id": message_data.company_id,
+        "message_id": message_data.message_id,
+        "contact_phone": message_data.phone_number,
+        "department_id": message_data.department_id,
+        "message": message_data.message,
+        "direction": "incoming",
+        "timestamp": timestamp or datetime.utcnow().isoformat(),
+        "ai_processed": False,
+        "reply_status": "pending",
+        "reply_deadline": reply_deadline()
+    }
+
+def build_reply_conversation(message_data: WhatsAppMessage, ai_response: str, throttled: bool = False) -> dict:
+    """Build the conversation record for an AI reply to an incoming WhatsApp message"""
+    record = {
+        "id": str(uuid.uuid4()),
+        "company_id": message_data.company_id,
+        "contact_phone": message_data.phone_number,
+        "reply_to": message_data.message_id,
+        "message": ai_response,
+        "direction": "outgoing",
+        "timestamp": datetime.utcnow().isoformat(),
+        "ai_generated": not throttled
+    }
+    if throttled:
+        record["throttled"] = True
+    return record
+
+def reply_deadline() -> str:
+    """Until when a message waiting for its reply is left to the attempt answering it"""
+    return (datetime.utcnow() + timedelta(seconds=WHATSAPP_REPLY_PENDING_SECONDS)).isoformat()
+
+def incoming_record_update(company_id: str, message_id: str, fields: dict, condition: Optional[dict] = None) -> UpdateOne:
+    """Update setting fields on a stored incoming message, if it also matches condition"""
+    condition = condition or {}
+    if CONVERSATION_STORAGE == "buckets":
+        return UpdateOne(
+            {"company_id": company_id, "message_ids": message_id},
+            {"$set": {f"messages.$[record].{field}": value for field, value in fields.items()}},
+            array_filters=[{
+                "record.message_id": message_id,
+                **{f"record.{field}": value for field, value in condition.items()}
+            }]
+        )
+    return UpdateOne({"company_id": company_id, "message_id": message_id, **condition}, {"$set": fields})
+
+async def update_incoming_records(db, company_id: str, message_ids: List[str], fields: dict):
+    """Set fields on stored incoming messages in a single round trip"""
+    if not message_ids:
+        return
+    collection = conversation_buckets(db) if CONVERSATION_STORAGE == "buckets" else conversation_log(db)
+    await collection.bulk_write(
+        [incoming_record_update(company_id, message_id, fields) for message_id in message_ids],
+        ordered=False
+    )
+
+async def mark_reply_outcome(db, company_id: str, answered_ids: List[str], failed_ids: List[str]):
+    """Record which incoming messages got a stored reply and which a retry must answer again"""
+    try:
+        await update_incoming_records(db, company_id, answered_ids, {"reply_status": "answered", "ai_processed": True})
+        await update_incoming_records(
+            db, company_id, failed_ids, {"reply_status": "failed", "reply_deadline": datetime.utcnow().isoformat()}
+        )
+    except Exception as e:
+        logging.error(f"Error recording reply outcome of WhatsApp messages: {str(e)}")
+
+async def claim_unanswered_message(db, company_id: str, message_id: str) -> bool:
+    """Take over a stored message whose earlier attempt failed or stalled without storing a reply"""
+    now = datetime.utcnow().isoformat()
+    update = incoming_record_update(
+        company_id, message_id,
+        {"reply_status": "pending", "reply_deadline": reply_deadline()},
+        # Records stored before reply tracking have no deadline and can be claimed too
+        {"reply_status": {"$ne": "answered"}, "reply_deadline": {"$not": {"$gte": now}}}
+    )
+    collection = conversation_buckets(db) if CONVERSATION_STORAGE == "buckets" else conversation_log(db)
+    result = await collection.bulk_write([update])
+    return result.modified_count == 1
+
+async def mark_ai_followup(db, message_data: WhatsAppMessage, reason: str):
+    """Flag a stored incoming message as still needing an AI answer"""
+    try:
+        await update_incoming_records(
+            db, message_data.company_id, [message_data.message_id],
+            {"ai_followup_pending": True, "ai_followup_reason": reason}
+        )
+    except Exception as e:
+        logging.error(f"Error marking message {message_data.message_id} for AI follow-up: {str(e)}")
+
+# Messages that got a fallback reply while the LLM was overloaded are answered again by the AI.
+# Follow-ups older than AI_FOLLOWUP_MAX_AGE_SECONDS are dropped: the answer would come too late.
+AI_FOLLOWUP_INTERVAL_SECONDS = int(os.environ.get("AI_FOLLOWUP_INTERVAL_SECONDS", "60"))
+AI_FOLLOWUP_MAX_AGE_SECONDS = int(os.environ.get("AI_FOLLOWUP_MAX_AGE_SECONDS", "900"))
+AI_FOLLOWUP_BATCH_SIZE = int(os.environ.get("AI_FOLLOWUP_BATCH_SIZE", "50"))
+
+async def pending_ai_followups(db, company_id: str, limit: int) -> List[dict]:
+    """Incoming records of a company flagged for an AI follow-up, oldest first"""
+    if CONVERSATION_STORAGE == "buckets":
+        cursor = conversation_buckets(db).find(
+            {"company_id": company_id, "messages.ai_followup_pending": True}, {"_id": 0}
+        ).limit(limit)
+        records = [record async for bucket in cursor for record in unbucket(bucket) if record.get("ai_followup_pending")]
+    else:
+        records = await conversation_log(db).find(
+            {"company_id": company_id, "ai_followup_pending": True}, {"_id": 0}
+        ).limit(limit).to_list(length=None)
+    return sorted(records, key=lambda record: record["timestamp"])[:limit]
+
+@singleton_job("answer_ai_followups", AI_FOLLOWUP_INTERVAL_SECONDS)
+async def answer_ai_followups(db):
+    """Push the AI answer to messages that only got a fallback reply, once the LLM has room again"""
+    cutoff = (datetime.utcnow() - timedelta(seconds=AI_FOLLOWUP_MAX_AGE_SECONDS)).isoformat()
+    for target_db, company_ids in await tenant_schema_targets(db):
+        for company_id in company_ids:
+            for record in await pending_ai_followups(target_db, company_id, AI_FOLLOWUP_BATCH_SIZE):
+                if draining:
+                    return
+                message_data = WhatsAppMessage(
+                    phone_number=record["contact_phone"],
+                    message=record["message"],
+                    message_id=record["message_id"],
+                    timestamp=0,
+                    department_id=record.get("department_id"),
+                    company_id=company_id
+                )
+                if record["timestamp"] < cutoff:
+                    await update_incoming_records(
+                        target_db, company_id, [message_data.message_id],
+                        {"ai_followup_pending": False, "ai_followup_result": "expired"}
+                    )
+                    continue
+                try:
+                    reply = await generate_ai_response(
+                        message_data.message, message_data.phone_number, message_data.department_id, company_id,
+                        fallback=False, message_id=message_data.message_id
+                    )
+                except LlmOverloaded:
+                    return  # still saturated, try again on the next run
+                if not reply or not await push_whatsapp_message(message_data, reply, last=True):
+                    continue  # kept pending until it is answered or expires
+                reply_record = build_reply_conversation(message_data, reply)
+                reply_record["ai_followup"] = True
+                await store_conversation(target_db, reply_record)
+                await update_incoming_records(
+                    target_db, company_id, [message_data.message_id],
+                    {"ai_followup_pending": False, "ai_followup_result": "answered"}
+                )
+
+async def find_original_replies(db, company_id: str, message_ids: List[str]) -> dict:
+    """Return the stored AI replies keyed by the message_id they answered"""
+    if CONVERSATION_STORAGE == "buckets":
+        wanted = set(message_ids)
+        cursor = db.conversation_buckets.find(
+            {"company_id": company_id, "messages.reply_to": {"$in": message_ids}},
+            {"_id": 0, "messages.reply_to": 1, "messages.message": 1}
+        )
+        records = [record async for bucket in cursor for record in bucket["messages"] if record.get("reply_to") in wanted]
+    else:
+        records = await db.conversations.find(
+            {"company_id": company_id, "reply_to": {"$in": message_ids}},
+            {"_id": 0, "reply_to": 1, "message": 1}
+        ).to_list(length=None)
+    replies = {}
+    for record in records:
+        replies[record["reply_to"]] = record["message"]
+        recent_messages.add(f"{company_id}:{record['reply_to']}", record["message"])
+    return replies
+
+def recent_message_key(message_data: WhatsAppMessage) -> str:
+    """Key of a message in recent_messages (message ids are only unique within a company)"""
+    return f"{message_data.company_id}:{message_data.message_id}"
+
+async def generate_message_reply(message_data: WhatsAppMessage, db, reply_stream: Optional[ReplyStream] = None) -> str:
+    """Generate the AI reply for an incoming message and handle any department transfer it implies"""
+    department_id = message_data.department_id
+    if INTENT_ROUTER_ENABLED:
+        with pipeline_stage("intent"):
+            template_reply = await trivial_message_reply(db, message_data)
+            if template_reply is None and not department_id:
+                department_id = await route_to_department(db, message_data)
+        if template_reply is not None:
+            return template_reply
+    
+    try:
+        ai_response = await generate_ai_response(
+            message_data.message, message_data.phone_number, department_id, message_data.company_id,
+            reply_stream=reply_stream, message_id=message_data.message_id
+        )
+    except LlmOverloaded as e:
+        # Shed load: answer with the department fallback now and leave the message for an AI follow-up
+        FALLBACK_REPLIES.labels("overloaded").inc()
+        await mark_ai_followup(db, message_data, f"{e.scope}_{e.reason}")
+        return await department_fallback_reply(department_id, message_data.company_id)
+    
+    # Check if AI response indicates a department transfer
+    with pipeline_stage("transfer"):
+        await check_and_handle_department_transfer(ai_response, message_data.phone_number, db, message_data.company_id)
+    
+    return ai_response
+
+# Intent pre-router
+# Runs before any LLM call: greetings, thanks, acknowledgements, goodbyes and emoji-only messages
+# get a template reply, and messages not addressed to a department are routed to one of the
+# seeded departments by keyword rules, then by a naive Bayes bag-of-words model trained on
+# the company's stored conversations.
+INTENT_ROUTER_ENABLED = os.environ.get("INTENT_ROUTER_ENABLED", "false").lower() == "true"
+# Minimum posterior probability for the model to pick a department
+INTENT_ROUTER_MIN_CONFIDENCE = float(os.environ.get("INTENT_ROUTER_MIN_CONFIDENCE", "0.7"))
+INTENT_ROUTER_RETRAIN_SECONDS = int(os.environ.get("INTENT_ROUTER_RETRAIN_SECONDS", "3600"))
+# Stored messages per company used for training
+INTENT_ROUTER_TRAINING_LIMIT = int(os.environ.get("INTENT_ROUTER_TRAINING_LIMIT", "20000"))
+INTENT_ROUTER_MAX_VOCABULARY = 5000
+# Longer messages are never treated as trivial
+TRIVIAL_MAX_TOKENS = 8
+
+# Trivial intents in priority order: (intent, words that identify it, words it may also contain)
+TRIVIAL_INTENTS = [
+    ("goodbye", {"tchau", "ate", "flw", "falou", "bye", "fui"}, {"logo", "mais", "breve", "amanha", "depois", "entao"}),
+    ("thanks", {"obrigado", "obrigada", "obg", "brigado", "brigada", "valeu", "vlw", "grato", "grata", "agradeco", "thanks"},
+        {"muito", "mto", "pela", "pelo", "ajuda", "atencao", "retorno", "informacao", "informacoes"}),
+    # Before greetings, so that "tá bom" is not taken for "bom dia"
+    ("ack", {"ok", "okay", "blz", "beleza", "certo", "entendi", "entendido", "perfeito", "show", "combinado", "otimo", "joia", "ta"},
+        {"esta", "tudo", "bem", "bom", "entao"}),
+    ("greeting", {"oi", "ola", "opa", "eai", "hello", "hi", "hey", "alo", "salve", "bom", "boa"},
+        {"dia", "tarde", "noite", "tudo", "td", "bem", "como", "vai", "voce", "vc", "ai"}),
+]
+TRIVIAL_FILLER_WORDS = {"a", "o", "e", "de", "da", "do", "pra", "para", "com", "voces", "pessoal", "gente", "senhor", "senhora", "sr", "sra"}
+TRIVIAL_VOCABULARY = set().union(TRIVIAL_FILLER_WORDS, *(anchors | extra for _, anchors, extra in TRIVIAL_INTENTS))
+INTENT_TEMPLATES = {
+    "greeting": "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?",
+    "thanks": "Por nada! Se precisar de mais alguma coisa, é só chamar.",
+    "ack": "Combinado! Qualquer dúvida, estou à disposição.",
+    "goodbye": "Até logo! A Empresas Web agradece o seu contato.",
+    "emoji": "😊 Se precisar de algo, é só mandar uma mensagem!"
+}
+# Intents that may be the answer to a question of the assistant; those go to the LLM
+CONTEXT_SENSITIVE_INTENTS = {"ack", "emoji"}
+
+# Words that route a message to a seeded department on their own
+DEPARTMENT_KEYWORDS = {
+    "abertura-de-empresa": {"abrir", "abertura", "mei", "cnpj", "constituicao", "constituir", "contrato", "cnae"},
+    "duvidas-contabeis": {"balanco", "balancete", "contabil", "contabeis", "contabilidade", "demonstracao", "escrituracao", "dre"},
+    "rh-e-folha": {"folha", "funcionario", "funcionarios", "admissao", "demissao", "ferias", "salario", "esocial", "rescisao", "fgts"},
+    "tributos-e-impostos": {"imposto", "impostos", "tributo", "tributos", "tributario", "irpj", "icms", "iss", "presumido"},
+    "emissao-de-notas-fiscais": {"nota", "notas", "nfe", "nfse", "nf", "certificado", "sped"},
+    "financeiro": {"boleto", "boletos", "pagamento", "cobranca", "fatura", "mensalidade", "pagar", "pix", "vencimento", "honorarios"},
+}
+
+def intent_tokens(text: str) -> List[str]:
+    """Lowercase words of a message without accents"""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    return re.findall(r"[a-z0-9]+", normalized.encode("ascii", "ignore").decode())
+
+# Characters that join or restyle emoji without being symbols themselves
+# (zero-width joiner, variation selectors, combining keycap)
+EMOJI_MODIFIERS = {"\u200d", "\ufe0e", "\ufe0f", "\u20e3"}
+
+def emoji_only(text: str) -> bool:
+    """True when a message holds emoji/pictographic symbols and nothing else"""
+    symbols = False
+    for char in text:
+        if unicodedata.category(char) in ("So", "Sk"):
+            symbols = True
+        elif not (char.isspace() or char in EMOJI_MODIFIERS):
+            return False
+    return symbols
+
+class IntentRouter:
+    """Keyword rules for trivial messages and a multinomial naive Bayes department classifier"""
+
+    def __init__(self):
+        self.vocabulary = {}  # word -> column
+        self.slugs = []
+        self.log_prior = None  # (departments,)
+        self.log_likelihood = None  # (departments, words)
+
+    @staticmethod
+    def trivial_intent(text: str) -> Optional[str]:
+        """Trivial intent of a message, None when it needs a real answer"""
+        if not text.strip():
+            return None  # media without caption
+        tokens = intent_tokens(text)
+        if not tokens:
+            # Punctuation or a script the word rules do not cover needs a real answer
+            return "emoji" if emoji_only(text) else None
+        if len(tokens) > TRIVIAL_MAX_TOKENS or not TRIVIAL_VOCABULARY.issuperset(tokens):
+            return None
+        for intent, anchors, _ in TRIVIAL_INTENTS:
+            if anchors.intersection(tokens):
+                return intent
+        return None
+
+    def fit(self, texts: List[str], slugs: List[str]):
+        import numpy as np
+        documents = [intent_tokens(text) for text in texts]
+        frequencies = {}
+        for tokens in documents:
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+        words = sorted(frequencies, key=frequencies.get, reverse=True)[:INTENT_ROUTER_MAX_VOCABULARY]
+        self.vocabulary = {word: column for column, word in enumerate(words)}
+        self.slugs = sorted(set(slugs))
+        rows = {slug: row for row, slug in enumerate(self.slugs)}
+        
+        counts = np.ones((len(self.slugs), len(words)))  # Laplace smoothing
+        documents_per_slug = np.zeros(len(self.slugs))
+        for tokens, slug in zip(documents, slugs):
+            columns = [self.vocabulary[token] for token in tokens if token in self.vocabulary]
+            np.add.at(counts[rows[slug]], columns, 1)
+            documents_per_slug[rows[slug]] += 1
+        self.log_prior = np.log(documents_per_slug / documents_per_slug.sum())
+        self.log_likelihood = np.log(counts / counts.sum(axis=1, keepdims=True))
+
+    def classify(self, text: str) -> Optional[tuple]:
+        """(department slug, confidence) from the keyword rules, else from the model"""
+        tokens = intent_tokens(text)
+        matches = [slug for slug, keywords in DEPARTMENT_KEYWORDS.items() if keywords.intersection(tokens)]
+        if len(matches) == 1:
+            return matches[0], 1.0
+        if self.log_likelihood is None:
+            return None
+        columns = [self.vocabulary[token] for token in tokens if token in self.vocabulary]
+        if not columns:
+            return None
+        import numpy as np
+        scores = self.log_prior + self.log_likelihood[:, columns].sum(axis=1)
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.slugs[best], float(probabilities[best])
+
+# Keyword rules only, used until a company's model is trained
+keyword_router = IntentRouter()
+# Department classifier per company: company_id -> (router, monotonic time it was trained)
+intent_routers = {}
+# Companies whose classifier is being trained by this worker
+intent_router_trainings = set()
+
+def company_intent_router(company_id: str) -> IntentRouter:
+    """The company's department classifier; training starts in the background when it is missing or stale"""
+    entry = intent_routers.get(company_id)
+    stale = entry is None or time.monotonic() - entry[1] > INTENT_ROUTER_RETRAIN_SECONDS
+    if stale and company_id not in intent_router_trainings and not draining:
+        intent_router_trainings.add(company_id)
+        spawn_tracked(train_intent_router(company_id), f"intent_router:{company_id}")
+    return entry[0] if entry else keyword_router
+
+async def trivial_message_reply(db, message_data: WhatsAppMessage) -> Optional[str]:
+    """Template reply for a trivial message, None when the message needs the LLM"""
+    intent = IntentRouter.trivial_intent(message_data.message)
+    if intent in CONTEXT_SENSITIVE_INTENTS:
+        # "ok" or 👍 right after a question of the assistant is an answer to it
+        history = await load_hot_conversation(db, message_data.company_id, message_data.phone_number, 3)
+        replies = [record for record in history if record.get("direction") == "outgoing"]
+        if replies and "?" in replies[-1].get("message", ""):
+            intent = None
+    if intent is None:
+        return None
+    INTENT_ROUTER_DECISIONS.labels(intent).inc()
+    return await add_department_signature(INTENT_TEMPLATES[intent], message_data.department_id, message_data.company_id)
+
+async def route_to_department(db, message_data: WhatsAppMessage) -> Optional[str]:
+    """Id of the seeded department a message not addressed to any department belongs to"""
+    prediction = company_intent_router(message_data.company_id).classify(message_data.message)
+    if prediction is None or prediction[1] < INTENT_ROUTER_MIN_CONFIDENCE:
+        INTENT_ROUTER_DECISIONS.labels("llm").inc()
+        return None
+    department = await db.departments.find_one(
+        {"company_id": message_data.company_id, "slug": prediction[0], "active": True}, {"_id": 0, "id": 1}
+    )
+    INTENT_ROUTER_DECISIONS.labels("routed" if department else "llm").inc()
+    return department["id"] if department else None
 
-# WhatsApp Routes
-WHATSAPP_SERVICE_URL = "http://localhost:3001"
+async def intent_training_records(db, company_id: str, department_ids: List[str]) -> List[dict]:
+    """Stored incoming messages of a company that were addressed to one of the given departments"""
+    if CONVERSATION_STORAGE != "buckets":
+        return await db.conversations.find(
+            {"company_id": company_id, "direction": "incoming", "department_id": {"$in": department_ids}},
+            {"_id": 0, "message": 1, "department_id": 1}
+        ).to_list(length=INTENT_ROUTER_TRAINING_LIMIT)
+    records = []
+    cursor = db.conversation_buckets.find(
+        {"company_id": company_id, "messages.department_id": {"$in": department_ids}},
+        {"_id": 0, "messages.message": 1, "messages.department_id": 1, "messages.direction": 1}
+    )
+    async for bucket in cursor:
+        records.extend(
+            record for record in bucket["messages"]
+            if record.get("direction") == "incoming" and record.get("department_id") in department_ids
+        )
+        if len(records) >= INTENT_ROUTER_TRAINING_LIMIT:
+            break
+    return records[:INTENT_ROUTER_TRAINING_LIMIT]
 
-@app.post("/api/whatsapp/message", response_model=MessageResponse)
-async def handle_whatsapp_message(message_data: WhatsAppMessage, db=Depends(get_database)):
-    """Process incoming WhatsApp messages and generate AI responses"""
+async def train_intent_router(company_id: str):
+    """Train a company's department classifier on the seeded department texts and its own conversations"""
+    texts, slugs = [], []
+    for department in DEFAULT_DEPARTMENTS:
+        keywords = " ".join(DEPARTMENT_KEYWORDS.get(department["slug"], ()))
+        texts.append(f"{department['name']} {department['description']} {department['manual_instructions']} {keywords}")
+        slugs.append(department["slug"])
     try:
-        # Get or create contact
-        contacts_collection = db.contacts
-        contact = await contacts_collection.find_one({"phone_number": message_data.phone_number})
-        
-        if not contact:
-            # Create new contact
-            contact_data = {
-                "id": str(uuid.uuid4()),
-                "name": f"Contact {message_data.phone_number}",
-                "phone_number": message_data.phone_number,
-                "email": None,
-                "company": None,
-                "created_at": datetime.utcnow().isoformat(),
-                "last_message": datetime.utcnow().isoformat()
-            }
-            await contacts_collection.insert_one(contact_data)
-            contact = contact_data
-        else:
-            # Update last message time
-            await contacts_collection.update_one(
-                {"phone_number": message_data.phone_number},
-                {"$set": {"last_message": datetime.utcnow().isoformat()}}
+        db = tenant_database(company_id)
+        seeded_slugs = [department["slug"] for department in DEFAULT_DEPARTMENTS]
+        department_slugs = {
+            department["id"]: department["slug"]
+            async for department in db.departments.find(
+                {"company_id": company_id, "slug": {"$in": seeded_slugs}}, {"_id": 0, "id": 1, "slug": 1}
             )
-
-        # Store message in conversation history
-        conversations_collection = db.conversations
-        conversation_data = {
-            "id": str(uuid.uuid4()),
-            "contact_phone": message_data.phone_number,
-            "message": message_data.message,
-            "direction": "incoming",
-            "timestamp": datetime.utcnow().isoformat(),
-            "ai_processed": False
         }
-        await conversations_collection.insert_one(conversation_data)
-
-        # Generate AI response
-        ai_response = await generate_ai_response(message_data.message, message_data.phone_number)
+        for record in await intent_training_records(db, company_id, list(department_slugs)):
+            texts.append(record.get("message") or "")
+            slugs.append(department_slugs[record["department_id"]])
         
-        # Check if AI response indicates a department transfer
-        await check_and_handle_department_transfer(ai_response, message_data.phone_number, db)
-        
-        if ai_response:
-            # Store AI response
-            response_data = {
-                "id": str(uuid.uuid4()),
-                "contact_phone": message_data.phone_number,
-                "message": ai_response,
-                "direction": "outgoing",
-                "timestamp": datetime.utcnow().isoformat(),
-                "ai_generated": True
-            }
-            await conversations_collection.insert_one(response_data)
+        router = IntentRouter()
+        await asyncio.to_thread(router.fit, texts, slugs)
+        intent_routers[company_id] = (router, time.monotonic())
+        logging.info(f"Intent router of {company_id} trained on {len(texts)} messages ({len(router.vocabulary)} words)")
+    except Exception as e:
+        logging.error(f"Error training intent router of {company_id}: {str(e)}")
+        # Keep serving the previous model (or the keyword rules) and retry after WARMUP_RETRY_SECONDS
+        previous = intent_routers.get(company_id)
+        retry_at = time.monotonic() - INTENT_ROUTER_RETRAIN_SECONDS + WARMUP_RETRY_SECONDS
+        intent_routers[company_id] = (previous[0] if previous else keyword_router, retry_at)
+    finally:
+        intent_router_trainings.discard(company_id)
 
-        return MessageResponse(reply=ai_response)
+TRANSFER_INDICATORS = (
+    "transferir você para",
+    "vou transferir",
+    "encaminhar para",
+    "direcionando para",
+    "departamento de"
+)
+TRANSFER_DEPARTMENTS = ("vendas", "suporte", "financeiro", "gerencial")
 
-    except Exception as e:
-        logging.error(f"Error processing WhatsApp message: {str(e)}")
-        return MessageResponse(
-            reply="Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?",
-            success=False
-        )
+def detect_transfer_department(ai_response: str) -> Optional[str]:
+    """Department an AI response transfers the contact to, if any"""
+    text = ai_response.lower()
+    if not any(indicator in text for indicator in TRANSFER_INDICATORS):
+        return None
+    for dept in TRANSFER_DEPARTMENTS:
+        if dept in text:
+            return dept
+    return None
 
-async def check_and_handle_department_transfer(ai_response: str, phone_number: str, db):
+async def check_and_handle_department_transfer(ai_response: str, phone_number: str, db, company_id: str = DEFAULT_COMPANY_ID):
     """Check if AI response indicates a department transfer and handle it"""
     try:
-        transfer_indicators = [
-            "transferir você para",
-            "vou transferir",
-            "encaminhar para",
-            "direcionando para",
-            "departamento de"
-        ]
-        
-        if any(indicator in ai_response.lower() for indicator in transfer_indicators):
-            # Extract department from response
-            departments = ["vendas", "suporte", "financeiro", "gerencial"]
-            detected_department = None
+        detected_department = detect_transfer_department(ai_response)
+        if detected_department:
+            TRANSFERS_DETECTED.labels(detected_department).inc()
             
-            for dept in departments:
-                if dept in ai_response.lower():
-                    detected_department = dept
-                    break
+            # Get or create department
+            department = await db.departments.find_one({"company_id": company_id, "name": {"$regex": detected_department, "$options": "i"}})
             
-            if detected_department:
-                # Get or create department
-                department = await db.departments.find_one({"name": {"$regex": detected_department, "$options": "i"}})
-                
-                if not department:
-                    # Create department if it doesn't exist
-                    department_data = {
-                        "id": str(uuid.uuid4()),
-                        "name": detected_department.title(),
-                        "description": f"Departamento de {detected_department}",
-                        "active": True,
-                        "created_at": datetime.utcnow().isoformat()
-                    }
-                    await db.departments.insert_one(department_data)
-                    department = department_data
-                
-                # Create transfer record
-                transfer_data = {
+            if not department:
+                # Create department if it doesn't exist
+                department_data = {
                     "id": str(uuid.uuid4()),
-                    "from_contact": phone_number,
-                    "to_department": department["id"],
-                    "message": ai_response,
-                    "status": "pending",
-                    "created_at": datetime.utcnow().isoformat(),
-                    "handled_by": None,
-                    "notes": f"Transfer automático detectado pela IA para {detected_department}"
+                    "company_id": company_id,
+                    "name": detected_department.title(),
+                    "description": f"Departamento de {detected_department}",
+                    "active": True,
+                    "created_at": datetime.utcnow().isoformat()
                 }
-                await db.transfers.insert_one(transfer_data)
-                
+                await db.departments.insert_one(department_data)
+                department = department_data
+            
+            # Create transfer record
+            transfer_data = {
+                "id": str(uuid.uuid4()),
+                "company_id": company_id,
+                "from_contact": phone_number,
+                "to_department": department["id"],
+                "message": ai_response,
+                "status": "pending",
+                "created_at": datetime.utcnow().isoformat(),
+                "handled_by": None,
+                "notes": f"Transfer automático detectado pela IA para {detected_department}"
+            }
+            await db.transfers.insert_one(transfer_data)
+        
     except Exception as e:
         logging.error(f"Error handling department transfer: {str(e)}")
 
-async def generate_ai_response(message: str, phone_number: str, department_id: Optional[str] = None) -> str:
-    """Generate AI response using Emergent LLM with specialized department context"""
-    try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        import os
-        
-        # Get API key from environment
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        logging.info(f"AI Response - API key found: {api_key is not None}")
-        
-        if not api_key:
-            logging.warning("No EMERGENT_LLM_KEY found, using fallback response")
-            base_response = "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?"
-            return await add_department_signature(base_response, department_id)
-        
-        # Get department info for specialized context
-        department_context = ""
-        department_instructions = ""
-        if department_id:
-            try:
-                db = database
-                department = await db.departments.find_one({"id": department_id})
-                if department:
-                    department_context = f"Departamento: {department['name']} - {department['description']}"
-                    department_instructions = department.get('manual_instructions', '')
-            except:
-                pass
-        
-        # Build specialized system message
-        system_message = f"""Você é o assistente de IA especializado da Empresas Web, uma empresa líder em serviços contábeis e empresariais.
+def build_system_message(department_context: str = "", department_instructions: str = "") -> str:
+    """System prompt for the assistant, specialized with the department context and manual instructions"""
+    return f"""Você é o assistente de IA especializado da Empresas Web, uma empresa líder em serviços contábeis e empresariais.
 
 {department_context}
 
@@ -557,76 +2763,576 @@ Seu papel:
 - Manter respostas concisas e práticas
 
 NÃO inclua assinatura na resposta - ela será adicionada automaticamente."""
+
+# LLM providers
+class LlmProvider(abc.ABC):
+    """Backend used by generate_ai_response to get a completion from a provider/model"""
+
+    requires_api_key = True
+
+    @abc.abstractmethod
+    async def complete(self, provider: str, model: str, system_message: str, session_id: str, text: str, api_key: Optional[str] = None) -> Optional[str]:
+        """The whole completion of text by the model"""
+
+    async def stream(self, provider: str, model: str, system_message: str, session_id: str, text: str, api_key: Optional[str] = None):
+        """Yield the completion as it is generated; backends without streaming yield it whole"""
+        response = await self.complete(provider, model, system_message, session_id, text, api_key=api_key)
+        if response:
+            yield response
+
+class EmergentLlmProvider(LlmProvider):
+    """Real providers through emergentintegrations"""
+
+    async def complete(self, provider, model, system_message, session_id, text, api_key=None):
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
         
-        # Try different models if one fails
-        models_to_try = [
-            ("gemini", "gemini-1.5-flash"),
-            ("openai", "gpt-4o-mini"),
-            ("openai", "gpt-3.5-turbo")
-        ]
+        chat = LlmChat(
+            api_key=api_key,
+            session_id=session_id,
+            system_message=system_message
+        ).with_model(provider, model)
+        return await chat.send_message(UserMessage(text=text))
+
+class FakeLlmProvider(LlmProvider):
+    """Deterministic offline provider for benchmarks and fault injection
+
+    Behaviour is configured per model name, with "*" as the default:
+        {
+            "gemini-1.5-flash": {
+                "latency_ms": {"distribution": "lognormal", "mean": 800, "stddev": 300},
+                "error_rate": 0.05,
+                "timeout_rate": 0.01,
+                "response_chars": 400,
+                "completion_tokens": 120
+            },
+            "*": {"latency_ms": {"distribution": "fixed", "value": 50}}
+        }
+    Latency distributions: fixed (value), uniform (min, max), normal and lognormal (mean, stddev).
+    A timed-out call hangs for hang_ms so the caller's LLM_CALL_TIMEOUT_SECONDS fires.
+    Streamed completions arrive in pieces of stream_chunk_chars, spread evenly over the latency.
+    """
+
+    requires_api_key = False
+    DEFAULT_MODEL_CONFIG = {
+        "latency_ms": {"distribution": "fixed", "value": 50},
+        "error_rate": 0.0,
+        "timeout_rate": 0.0,
+        "hang_ms": 120000,
+        "response_chars": 300,
+        "stream_chunk_chars": 16,
+    }
+    FILLER = (
+        "Olá! Obrigado pelo contato com a Empresas Web. "
+        "Posso ajudar com a abertura da sua empresa, contabilidade, folha de pagamento e tributos. "
+        "Me conte um pouco mais sobre a sua necessidade para que eu possa orientar você. "
+    )
+
+    def __init__(self, config: Optional[dict] = None, seed: int = 42):
+        self.config = config or {}
+        self._rng = random.Random(seed)
+        self.usage = {}  # model -> call, error, timeout and token counters
+
+    def model_config(self, model: str) -> dict:
+        return {**self.DEFAULT_MODEL_CONFIG, **self.config.get("*", {}), **self.config.get(model, {})}
+
+    def sample_latency(self, latency: dict) -> float:
+        distribution = latency.get("distribution", "fixed")
+        if distribution == "uniform":
+            value = self._rng.uniform(latency["min"], latency["max"])
+        elif distribution == "normal":
+            value = self._rng.gauss(latency["mean"], latency.get("stddev", 0))
+        elif distribution == "lognormal":
+            # Parameterised by the mean/stddev of the latency itself, not of its logarithm
+            mean, stddev = latency["mean"], latency.get("stddev", 0)
+            sigma_squared = math.log(1 + (stddev / mean) ** 2)
+            value = self._rng.lognormvariate(math.log(mean) - sigma_squared / 2, math.sqrt(sigma_squared))
+        else:
+            value = latency.get("value", 0)
+        return max(0.0, value) / 1000
+
+    async def complete(self, provider, model, system_message, session_id, text, api_key=None):
+        return "".join([piece async for piece in self.stream(provider, model, system_message, session_id, text, api_key)])
+
+    async def stream(self, provider, model, system_message, session_id, text, api_key=None):
+        config = self.model_config(model)
+        usage = self.usage.setdefault(model, {"calls": 0, "errors": 0, "timeouts": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        usage["calls"] += 1
         
-        for provider, model in models_to_try:
+        # Draw every random decision up front so the sequence does not depend on timing
+        roll = self._rng.random()
+        latency = self.sample_latency(config["latency_ms"])
+        
+        if roll < config["timeout_rate"]:
+            usage["timeouts"] += 1
+            await asyncio.sleep(config["hang_ms"] / 1000)
+            raise asyncio.TimeoutError(f"Fake {provider}/{model} timed out")
+        
+        if roll < config["timeout_rate"] + config["error_rate"]:
+            await asyncio.sleep(latency)
+            usage["errors"] += 1
+            raise RuntimeError(f"Fake {provider}/{model} error")
+        
+        chars = config["response_chars"]
+        response = (self.FILLER * (chars // len(self.FILLER) + 1))[:chars].strip()
+        usage["prompt_tokens"] += config.get("prompt_tokens", (len(system_message) + len(text)) // 4)
+        usage["completion_tokens"] += config.get("completion_tokens", len(response) // 4)
+        size = max(1, config["stream_chunk_chars"])
+        pieces = [response[start:start + size] for start in range(0, len(response), size)]
+        for piece in pieces:
+            await asyncio.sleep(latency / len(pieces))
+            yield piece
+
+def create_llm_provider() -> LlmProvider:
+    """Provider selected by LLM_PROVIDER (emergent or fake)"""
+    if os.environ.get("LLM_PROVIDER", "emergent").lower() == "fake":
+        config = {}
+        if os.environ.get("FAKE_LLM_CONFIG_FILE"):
+            with open(os.environ["FAKE_LLM_CONFIG_FILE"]) as f:
+                config = json.load(f)
+        elif os.environ.get("FAKE_LLM_CONFIG"):
+            config = json.loads(os.environ["FAKE_LLM_CONFIG"])
+        return FakeLlmProvider(config, seed=int(os.environ.get("FAKE_LLM_SEED", "42")))
+    return EmergentLlmProvider()
+
+llm_provider = create_llm_provider()
+
+# Fallback chain tried in order until a model returns a completion
+LLM_MODELS = [
+    ("gemini", "gemini-1.5-flash"),
+    ("openai", "gpt-4o-mini"),
+    ("openai", "gpt-3.5-turbo")
+]
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", "30"))
+
+class LlmOverloaded(Exception):
+    """No LLM concurrency slot became free in time"""
+
+    def __init__(self, scope: str, reason: str):
+        super().__init__(f"LLM {scope} slots exhausted ({reason})")
+        self.scope = scope
+        self.reason = reason
+
+class ConcurrencySlots:
+    """Concurrency limit with a bounded wait queue; 0 slots means unlimited"""
+
+    def __init__(self, scope: str, max_concurrency: int, max_queue: int):
+        self.scope = scope
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+    async def acquire(self, timeout: float):
+        if self.max_concurrency <= 0:
+            return
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            LLM_SLOT_WAIT.labels(self.scope).observe(0)
+        else:
+            if self.waiting >= self.max_queue:
+                LLM_SLOT_REJECTIONS.labels(self.scope, "queue_full").inc()
+                raise LlmOverloaded(self.scope, "queue_full")
+            self.waiting += 1
+            LLM_SLOT_QUEUE_DEPTH.labels(self.scope).inc()
+            start = time.perf_counter()
             try:
-                # Initialize chat with session per phone number and department
-                session_id = f"whatsapp_{phone_number}_{department_id or 'general'}"
-                chat = LlmChat(
-                    api_key=api_key,
-                    session_id=session_id,
-                    system_message=system_message
-                ).with_model(provider, model)
-                
-                # Create user message
-                user_message = UserMessage(text=message)
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=timeout)
+            except asyncio.TimeoutError:
+                LLM_SLOT_REJECTIONS.labels(self.scope, "queue_timeout").inc()
+                raise LlmOverloaded(self.scope, "queue_timeout")
+            finally:
+                self.waiting -= 1
+                LLM_SLOT_QUEUE_DEPTH.labels(self.scope).dec()
+                LLM_SLOT_WAIT.labels(self.scope).observe(time.perf_counter() - start)
+        LLM_SLOTS_IN_USE.labels(self.scope).inc()
+
+    def release(self):
+        if self.max_concurrency <= 0:
+            return
+        self._semaphore.release()
+        LLM_SLOTS_IN_USE.labels(self.scope).dec()
+
+class LlmConcurrencyLimiter:
+    """Global and per-provider limits on concurrent LLM calls"""
+
+    def __init__(self, max_concurrency: int, provider_max_concurrency: dict, default_provider_max: int, max_queue: int, queue_timeout: float):
+        self.global_slots = ConcurrencySlots("global", max_concurrency, max_queue)
+        self.provider_max_concurrency = provider_max_concurrency
+        self.default_provider_max = default_provider_max
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.provider_slots = {}
+
+    def slots_for(self, provider: str) -> ConcurrencySlots:
+        slots = self.provider_slots.get(provider)
+        if slots is None:
+            max_concurrency = self.provider_max_concurrency.get(provider, self.default_provider_max)
+            slots = self.provider_slots[provider] = ConcurrencySlots(provider, max_concurrency, self.max_queue)
+        return slots
+
+    @asynccontextmanager
+    async def slot(self, provider: str):
+        """Hold a global and a provider slot for one call; raises LlmOverloaded past the queue deadline"""
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.queue_timeout
+        provider_slots = self.slots_for(provider)
+        try:
+            await self.global_slots.acquire(self.queue_timeout)
+            try:
+                await provider_slots.acquire(max(0.0, deadline - time.monotonic()))
+            except LlmOverloaded:
+                self.global_slots.release()
+                raise
+        finally:
+            record_pipeline_stage("llm_queue", time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            provider_slots.release()
+            self.global_slots.release()
+
+llm_limiter = LlmConcurrencyLimiter(
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "32")),
+    # e.g. LLM_PROVIDER_MAX_CONCURRENCY='{"gemini": 16, "openai": 8}'
+    provider_max_concurrency=json.loads(os.environ.get("LLM_PROVIDER_MAX_CONCURRENCY", "{}")),
+    default_provider_max=int(os.environ.get("LLM_PROVIDER_DEFAULT_MAX_CONCURRENCY", "0")),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", "64")),
+    queue_timeout=float(os.environ.get("LLM_QUEUE_TIMEOUT_SECONDS", "2"))
+)
+
+# Replies served when no AI completion is available, keyed by department name
+DEPARTMENT_FALLBACK_REPLIES = {
+    "Abertura de Empresa": "Olá! Sou especialista em abertura de empresas. Posso ajudar com MEI, CNPJ e toda documentação necessária!",
+    "Dúvidas Contábeis": "Olá! Sou especialista em contabilidade. Posso ajudar com balanços, demonstrações e escrituração contábil!",
+    "RH e Folha": "Olá! Sou especialista em RH e folha de pagamento. Posso ajudar com admissões, cálculos trabalhistas e eSocial!",
+    "Tributos e Impostos": "Olá! Sou especialista em tributos. Posso ajudar com Simples Nacional e planejamento tributário!",
+    "Emissão de Notas Fiscais": "Olá! Sou especialista em notas fiscais. Posso ajudar com NFe, NFSe e certificados digitais!",
+    "Outros Assuntos": "Olá! Sou consultor empresarial. Posso ajudar com orientações gerais e estratégicas!",
+    "Financeiro": "Olá! Sou especialista financeiro. Posso ajudar com contas, fluxo de caixa e cobrança!"
+}
+DEFAULT_FALLBACK_REPLY = "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje? 🤖"
+
+async def department_fallback_reply(department_id: Optional[str] = None, company_id: str = DEFAULT_COMPANY_ID) -> str:
+    """Canned reply of the department (with its signature) for when the LLM is unavailable"""
+    dept_name = None
+    if department_id:
+        try:
+            department = await tenant_database(company_id).departments.find_one(
+                {"company_id": company_id, "id": department_id}, {"_id": 0, "name": 1}
+            )
+            dept_name = department.get('name') if department else None
+        except:
+            pass
+    base_response = DEPARTMENT_FALLBACK_REPLIES.get(dept_name, DEFAULT_FALLBACK_REPLY)
+    return await add_department_signature(base_response, department_id, company_id)
+
+# Conversation context
+# Prompts are built from the stored conversation instead of the LLM session memory: the latest turns
+# that fit LLM_CONTEXT_TOKEN_BUDGET, plus a rolling summary of the turns before them. The summary is
+# refreshed in the background and cached per contact, so prompt size stays flat for long chats.
+LLM_CONTEXT_TOKEN_BUDGET = int(os.environ.get("LLM_CONTEXT_TOKEN_BUDGET", "1500"))  # 0 keeps the LLM session memory
+LLM_CONTEXT_MAX_TURNS = int(os.environ.get("LLM_CONTEXT_MAX_TURNS", "20"))
+# Turns that left the window before the summary is refreshed (each refresh is one LLM call)
+LLM_SUMMARY_REFRESH_TURNS = int(os.environ.get("LLM_SUMMARY_REFRESH_TURNS", "10"))
+LLM_SUMMARY_MAX_TOKENS = int(os.environ.get("LLM_SUMMARY_MAX_TOKENS", "300"))
+# Message ids stored ahead of their turn (the later messages of a batch), kept out of the context
+context_excluded_messages: ContextVar[frozenset] = ContextVar("context_excluded_messages", default=frozenset())
+
+SUMMARY_SYSTEM_MESSAGE = (
+    "Você resume conversas de atendimento da Empresas Web. Escreva em português um resumo objetivo "
+    "com os dados do cliente, as necessidades dele, o que já foi respondido e o que ficou pendente. "
+    f"Use no máximo {LLM_SUMMARY_MAX_TOKENS * 3 // 4} palavras."
+)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+def format_turn(record: dict) -> str:
+    speaker = "Cliente" if record.get("direction") == "incoming" else "Assistente"
+    return f"{speaker}: {record.get('message', '')}"
+
+def select_context_window(history: List[dict], budget: int, max_turns: int) -> List[dict]:
+    """Latest records of a conversation (oldest first) whose turns fit the token budget"""
+    window = []
+    for record in reversed(history):
+        cost = estimate_tokens(format_turn(record))
+        if len(window) >= max_turns or cost > budget:
+            break
+        budget -= cost
+        window.append(record)
+    window.reverse()
+    return window
+
+def build_context_system_message(system_message: str, summary: Optional[str], window: List[dict]) -> str:
+    """System prompt extended with the conversation summary and the recent turns"""
+    parts = [system_message]
+    if summary:
+        parts.append(f"RESUMO DA CONVERSA ATÉ AGORA:\n{summary}")
+    if window:
+        parts.append("MENSAGENS RECENTES:\n" + "\n".join(format_turn(record) for record in window))
+    return "\n\n".join(parts)
+
+class ConversationSummaryCache:
+    """Bounded LRU of conversation summaries per (company, contact)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._summaries = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[dict]:
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+        return summary
+
+    def put(self, key: tuple, summary: dict):
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        if len(self._summaries) > self.max_size:
+            self._summaries.popitem(last=False)
+
+    def discard(self, key: tuple):
+        self._summaries.pop(key, None)
+
+summary_cache = ConversationSummaryCache(int(os.environ.get("CONVERSATION_SUMMARY_CACHE_MAX", "10000")))
+# Other workers drop their copy of a refreshed summary and read the new one on the next reply
+CACHE_INVALIDATION_HANDLERS["conversation_summaries"] = lambda key, data: summary_cache.discard((data["company_id"], data["contact_phone"]))
+# Contacts whose summary is being refreshed by this worker
+summary_refreshes = set()
+
+async def get_conversation_summary(db, company_id: str, phone_number: str) -> Optional[dict]:
+    """Cached summary of a contact ({summary, covered_until}), None until the first refresh"""
+    key = (company_id, phone_number)
+    summary = summary_cache.get(key)
+    if summary is None:
+        summary = await db.conversation_summaries.find_one(
+            {"company_id": company_id, "contact_phone": phone_number},
+            {"_id": 0, "summary": 1, "covered_until": 1}
+        )
+        if summary:
+            summary_cache.put(key, summary)
+    return summary
+
+async def summarize_conversation(previous_summary: Optional[str], records: List[dict]) -> Optional[str]:
+    """Fold records into the previous summary with the first model that answers"""
+    text = "\n".join(format_turn(record) for record in records)
+    if previous_summary:
+        text = f"Resumo anterior:\n{previous_summary}\n\nNovas mensagens:\n{text}"
+    api_key = os.environ.get('EMERGENT_LLM_KEY')
+    for provider, model in LLM_MODELS:
+        try:
+            async with llm_limiter.slot(provider):
+                with inflight_work.track("llm", f"{provider}/{model}"):
+                    summary = await asyncio.wait_for(
+                        llm_provider.complete(provider, model, SUMMARY_SYSTEM_MESSAGE, f"summary_{uuid.uuid4().hex}", text, api_key=api_key),
+                        timeout=LLM_CALL_TIMEOUT_SECONDS
+                    )
+            if summary:
+                return summary[:LLM_SUMMARY_MAX_TOKENS * 4]
+        except LlmOverloaded:
+            return None  # retried once more turns leave the window
+        except Exception as e:
+            logging.warning(f"Summary failed with {provider}/{model}: {str(e) or type(e).__name__}")
+    return None
+
+async def refresh_conversation_summary(db, company_id: str, phone_number: str, previous: Optional[dict], records: List[dict]):
+    """Fold the turns that left the context window into the contact's summary"""
+    key = (company_id, phone_number)
+    try:
+        summary = await summarize_conversation(previous["summary"] if previous else None, records)
+        if not summary:
+            return
+        covered_until = records[-1]["timestamp"]
+        document = {"summary": summary, "covered_until": covered_until}
+        # Another worker may have stored a more recent summary meanwhile; never move backwards
+        await db.conversation_summaries.update_one(
+            {"company_id": company_id, "contact_phone": phone_number, "covered_until": {"$not": {"$gte": covered_until}}},
+            {"$set": {**document, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        summary_cache.put(key, document)
+        await publish_cache_invalidation(
+            database, "conversation_summaries", f"{company_id}:{phone_number}",
+            company_id=company_id, contact_phone=phone_number
+        )
+    except DuplicateKeyError:
+        pass  # a newer summary is already stored
+    except Exception as e:
+        logging.error(f"Error refreshing conversation summary for {phone_number}: {str(e)}")
+    finally:
+        summary_refreshes.discard(key)
+
+async def build_conversation_context(db, company_id: str, phone_number: str, message: str, message_id: Optional[str] = None) -> tuple:
+    """(summary, window) for a reply: the rolling summary and the latest turns within the token budget
+
+    Schedules a summary refresh once enough turns have left the window.
+    """
+    # The message being answered is already stored; it is sent as the prompt itself
+    excluded = context_excluded_messages.get() | ({message_id} if message_id else frozenset())
+    # Enough history to fill the window and notice the turns that just left it
+    history = await load_hot_conversation(
+        db, company_id, phone_number, LLM_CONTEXT_MAX_TURNS + LLM_SUMMARY_REFRESH_TURNS + len(excluded)
+    )
+    history = [record for record in history if record.get("message_id") not in excluded]
+
+    summary = await get_conversation_summary(db, company_id, phone_number)
+    budget = LLM_CONTEXT_TOKEN_BUDGET - estimate_tokens(message) - (estimate_tokens(summary["summary"]) if summary else 0)
+    window = select_context_window(history, max(budget, 0), LLM_CONTEXT_MAX_TURNS)
+    
+    left_window = history[:len(history) - len(window)]
+    unsummarized = [record for record in left_window if not summary or record.get("timestamp", "") > summary["covered_until"]]
+    key = (company_id, phone_number)
+    if unsummarized and (summary is None or len(unsummarized) >= LLM_SUMMARY_REFRESH_TURNS) and key not in summary_refreshes:
+        summary_refreshes.add(key)
+        spawn_tracked(refresh_conversation_summary(db, company_id, phone_number, summary, unsummarized), f"summary:{phone_number}")
+    return (summary["summary"] if summary else None), window
+
+async def generate_ai_response(
+    message: str,
+    phone_number: str,
+    department_id: Optional[str] = None,
+    company_id: str = DEFAULT_COMPANY_ID,
+    reply_stream: Optional[ReplyStream] = None,
+    fallback: bool = True,
+    message_id: Optional[str] = None
+) -> Optional[str]:
+    """Generate AI response using Emergent LLM with specialized department context
+
+    Raises LlmOverloaded when every model's provider is saturated. With a reply_stream, the
+    completion is pushed to the bridge chunk by chunk as it is generated. With fallback=False,
+    None is returned instead of a canned reply when no model answers. The stored message with
+    message_id is the one being answered and is left out of the conversation context.
+    """
+    try:
+        # Get API key from environment
+        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        logging.info(f"AI Response - API key found: {api_key is not None}")
+        
+        if not api_key and llm_provider.requires_api_key:
+            logging.warning("No EMERGENT_LLM_KEY found, using fallback response")
+            if not fallback:
+                return None
+            FALLBACK_REPLIES.labels("no_api_key").inc()
+            base_response = "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?"
+            return await add_department_signature(base_response, department_id, company_id)
+        
+        # Get department info for specialized context
+        department_context = ""
+        department_instructions = ""
+        if department_id:
+            try:
+                db = tenant_database(company_id)
+                with pipeline_stage("department_context"):
+                    department = await db.departments.find_one({"company_id": company_id, "id": department_id})
+                if department:
+                    department_context = f"Departamento: {department['name']} - {department['description']}"
+                    department_instructions = department.get('manual_instructions', '')
+            except:
+                pass
+        
+        # Build specialized system message
+        system_message = build_system_message(department_context, department_instructions)
+        if LLM_CONTEXT_TOKEN_BUDGET:
+            with pipeline_stage("context"):
+                summary, window = await build_conversation_context(
+                    tenant_database(company_id), company_id, phone_number, message, message_id
+                )
+            system_message = build_context_system_message(system_message, summary, window)
+        
+        # Try different models if one fails
+        saturated, overloaded = set(), None
+        for provider, model in LLM_MODELS:
+            if provider in saturated:
+                continue
+            try:
+                if LLM_CONTEXT_TOKEN_BUDGET:
+                    # The context is in the prompt; a fresh session keeps the provider from replaying its own history
+                    session_id = f"whatsapp_{uuid.uuid4().hex}"
+                else:
+                    # Session per phone number and department
+                    session_id = f"whatsapp_{company_id}_{phone_number}_{department_id or 'general'}"
                 
                 # Get AI response
                 logging.info(f"Sending message to AI using {provider}/{model} for dept {department_id}: {message}")
-                response = await chat.send_message(user_message)
+                async with llm_limiter.slot(provider):
+                    call_start = time.perf_counter()
+                    try:
+                        with inflight_work.track("llm", f"{provider}/{model}"):
+                            if reply_stream is not None:
+                                completion = reply_stream.consume(
+                                    llm_provider.stream(provider, model, system_message, session_id, message, api_key=api_key)
+                                )
+                            else:
+                                completion = llm_provider.complete(provider, model, system_message, session_id, message, api_key=api_key)
+                            response = await asyncio.wait_for(completion, timeout=LLM_CALL_TIMEOUT_SECONDS)
+                    except asyncio.TimeoutError:
+                        call_seconds = time.perf_counter() - call_start
+                        LLM_CALL_LATENCY.labels(provider, model, "timeout").observe(call_seconds)
+                        record_pipeline_stage("llm", call_seconds)
+                        raise
+                    except Exception:
+                        call_seconds = time.perf_counter() - call_start
+                        LLM_CALL_LATENCY.labels(provider, model, "error").observe(call_seconds)
+                        record_pipeline_stage("llm", call_seconds)
+                        raise
+                    call_seconds = time.perf_counter() - call_start
+                LLM_CALL_LATENCY.labels(provider, model, "success" if response else "empty").observe(call_seconds)
+                record_pipeline_stage("llm", call_seconds)
                 logging.info(f"AI Response received from {provider}/{model}: {response}")
                 
                 if response:
                     # Add department signature
-                    return await add_department_signature(response, department_id)
+                    if reply_stream is not None:
+                        return await reply_stream.finish(department_id, company_id)
+                    return await add_department_signature(response, department_id, company_id)
                     
+            except LlmOverloaded as e:
+                if e.scope == "global":
+                    # No slot for any model
+                    raise
+                # This provider is saturated; its other models are skipped and the next provider tried
+                logging.warning(f"Skipping {provider}, no LLM slot ({e.reason})")
+                saturated.add(provider)
+                overloaded = e
+                continue
             except Exception as model_error:
-                logging.warning(f"Failed with {provider}/{model}: {str(model_error)}")
+                logging.warning(f"Failed with {provider}/{model}: {str(model_error) or type(model_error).__name__}")
+                if reply_stream is not None and reply_stream.chunks_sent:
+                    # The contact already got part of this reply; close it instead of starting over with another model
+                    return await reply_stream.finish(department_id, company_id)
+                if reply_stream is not None:
+                    reply_stream.reset()
                 continue
         
-        # If all models fail, return specialized fallback
-        fallback_responses = {
-            "Abertura de Empresa": "Olá! Sou especialista em abertura de empresas. Posso ajudar com MEI, CNPJ e toda documentação necessária!",
-            "Dúvidas Contábeis": "Olá! Sou especialista em contabilidade. Posso ajudar com balanços, demonstrações e escrituração contábil!",
-            "RH e Folha": "Olá! Sou especialista em RH e folha de pagamento. Posso ajudar com admissões, cálculos trabalhistas e eSocial!",
-            "Tributos e Impostos": "Olá! Sou especialista em tributos. Posso ajudar com Simples Nacional e planejamento tributário!",
-            "Emissão de Notas Fiscais": "Olá! Sou especialista em notas fiscais. Posso ajudar com NFe, NFSe e certificados digitais!",
-            "Outros Assuntos": "Olá! Sou consultor empresarial. Posso ajudar com orientações gerais e estratégicas!",
-            "Financeiro": "Olá! Sou especialista financeiro. Posso ajudar com contas, fluxo de caixa e cobrança!"
-        }
-        
-        # Get department name for fallback
-        dept_name = None
-        if department_id:
-            try:
-                department = await database.departments.find_one({"id": department_id})
-                dept_name = department.get('name') if department else None
-            except:
-                pass
+        if saturated == {provider for provider, _ in LLM_MODELS}:
+            raise overloaded
         
-        base_response = fallback_responses.get(dept_name, "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje? 🤖")
-        return await add_department_signature(base_response, department_id)
+        # If all models fail, return specialized fallback
+        if not fallback:
+            return None
+        FALLBACK_REPLIES.labels("all_models_failed").inc()
+        return await department_fallback_reply(department_id, company_id)
         
+    except LlmOverloaded:
+        raise
     except Exception as e:
         logging.error(f"Error generating AI response: {str(e)}", exc_info=True)
+        if not fallback:
+            return None
+        FALLBACK_REPLIES.labels("error").inc()
         base_response = "Olá! Sou o assistente virtual da Empresas Web. Como posso ajudá-lo hoje?"
-        return await add_department_signature(base_response, department_id)
+        return await add_department_signature(base_response, department_id, company_id)
 
-async def add_department_signature(message: str, department_id: Optional[str] = None) -> str:
+async def add_department_signature(message: str, department_id: Optional[str] = None, company_id: str = DEFAULT_COMPANY_ID) -> str:
     """Add department signature to message"""
     try:
         if not department_id:
             return message
             
-        db = database
-        department = await db.departments.find_one({"id": department_id})
+        db = tenant_database(company_id)
+        with pipeline_stage("signature"):
+            department = await db.departments.find_one({"company_id": company_id, "id": department_id})
         
         if department and department.get('signature'):
             return f"{message}\n\n{department['signature']}"
@@ -641,36 +3347,94 @@ async def add_department_signature(message: str, department_id: Optional[str] =
 
 
 # WhatsApp QR Routes (Simplified for MVP)
-@app.get("/api/whatsapp/qrcode")
-async def get_whatsapp_qr():
-    """Generate QR code for WhatsApp Web connection"""
-    # Generate a mock QR code for demonstration
+QR_SESSION_ID = "mock-session-12345"
+QR_SESSION_PAYLOAD = "https://web.whatsapp.com/mock-session-12345"
+QR_CACHE_MAX = 16
+
+# Rendered QR images keyed by (payload, format); values are tasks so concurrent
+# requests for a new payload share a single render
+qr_image_cache = OrderedDict()
+
+def render_qr_image(payload: str, image_format: str) -> bytes:
+    """Render a QR code as PNG, SVG or PNG data URL bytes (CPU bound, runs in a worker thread)"""
+    if image_format == "data_url":
+        png = render_qr_image(payload, "png")
+        return f"data:image/png;base64,{base64.b64encode(png).decode()}".encode()
+    
+    # Imported on first use: qrcode pulls in PIL, which most workers never need
+    import qrcode
+    import qrcode.image.svg
+    
     qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data("https://web.whatsapp.com/mock-session-12345")
+    qr.add_data(payload)
     qr.make(fit=True)
     
-    # Create QR code image
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert to base64
     buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    if image_format == "svg":
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+        img.save(buffered)
+    elif image_format == "png":
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(buffered, format="PNG")
+    else:
+        raise ValueError(f"Unsupported QR image format: {image_format}")
+    return buffered.getvalue()
+
+async def get_qr_image(payload: str, image_format: str) -> bytes:
+    key = (payload, image_format)
+    task = qr_image_cache.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(render_qr_image, payload, image_format))
+        qr_image_cache[key] = task
+        if len(qr_image_cache) > QR_CACHE_MAX:
+            qr_image_cache.popitem(last=False)
+    qr_image_cache.move_to_end(key)
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        if qr_image_cache.get(key) is task:
+            del qr_image_cache[key]
+        raise
+
+async def qr_image_response(request: Request, image_format: str, media_type: str) -> Response:
+    etag = f'"{hashlib.sha1(f"{QR_SESSION_PAYLOAD}:{image_format}".encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    content = await get_qr_image(QR_SESSION_PAYLOAD, image_format)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+@app.get("/api/whatsapp/qrcode")
+async def get_whatsapp_qr():
+    """Generate QR code for WhatsApp Web connection"""
+    # Generate a mock QR code for demonstration
+    img_str = (await get_qr_image(QR_SESSION_PAYLOAD, "data_url")).decode()
     
     return {
-        "qr_code": f"data:image/png;base64,{img_str}",
+        "qr_code": img_str,
         "status": "disconnected",
-        "session_id": "mock-session-12345"
+        "session_id": QR_SESSION_ID
     }
 
+@app.get("/api/whatsapp/qrcode.png")
+async def get_whatsapp_qr_png(request: Request):
+    """QR code for WhatsApp Web connection as a raw PNG image"""
+    return await qr_image_response(request, "png", "image/png")
+
+@app.get("/api/whatsapp/qrcode.svg")
+async def get_whatsapp_qr_svg(request: Request):
+    """QR code for WhatsApp Web connection as an SVG image"""
+    return await qr_image_response(request, "svg", "image/svg+xml")
+
 @app.post("/api/appointments")
-async def create_appointment(appointment: AppointmentCreate, db=Depends(get_database), user=Depends(get_current_user)):
+async def create_appointment(appointment: AppointmentCreate, user=Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     """Create a new appointment"""
     try:
         appointments_collection = db.appointments
         
         appointment_data = {
             "id": str(uuid.uuid4()),
+            "company_id": company_id,
             "title": appointment.title,
             "description": appointment.description,
             "scheduled_date": appointment.scheduled_date,
@@ -691,11 +3455,11 @@ async def create_appointment(appointment: AppointmentCreate, db=Depends(get_data
         raise HTTPException(status_code=500, detail="Error creating appointment")
 
 @app.get("/api/appointments")
-async def list_appointments(db=Depends(get_database), user=Depends(get_current_user)):
+async def list_appointments(user=Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     """List all appointments for the user"""
     try:
         appointments_collection = db.appointments
-        cursor = appointments_collection.find({"created_by": user})
+        cursor = appointments_collection.find({"company_id": company_id, "created_by": user})
         appointments = await cursor.to_list(length=100)
         
         return [mongo_to_dict(appointment) for appointment in appointments]
@@ -705,13 +3469,14 @@ async def list_appointments(db=Depends(get_database), user=Depends(get_current_u
         raise HTTPException(status_code=500, detail="Error retrieving appointments")
 
 @app.post("/api/scheduled-messages")
-async def create_scheduled_message(message: ScheduledMessageCreate, db=Depends(get_database), user=Depends(get_current_user)):
+async def create_scheduled_message(message: ScheduledMessageCreate, user=Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     """Create a new scheduled message"""
     try:
         messages_collection = db.scheduled_messages
         
         message_data = {
             "id": str(uuid.uuid4()),
+            "company_id": company_id,
             "title": message.title,
             "message": message.message,
             "recipients": message.recipients,
@@ -732,11 +3497,11 @@ async def create_scheduled_message(message: ScheduledMessageCreate, db=Depends(g
         raise HTTPException(status_code=500, detail="Error creating scheduled message")
 
 @app.get("/api/scheduled-messages")
-async def list_scheduled_messages(db=Depends(get_database), user=Depends(get_current_user)):
+async def list_scheduled_messages(user=Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     """List all scheduled messages for the user"""
     try:
         messages_collection = db.scheduled_messages
-        cursor = messages_collection.find({"created_by": user})
+        cursor = messages_collection.find({"company_id": company_id, "created_by": user})
         messages = await cursor.to_list(length=100)
         
         return [mongo_to_dict(message) for message in messages]
@@ -745,79 +3510,83 @@ async def list_scheduled_messages(db=Depends(get_database), user=Depends(get_cur
         logging.error(f"Error listing scheduled messages: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving scheduled messages")
 
+def build_extension_company_config(company_data: dict) -> dict:
+    """Chrome Extension configuration for one company"""
+    return {
+        "id": company_data["id"],
+        "name": company_data["name"],
+        "phone": company_data.get("whatsapp_number", ""),
+        "settings": {
+            "autoResponder": {
+                "enabled": False,
+                "welcomeMessage": "Olá! Obrigado por entrar em contato. Como posso ajudá-lo?",
+                "businessHours": {"start": "09:00", "end": "18:00"},
+                "weekdays": [1, 2, 3, 4, 5]
+            },
+            "quickButtons": [
+                {"text": "📋 Abertura de Empresa", "action": "send_message", "value": "Olá! Vou te ajudar com a abertura da sua empresa."},
+                {"text": "💰 Dúvidas Contábeis", "action": "send_message", "value": "Posso esclarecer suas dúvidas contábeis!"},
+                {"text": "👥 RH e Folha", "action": "send_message", "value": "Vamos resolver suas questões de RH e folha de pagamento."},
+                {"text": "📊 Impostos", "action": "send_message", "value": "Te ajudo com questões tributárias e impostos."}
+            ],
+            "labels": [
+                {"id": "hot_lead", "name": "Lead Quente", "color": "#EF4444"},
+                {"id": "warm_lead", "name": "Lead Morno", "color": "#F97316"},
+                {"id": "cold_lead", "name": "Lead Frio", "color": "#3B82F6"},
+                {"id": "client", "name": "Cliente", "color": "#10B981"},
+                {"id": "prospect", "name": "Prospect", "color": "#8B5CF6"}
+            ],
+            "signatures": {
+                "default": f"\n\n---\n📞 {company_data['name']}\n🌐 www.empresasweb.com.br\n📧 contato@empresasweb.com.br"
+            }
+        },
+        "crmData": {
+            "contacts": {},
+            "conversations": {},
+            "deals": {},
+            "campaigns": []
+        }
+    }
+
+def build_extension_config(companies: List[dict]) -> dict:
+    """Complete Chrome Extension configuration tree for the given companies"""
+    companies_dict = {company["id"]: build_extension_company_config(company) for company in companies}
+    
+    return {
+        "companies": companies_dict,
+        "activeCompany": list(companies_dict.keys())[0] if companies_dict else None,
+        "globalSettings": {
+            "autoSave": True,
+            "notifications": True,
+            "theme": "light",
+            "language": "pt-BR"
+        },
+        "crmConfig": {
+            "kanbanStages": [
+                {"id": "lead", "name": "Leads", "color": "#3B82F6"},
+                {"id": "contact", "name": "Primeiro Contato", "color": "#EAB308"},
+                {"id": "proposal", "name": "Proposta", "color": "#F97316"},
+                {"id": "negotiation", "name": "Negociação", "color": "#8B5CF6"},
+                {"id": "closed", "name": "Fechado", "color": "#10B981"},
+                {"id": "lost", "name": "Perdido", "color": "#EF4444"}
+            ]
+        },
+        "automationRules": [],
+        "quickButtons": [],
+        "scheduledMessages": [],
+        "massMessageCampaigns": []
+    }
+
 # Chrome Extension Integration Endpoints
 @app.get("/api/chrome-extension/config")
-async def get_extension_config(db=Depends(get_database), user=Depends(get_current_user)):
+async def get_extension_config(db=Depends(get_database), user=Depends(get_current_user), company_id: str = Depends(get_current_company)):
     """Get complete configuration for Chrome Extension"""
     try:
         companies_collection = db.companies
-        cursor = companies_collection.find({})
+        cursor = companies_collection.find({"id": company_id})
         companies = await cursor.to_list(length=100)
         
-        # Convert companies to extension format
-        companies_dict = {}
-        for company in companies:
-            company_data = mongo_to_dict(company)
-            companies_dict[company_data["id"]] = {
-                "id": company_data["id"],
-                "name": company_data["name"],
-                "phone": company_data.get("whatsapp_number", ""),
-                "settings": {
-                    "autoResponder": {
-                        "enabled": False,
-                        "welcomeMessage": "Olá! Obrigado por entrar em contato. Como posso ajudá-lo?",
-                        "businessHours": {"start": "09:00", "end": "18:00"},
-                        "weekdays": [1, 2, 3, 4, 5]
-                    },
-                    "quickButtons": [
-                        {"text": "📋 Abertura de Empresa", "action": "send_message", "value": "Olá! Vou te ajudar com a abertura da sua empresa."},
-                        {"text": "💰 Dúvidas Contábeis", "action": "send_message", "value": "Posso esclarecer suas dúvidas contábeis!"},
-                        {"text": "👥 RH e Folha", "action": "send_message", "value": "Vamos resolver suas questões de RH e folha de pagamento."},
-                        {"text": "📊 Impostos", "action": "send_message", "value": "Te ajudo com questões tributárias e impostos."}
-                    ],
-                    "labels": [
-                        {"id": "hot_lead", "name": "Lead Quente", "color": "#EF4444"},
-                        {"id": "warm_lead", "name": "Lead Morno", "color": "#F97316"},
-                        {"id": "cold_lead", "name": "Lead Frio", "color": "#3B82F6"},
-                        {"id": "client", "name": "Cliente", "color": "#10B981"},
-                        {"id": "prospect", "name": "Prospect", "color": "#8B5CF6"}
-                    ],
-                    "signatures": {
-                        "default": f"\n\n---\n📞 {company_data['name']}\n🌐 www.empresasweb.com.br\n📧 contato@empresasweb.com.br"
-                    }
-                },
-                "crmData": {
-                    "contacts": {},
-                    "conversations": {},
-                    "deals": {},
-                    "campaigns": []
-                }
-            }
-        
-        return {
-            "companies": companies_dict,
-            "activeCompany": list(companies_dict.keys())[0] if companies_dict else None,
-            "globalSettings": {
-                "autoSave": True,
-                "notifications": True,
-                "theme": "light",
-                "language": "pt-BR"
-            },
-            "crmConfig": {
-                "kanbanStages": [
-                    {"id": "lead", "name": "Leads", "color": "#3B82F6"},
-                    {"id": "contact", "name": "Primeiro Contato", "color": "#EAB308"},
-                    {"id": "proposal", "name": "Proposta", "color": "#F97316"},
-                    {"id": "negotiation", "name": "Negociação", "color": "#8B5CF6"},
-                    {"id": "closed", "name": "Fechado", "color": "#10B981"},
-                    {"id": "lost", "name": "Perdido", "color": "#EF4444"}
-                ]
-            },
-            "automationRules": [],
-            "quickButtons": [],
-            "scheduledMessages": [],
-            "massMessageCampaigns": []
-        }
+        return build_extension_config([mongo_to_dict(company) for company in companies])
         
     except Exception as e:
         logging.error(f"Error getting extension config: {str(e)}")
@@ -826,8 +3595,9 @@ async def get_extension_config(db=Depends(get_database), user=Depends(get_curren
 @app.post("/api/chrome-extension/crm-data")
 async def save_extension_crm_data(
     crm_data: dict, 
-    db=Depends(get_database), 
-    user=Depends(get_current_user)
+    db=Depends(get_tenant_database), 
+    user=Depends(get_current_user),
+    company_id: str = Depends(get_current_company)
 ):
     """Save CRM data from Chrome Extension"""
     try:
@@ -837,9 +3607,10 @@ async def save_extension_crm_data(
             for contact_id, contact_data in crm_data["contacts"].items():
                 contact_data["updated_at"] = datetime.utcnow().isoformat()
                 contact_data["updated_by"] = user
+                contact_data["company_id"] = company_id
                 
                 await contacts_collection.update_one(
-                    {"id": contact_id},
+                    {"company_id": company_id, "id": contact_id},
                     {"$set": contact_data},
                     upsert=True
                 )
@@ -850,9 +3621,10 @@ async def save_extension_crm_data(
             for deal_id, deal_data in crm_data["deals"].items():
                 deal_data["updated_at"] = datetime.utcnow().isoformat()
                 deal_data["updated_by"] = user
+                deal_data["company_id"] = company_id
                 
                 await deals_collection.update_one(
-                    {"id": deal_id},
+                    {"company_id": company_id, "id": deal_id},
                     {"$set": deal_data},
                     upsert=True
                 )
@@ -863,9 +3635,10 @@ async def save_extension_crm_data(
             for conv_id, conv_data in crm_data["conversations"].items():
                 conv_data["updated_at"] = datetime.utcnow().isoformat()
                 conv_data["updated_by"] = user
+                conv_data["company_id"] = company_id
                 
                 await conversations_collection.update_one(
-                    {"id": conv_id},
+                    {"company_id": company_id, "id": conv_id},
                     {"$set": conv_data},
                     upsert=True
                 )
@@ -879,8 +3652,9 @@ async def save_extension_crm_data(
 @app.post("/api/chrome-extension/mass-message")
 async def send_mass_message_extension(
     message_data: dict,
-    db=Depends(get_database),
-    user=Depends(get_current_user)
+    db=Depends(get_tenant_database),
+    user=Depends(get_current_user),
+    company_id: str = Depends(get_current_company)
 ):
     """Handle mass message sending from Chrome Extension"""
     try:
@@ -894,6 +3668,7 @@ async def send_mass_message_extension(
         
         campaign_record = {
             "id": campaign_id,
+            "company_id": company_id,
             "title": message_data.get("title", f"Campanha {datetime.utcnow().strftime('%d/%m/%Y %H:%M')}"),
             "message": message_data["message"],
             "recipients": message_data["recipients"],
@@ -907,6 +3682,7 @@ async def send_mass_message_extension(
         }
         
         await campaigns_collection.insert_one(campaign_record)
+        CAMPAIGN_SENDS.inc(campaign_record["total_recipients"])
         
         # Here you would integrate with actual WhatsApp sending logic
         # For now, we'll return success
@@ -926,23 +3702,26 @@ async def send_mass_message_extension(
 @app.get("/api/chrome-extension/analytics")
 async def get_extension_analytics(
     company_id: str = None,
-    db=Depends(get_database), 
-    user=Depends(get_current_user)
+    db=Depends(get_tenant_database), 
+    user=Depends(get_current_user),
+    user_company_id: str = Depends(get_current_company)
 ):
     """Get analytics data for Chrome Extension dashboard"""
+    if company_id and company_id != user_company_id:
+        raise HTTPException(status_code=403, detail="Analytics of another company are not accessible")
+    company_id = user_company_id
     try:
         # Get contacts count
-        contacts_collection = db.contacts
-        total_contacts = await contacts_collection.count_documents({})
+        contacts_collection = collection_for(db, "contacts", "analytics")
+        total_contacts = await contacts_collection.count_documents({"company_id": company_id})
         
         # Get deals count
-        deals_collection = db.deals
-        total_deals = await deals_collection.count_documents({})
-        active_deals = await deals_collection.count_documents({"stage": {"$nin": ["closed", "lost"]}})
+        deals_collection = collection_for(db, "deals", "analytics")
+        total_deals = await deals_collection.count_documents({"company_id": company_id})
+        active_deals = await deals_collection.count_documents({"company_id": company_id, "stage": {"$nin": ["closed", "lost"]}})
         
         # Get conversations count
-        conversations_collection = db.conversations
-        total_conversations = await conversations_collection.count_documents({})
+        total_conversations = await count_conversation_messages(db, company_id, "analytics")
         
         # Calculate conversion rate
         conversion_rate = round((active_deals / total_contacts * 100) if total_contacts > 0 else 0, 1)
@@ -950,6 +3729,7 @@ async def get_extension_analytics(
         # Get recent activity (last 7 days)
         seven_days_ago = (datetime.utcnow() - timedelta(days=7)).isoformat()
         recent_contacts = await contacts_collection.count_documents({
+            "company_id": company_id,
             "created_at": {"$gte": seven_days_ago}
         })
         
@@ -963,12 +3743,12 @@ async def get_extension_analytics(
                 "recent_contacts": recent_contacts
             },
             "kanban_data": {
-                "lead": await deals_collection.count_documents({"stage": "lead"}),
-                "contact": await deals_collection.count_documents({"stage": "contact"}),
-                "proposal": await deals_collection.count_documents({"stage": "proposal"}),
-                "negotiation": await deals_collection.count_documents({"stage": "negotiation"}),
-                "closed": await deals_collection.count_documents({"stage": "closed"}),
-                "lost": await deals_collection.count_documents({"stage": "lost"})
+                "lead": await deals_collection.count_documents({"company_id": company_id, "stage": "lead"}),
+                "contact": await deals_collection.count_documents({"company_id": company_id, "stage": "contact"}),
+                "proposal": await deals_collection.count_documents({"company_id": company_id, "stage": "proposal"}),
+                "negotiation": await deals_collection.count_documents({"company_id": company_id, "stage": "negotiation"}),
+                "closed": await deals_collection.count_documents({"company_id": company_id, "stage": "closed"}),
+                "lost": await deals_collection.count_documents({"company_id": company_id, "stage": "lost"})
             }
         }
         
@@ -993,13 +3773,15 @@ async def send_whatsapp_message(
     phone_number: str,
     message: str,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     """Send WhatsApp message (Mock for MVP)"""
     try:
         # For MVP, just store the message as sent
         conversation_data = {
             "id": str(uuid.uuid4()),
+            "company_id": company_id,
             "contact_phone": phone_number,
             "message": message,
             "direction": "outgoing",
@@ -1008,7 +3790,7 @@ async def send_whatsapp_message(
             "mock_sent": True
         }
         
-        await db.conversations.insert_one(conversation_data)
+        await store_conversation(db, conversation_data)
         
         return {
             "success": True,
@@ -1023,8 +3805,8 @@ async def send_whatsapp_message(
 
 # Contacts Routes
 @app.get("/api/contacts")
-async def get_contacts(current_user: str = Depends(get_current_user), db=Depends(get_database)):
-    contacts = await db.contacts.find().to_list(length=100)
+async def get_contacts(current_user: str = Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
+    contacts = await db.contacts.find({"company_id": company_id}).to_list(length=100)
     # Fix phone field inconsistency
     for contact in contacts:
         if 'phone' in contact and 'phone_number' not in contact:
@@ -1034,9 +3816,10 @@ async def get_contacts(current_user: str = Depends(get_current_user), db=Depends
     return convert_mongo_document(contacts)
 
 @app.post("/api/contacts")
-async def create_contact(contact: ContactCreate, current_user: str = Depends(get_current_user), db=Depends(get_database)):
+async def create_contact(contact: ContactCreate, current_user: str = Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     contact_data = {
         "id": str(uuid.uuid4()),
+        "company_id": company_id,
         "name": contact.name,
         "phone_number": contact.phone,
         "email": contact.email,
@@ -1051,19 +3834,26 @@ async def create_contact(contact: ContactCreate, current_user: str = Depends(get
     return convert_mongo_document(contact_data)
 
 @app.get("/api/conversations/{phone_number}")
-async def get_conversations(phone_number: str, current_user: str = Depends(get_current_user), db=Depends(get_database)):
-    conversations = await db.conversations.find(
-        {"contact_phone": phone_number}
-    ).sort("timestamp", 1).to_list(length=100)
+async def get_conversations(
+    phone_number: str,
+    before: Optional[str] = None,
+    limit: int = 100,
+    current_user: str = Depends(get_current_user),
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
+):
+    """Latest messages of a contact; pass the oldest timestamp received as `before` to page back (into the archive)"""
+    limit = max(1, min(limit, 500))
+    conversations = await load_conversation(db, company_id, phone_number, limit, before)
     return convert_mongo_document(conversations)
 
 @app.get("/api/dashboard/stats")
-async def get_dashboard_stats(current_user: str = Depends(get_current_user), db=Depends(get_database)):
-    contacts_count = await db.contacts.count_documents({})
-    conversations_count = await db.conversations.count_documents({})
-    today_messages = await db.conversations.count_documents({
-        "timestamp": {"$gte": datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)}
-    })
+async def get_dashboard_stats(current_user: str = Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
+    contacts_count = await collection_for(db, "contacts", "dashboard").count_documents({"company_id": company_id})
+    conversations_count = await count_conversation_messages(db, company_id, "dashboard")
+    today_messages = await count_conversation_messages(
+        db, company_id, "dashboard", since=datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    )
     
     return {
         "total_contacts": contacts_count,
@@ -1072,12 +3862,37 @@ async def get_dashboard_stats(current_user: str = Depends(get_current_user), db=
         "whatsapp_connected": True  # Will be dynamic when WhatsApp service is integrated
     }
 
+@app.get("/api/metrics/pipeline")
+async def get_pipeline_timings(current_user: str = Depends(get_current_user)):
+    """Percentile breakdown (ms) of the inbound message pipeline stages over the sliding window"""
+    return {
+        "window_seconds": pipeline_timings.window_seconds,
+        "stages": pipeline_timings.percentiles()
+    }
+
+@app.post("/api/admin/drain")
+async def start_drain(user=Depends(get_admin_user)):
+    """Start draining ahead of a shutdown (e.g. from a preStop hook): reject new inbound messages and fail readiness"""
+    global draining
+    draining = True
+    return {"draining": True, "in_flight": inflight_work.snapshot(), "pending_tasks": len(pending_tasks)}
+
+@app.get("/api/admin/slow-queries")
+async def get_slow_queries(limit: int = 100, current_user: str = Depends(get_admin_user)):
+    """Recent Mongo commands over the slow-query threshold and totals per query shape"""
+    return slow_query_log.report(max(1, min(limit, 1000)))
+
+@app.delete("/api/admin/slow-queries")
+async def reset_slow_queries(current_user: str = Depends(get_admin_user)):
+    slow_query_log.reset()
+    return {"success": True}
+
 # Assistants Management Routes
 @app.get("/api/assistants")
-async def get_assistants(current_user: str = Depends(get_current_user), db=Depends(get_database)):
+async def get_assistants(current_user: str = Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
     """Get all AI assistants with department info"""
     assistants = []
-    departments = await db.departments.find().to_list(length=100)
+    departments = await db.departments.find({"company_id": company_id}).to_list(length=100)
     
     for dept in departments:
         assistant_data = {
@@ -1108,7 +3923,8 @@ async def update_assistant(
     enabled: Optional[bool] = None,
     phone_number: Optional[str] = None,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     """Update AI assistant information"""
     update_data = {}
@@ -1129,7 +3945,7 @@ async def update_assistant(
     if update_data:
         update_data["updated_at"] = datetime.utcnow().isoformat()
         result = await db.departments.update_one(
-            {"id": assistant_id},
+            {"company_id": company_id, "id": assistant_id},
             {"$set": update_data}
         )
         
@@ -1142,16 +3958,18 @@ async def update_assistant(
 async def duplicate_assistant(
     assistant_id: str,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     """Duplicate an existing assistant"""
-    original = await db.departments.find_one({"id": assistant_id})
+    original = await db.departments.find_one({"company_id": company_id, "id": assistant_id})
     if not original:
         raise HTTPException(status_code=404, detail="Assistant not found")
     
     # Create duplicate with modified name
     duplicate_data = {
         "id": str(uuid.uuid4()),
+        "company_id": company_id,
         "name": f"{original['name']} - Cópia",
         "assistant_name": f"{original.get('assistant_name', original['name'])} - Cópia",
         "description": original["description"],
@@ -1166,24 +3984,26 @@ async def duplicate_assistant(
     await db.departments.insert_one(duplicate_data)
     return convert_mongo_document(duplicate_data)
 @app.get("/api/departments")
-async def get_departments(current_user: str = Depends(get_current_user), db=Depends(get_database)):
-    departments = await db.departments.find().to_list(length=100)
+async def get_departments(current_user: str = Depends(get_current_user), db=Depends(get_tenant_database), company_id: str = Depends(get_current_company)):
+    departments = await db.departments.find({"company_id": company_id}).to_list(length=100)
     return convert_mongo_document(departments)
 
 @app.post("/api/departments")
 async def create_department(
     department: DepartmentCreate,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     # Check if WhatsApp number is unique (if provided)
     if department.whatsapp_number:
-        existing_dept = await db.departments.find_one({"whatsapp_number": department.whatsapp_number})
+        existing_dept = await db.departments.find_one({"company_id": company_id, "whatsapp_number": department.whatsapp_number})
         if existing_dept:
             raise HTTPException(status_code=400, detail="WhatsApp number already in use")
 
     department_data = {
         "id": str(uuid.uuid4()),
+        "company_id": company_id,
         "name": department.name,
         "description": department.description,
         "signature": department.signature,
@@ -1209,12 +4029,14 @@ async def update_department(
     integration_mode: Optional[str] = None,
     active: Optional[bool] = None,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     """Update department information including signature, avatar and manual instructions"""
     # Check if WhatsApp number is unique (if provided and different from current)
     if whatsapp_number is not None:
         existing_dept = await db.departments.find_one({
+            "company_id": company_id,
             "whatsapp_number": whatsapp_number,
             "id": {"$ne": department_id}
         })
@@ -1242,7 +4064,7 @@ async def update_department(
     if update_data:
         update_data["updated_at"] = datetime.utcnow().isoformat()
         result = await db.departments.update_one(
-            {"id": department_id},
+            {"company_id": company_id, "id": department_id},
             {"$set": update_data}
         )
         
@@ -1252,20 +4074,113 @@ async def update_department(
     return {"success": True, "updated_fields": list(update_data.keys())}
 
 @app.get("/api/transfers")
-async def get_transfers(current_user: str = Depends(get_current_user), db=Depends(get_database)):
-    transfers = await db.transfers.find().sort("created_at", -1).to_list(length=100)
+async def get_transfers(
+    to_department: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 100,
+    current_user: str = Depends(get_current_user),
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
+):
+    query = {"company_id": company_id}
+    if to_department:
+        query["to_department"] = to_department
+    if status:
+        query["status"] = status
+    limit = max(1, min(limit, 500))
+    transfers = await db.transfers.find(query).sort("created_at", -1).to_list(length=limit)
     return convert_mongo_document(transfers)
 
+# created_at of a transfer as a date: ISO strings are parsed, BSON dates from older
+# records are kept, anything else becomes null instead of failing the whole update
+TRANSFER_CREATED_AT_DATE = {"$convert": {"input": "$created_at", "to": "date", "onError": None, "onNull": None}}
+
+@app.post("/api/transfers/claim")
+async def claim_transfer(
+    department_id: str,
+    current_user: str = Depends(get_current_user),
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
+):
+    """Atomically assign the oldest pending transfer of a department to the current agent"""
+    now = datetime.utcnow()
+    transfer = await db.transfers.find_one_and_update(
+        {"company_id": company_id, "to_department": department_id, "status": "pending"},
+        [{"$set": {
+            "status": "accepted",
+            "handled_by": current_user,
+            "claimed_at": now.isoformat(),
+            "wait_seconds": {"$divide": [{"$subtract": [now, TRANSFER_CREATED_AT_DATE]}, 1000]}
+        }}],
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if not transfer:
+        raise HTTPException(status_code=404, detail="No pending transfers for this department")
+    
+    return convert_mongo_document(transfer)
+
+@app.get("/api/transfers/metrics")
+async def get_transfer_metrics(
+    window_hours: int = 24,
+    current_user: str = Depends(get_current_user),
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
+):
+    """Queue depth and wait times per department"""
+    now = datetime.utcnow()
+    since = (now - timedelta(hours=window_hours)).isoformat()
+    pipeline = [
+        {"$match": {"company_id": company_id, "$or": [{"status": "pending"}, {"claimed_at": {"$gte": since}}]}},
+        {"$group": {
+            "_id": "$to_department",
+            "queue_depth": {"$sum": {"$cond": [{"$eq": ["$status", "pending"]}, 1, 0]}},
+            "oldest_pending_at": {"$min": {"$cond": [{"$eq": ["$status", "pending"]}, TRANSFER_CREATED_AT_DATE, None]}},
+            "claimed": {"$sum": {"$cond": [{"$gte": ["$claimed_at", since]}, 1, 0]}},
+            "avg_wait_seconds": {"$avg": "$wait_seconds"},
+            "max_wait_seconds": {"$max": "$wait_seconds"}
+        }}
+    ]
+    groups = await collection_for(db, "transfers", "analytics").aggregate(pipeline).to_list(length=None)
+    
+    department_ids = [group["_id"] for group in groups]
+    departments = await db.departments.find(
+        {"company_id": company_id, "id": {"$in": department_ids}},
+        {"_id": 0, "id": 1, "name": 1}
+    ).to_list(length=None)
+    department_names = {department["id"]: department["name"] for department in departments}
+    
+    metrics = []
+    for group in groups:
+        oldest_wait = None
+        if group["oldest_pending_at"]:
+            oldest_wait = round((now - group["oldest_pending_at"]).total_seconds(), 1)
+        metrics.append({
+            "department_id": group["_id"],
+            "department_name": department_names.get(group["_id"]),
+            "queue_depth": group["queue_depth"],
+            "oldest_pending_wait_seconds": oldest_wait,
+            "claimed_last_window": group["claimed"],
+            "avg_wait_seconds": round(group["avg_wait_seconds"], 1) if group["avg_wait_seconds"] is not None else None,
+            "max_wait_seconds": round(group["max_wait_seconds"], 1) if group["max_wait_seconds"] is not None else None
+        })
+    
+    metrics.sort(key=lambda item: item["queue_depth"], reverse=True)
+    return {"window_hours": window_hours, "departments": metrics}
+
 @app.post("/api/transfers")
 async def create_transfer(
     contact_phone: str,
     department_id: str,
     message: str,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     transfer_data = {
         "id": str(uuid.uuid4()),
+        "company_id": company_id,
         "from_contact": contact_phone,
         "to_department": department_id,
         "message": message,
@@ -1283,7 +4198,8 @@ async def update_transfer(
     status: str,
     notes: Optional[str] = None,
     current_user: str = Depends(get_current_user),
-    db=Depends(get_database)
+    db=Depends(get_tenant_database),
+    company_id: str = Depends(get_current_company)
 ):
     update_data = {
         "status": status,
@@ -1291,12 +4207,15 @@ async def update_transfer(
         "notes": notes
     }
     
+    # Only unassigned transfers or transfers already held by this agent can be updated
     result = await db.transfers.update_one(
-        {"id": transfer_id},
+        {"company_id": company_id, "id": transfer_id, "handled_by": {"$in": [None, current_user]}},
         {"$set": update_data}
     )
     
     if result.matched_count == 0:
+        if await db.transfers.count_documents({"company_id": company_id, "id": transfer_id}, limit=1):
+            raise HTTPException(status_code=409, detail="Transfer already handled by another agent")
         raise HTTPException(status_code=404, detail="Transfer not found")
     
     return {"success": True}
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+import sys
+import uuid
+import warnings
+
+import pytest
+import pytest_asyncio
+
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("FAKE_LLM_CONFIG", json.dumps({"*": {"latency_ms": {"distribution": "fixed", "value": 1}}}))
+for limit in ("RATE_LIMIT_PHONE_PER_MINUTE", "RATE_LIMIT_IP_PER_MINUTE", "RATE_LIMIT_DEPARTMENT_PER_MINUTE"):
+    os.environ.setdefault(limit, "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+warnings.filterwarnings("ignore")
+
+import server  # noqa: E402
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest_asyncio.fixture
+async def db(monkeypatch):
+    """A fresh mongomock database with the schema applied, used as the shared database"""
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "database", client["empresas_web_test"])
+    monkeypatch.setattr(server, "recent_messages", server.RecentMessageCache(1000))
+    monkeypatch.setattr(server, "reply_futures", {})
+    await server.warm_up(server.database)
+    yield server.database
+    # Background work a test started (summary refreshes, router training) ends with it
+    await asyncio.gather(*server.pending_tasks, return_exceptions=True)
+
+
+@pytest_asyncio.fixture
+async def http(db):
+    """An HTTP client bound to the app, without running its lifespan"""
+    import httpx
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+@pytest_asyncio.fixture
+async def mongo():
+    """A throwaway database on the MongoDB server at MONGO_TEST_URL, for queries mongomock cannot run"""
+    url = os.environ.get("MONGO_TEST_URL")
+    if not url:
+        pytest.skip("MONGO_TEST_URL is not set")
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(url, serverSelectionTimeoutMS=2000)
+    name = f"empresas_web_test_{uuid.uuid4().hex[:8]}"
+    yield client[name]
+    await client.drop_database(name)
+    client.close()
@@ -0,0 +1,18 @@
+"""Synthetic PyMongo command monitoring events for the command listeners"""
+from datetime import timedelta
+
+from pymongo import monitoring
+
+CONNECTION = ("localhost", 27017)
+
+
+def started(request_id, command, database="empresas_web_test"):
+    return monitoring.CommandStartedEvent(command, database, request_id, CONNECTION, request_id)
+
+
+def succeeded(request_id, command_name, milliseconds):
+    return monitoring.CommandSucceededEvent(timedelta(milliseconds=milliseconds), {"ok": 1}, command_name, request_id, CONNECTION, request_id)
+
+
+def failed(request_id, command_name, milliseconds):
+    return monitoring.CommandFailedEvent(timedelta(milliseconds=milliseconds), {"ok": 0}, command_name, request_id, CONNECTION, request_id)
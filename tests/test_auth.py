@@ -0,0 +1,144 @@
+import jwt
+import pytest
+
+import server
+
+
+@pytest.fixture
+def token_cache(monkeypatch):
+    cache = server.TokenCache(2)
+    monkeypatch.setattr(server, "token_cache", cache)
+    return cache
+
+
+def test_cache_evicts_the_least_recently_used_token():
+    cache = server.TokenCache(2)
+    cache.put("a", ("u1", "default"), exp=200)
+    cache.put("b", ("u2", "default"), exp=200)
+    assert cache.get("a", now=100) == ("u1", "default")
+
+    cache.put("c", ("u3", "default"), exp=200)
+
+    assert cache.get("b", now=100) is None
+    assert cache.get("a", now=100) == ("u1", "default") and cache.get("c", now=100) == ("u3", "default")
+
+
+def test_cached_token_is_dropped_once_expired():
+    cache = server.TokenCache(2)
+    cache.put("a", ("u1", "default"), exp=200)
+    assert cache.get("a", now=200) is None
+    # Gone for good, even for a caller with an earlier clock
+    assert cache.get("a", now=100) is None
+
+
+def test_revocation_removes_the_cached_token_and_forgets_expired_revocations():
+    cache = server.TokenCache(2)
+    cache.put("a", ("u1", "default"), exp=4102444800)
+    cache.revoke("old", exp=1)
+    cache.revoke("a", exp=4102444800)
+
+    assert cache.is_revoked("a") and cache.get("a", now=100) is None
+    assert not cache.is_revoked("old")
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.mark.asyncio
+async def test_verified_token_is_served_from_the_cache(db, http, token_cache, monkeypatch):
+    token = server.create_token("u1", "acme")
+    assert (await http.get("/api/auth/verify", headers=auth(token))).json()["company_id"] == "acme"
+
+    # A cached token is not decoded again
+    monkeypatch.setattr(server, "decode_token", lambda token: pytest.fail("token decoded again"))
+    response = await http.get("/api/auth/verify", headers=auth(token))
+    assert response.json() == {"valid": True, "user_id": "u1", "company_id": "acme"}
+
+
+@pytest.mark.asyncio
+async def test_logout_revokes_the_token_on_every_worker(db, http, token_cache, monkeypatch):
+    token = server.create_token("u1")
+    other = server.create_token("u2")
+    assert (await http.get("/api/auth/verify", headers=auth(token))).status_code == 200
+
+    assert (await http.post("/api/auth/logout", headers=auth(token))).json() == {"success": True}
+
+    assert (await http.get("/api/auth/verify", headers=auth(token))).status_code == 401
+    assert (await http.get("/api/auth/verify", headers=auth(other))).status_code == 200
+    assert await db.revoked_tokens.count_documents({"token_hash": server.hash_token(token)}) == 1
+
+    # A worker started later loads the revocation from the database
+    monkeypatch.setattr(server, "token_cache", server.TokenCache(2))
+    await server.load_revoked_tokens(db)
+    assert (await http.get("/api/auth/verify", headers=auth(token))).status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_invalid_tokens_are_rejected(db, http, token_cache):
+    assert (await http.get("/api/auth/verify", headers=auth("not-a-token"))).status_code == 401
+    assert (await http.get("/api/auth/verify", headers=auth(server.create_token("")))).status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_token_without_expiry_is_rejected(db, http, token_cache):
+    token = jwt.encode({"user_id": "u1", "company_id": "acme"}, server.SECRET_KEY, algorithm="HS256")
+
+    assert (await http.get("/api/auth/verify", headers=auth(token))).status_code == 401
+    # Logging out with it is not an error either, and nothing is stored
+    assert (await http.post("/api/auth/logout", headers=auth(token))).status_code == 401
+    await server.revoke_token(token, db)
+    assert await db.revoked_tokens.count_documents({}) == 0
+
+
+@pytest.fixture
+def users(db):
+    """Insert a user with the given password fields"""
+    async def insert(**password_fields):
+        await db.users.insert_one({"id": "u1", "username": "ana", "name": "Ana", **password_fields})
+        return db.users
+    return insert
+
+
+async def login(http, password):
+    return await http.post("/api/auth/login", json={"username": "ana", "password": password})
+
+
+@pytest.mark.asyncio
+async def test_plaintext_password_is_hashed_on_login(http, users):
+    collection = await users(password="segredo")
+
+    response = await login(http, "segredo")
+
+    assert response.status_code == 200 and response.json()["user"]["role"] == "user"
+    stored = await collection.find_one({"id": "u1"})
+    assert "password" not in stored and server.pwd_context.verify("segredo", stored["password_hash"])
+    assert (await login(http, "segredo")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_hash_with_too_few_rounds_is_upgraded_on_login(http, users):
+    weak = server.pwd_context.handler("pbkdf2_sha256").using(rounds=1000).hash("segredo")
+    collection = await users(password_hash=weak)
+
+    assert (await login(http, "segredo")).status_code == 200
+
+    stored = (await collection.find_one({"id": "u1"}))["password_hash"]
+    assert stored != weak and stored.startswith(f"$pbkdf2-sha256${server.PASSWORD_HASH_ROUNDS}$")
+
+
+@pytest.mark.asyncio
+async def test_current_hash_and_wrong_password_are_left_alone(http, users):
+    current = server.pwd_context.hash("segredo")
+    collection = await users(password_hash=current)
+
+    assert (await login(http, "errada")).status_code == 401
+    assert (await login(http, "segredo")).status_code == 200
+    assert (await collection.find_one({"id": "u1"}))["password_hash"] == current
+
+
+@pytest.mark.asyncio
+async def test_wrong_password_does_not_replace_plaintext(http, users):
+    collection = await users(password="segredo")
+    assert (await login(http, "errada")).status_code == 401
+    assert (await collection.find_one({"id": "u1"}))["password"] == "segredo"
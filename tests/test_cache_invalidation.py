@@ -0,0 +1,26 @@
+import pytest
+
+import server
+
+
+@pytest.mark.asyncio
+async def test_refreshed_summary_is_dropped_by_the_other_workers(db, monkeypatch):
+    monkeypatch.setattr(server, "MULTI_WORKER", True)
+    monkeypatch.setattr(server, "summary_cache", server.ConversationSummaryCache(10))
+
+    async def summarize(previous_summary, records):
+        return "novo resumo"
+
+    monkeypatch.setattr(server, "summarize_conversation", summarize)
+    key = (server.DEFAULT_COMPANY_ID, "5511999990000")
+    records = [{"direction": "incoming", "message": "Oi", "timestamp": "2024-05-01T10:00:00"}]
+
+    await server.refresh_conversation_summary(db, *key, None, records)
+
+    event = await db.cache_invalidations.find_one({"cache": "conversation_summaries"})
+    assert event["origin"] == server.WORKER_ID
+    # Another worker still holding the old summary applies the event
+    server.summary_cache.put(key, {"summary": "antigo", "covered_until": ""})
+    server.CACHE_INVALIDATION_HANDLERS[event["cache"]](event["key"], event["data"])
+    assert server.summary_cache.get(key) is None
+    assert (await server.get_conversation_summary(db, *key))["summary"] == "novo resumo"
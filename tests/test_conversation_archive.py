@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+PHONE = "5511999990000"
+
+
+def record(n, timestamp, **fields):
+    return {
+        "id": f"r{n}", "company_id": server.DEFAULT_COMPANY_ID, "contact_phone": PHONE,
+        "message": f"mensagem {n}", "direction": "incoming", "timestamp": timestamp, **fields
+    }
+
+
+def test_archive_round_trip_restores_the_contact_fields():
+    records = [record(1, "2024-01-05T10:00:00", message_id="wamid.1"), record(2, "2024-01-06T10:00:00")]
+    codec, payload = server.compress_archive([server.archive_record(entry) for entry in records])
+    archive = {"company_id": server.DEFAULT_COMPANY_ID, "contact_phone": PHONE, "codec": codec, "data": payload}
+
+    restored = server.decompress_archive(archive)
+
+    assert codec in ("zstd", "zlib")
+    assert restored == records
+
+
+async def store_history(db):
+    """Three months of history: January and February are past the cutoff, March stays hot"""
+    await db.conversations.insert_many([
+        record(1, "2024-01-10T09:00:00"), record(2, "2024-01-20T09:00:00"),
+        record(3, "2024-02-03T09:00:00"), record(4, "2024-02-04T09:00:00"),
+        record(5, "2024-03-01T09:00:00"), record(6, "2024-03-02T09:00:00"),
+        {**record(7, "2024-01-11T09:00:00"), "contact_phone": "5511888880000"}
+    ])
+
+
+@pytest.mark.asyncio
+async def test_old_records_move_to_one_archive_per_contact_month(db):
+    await store_history(db)
+
+    moved = await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1))
+
+    assert moved == 5
+    assert sorted(record["id"] for record in await db.conversations.find().to_list(length=None)) == ["r5", "r6"]
+    archives = await db.conversation_archives.find({"contact_phone": PHONE}).sort("month", 1).to_list(length=None)
+    assert [(archive["month"], archive["count"]) for archive in archives] == [("2024-01", 2), ("2024-02", 2)]
+    assert archives[0]["first_timestamp"] == "2024-01-10T09:00:00" and archives[0]["last_timestamp"] == "2024-01-20T09:00:00"
+    assert [entry["id"] for entry in server.decompress_archive(archives[1])] == ["r3", "r4"]
+    assert await server.count_conversation_messages(db, server.DEFAULT_COMPANY_ID, "analytics") == 7
+    # Nothing is left to move
+    assert await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1)) == 0
+
+
+@pytest.mark.asyncio
+async def test_archiving_again_after_a_crash_does_not_duplicate_records(db):
+    await store_history(db)
+    await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1))
+    # As if the previous run stopped between writing the archive and deleting the hot record
+    await db.conversations.insert_one(record(3, "2024-02-03T09:00:00"))
+
+    assert await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1)) == 1
+
+    february = await db.conversation_archives.find_one({"contact_phone": PHONE, "month": "2024-02"})
+    assert february["count"] == 2
+    assert [entry["id"] for entry in server.decompress_archive(february)] == ["r3", "r4"]
+
+
+@pytest.mark.asyncio
+async def test_pages_continue_from_the_hot_collection_into_the_archive(db):
+    await store_history(db)
+    await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1))
+
+    def ids(records):
+        return [record["id"] for record in records]
+
+    latest = await server.load_conversation(db, server.DEFAULT_COMPANY_ID, PHONE, limit=3)
+    older = await server.load_conversation(db, server.DEFAULT_COMPANY_ID, PHONE, limit=3, before=latest[0]["timestamp"])
+    oldest = await server.load_conversation(db, server.DEFAULT_COMPANY_ID, PHONE, limit=3, before=older[0]["timestamp"])
+
+    assert ids(latest) == ["r4", "r5", "r6"]
+    assert ids(older) == ["r1", "r2", "r3"]
+    assert ids(oldest) == []
+    assert older[0]["contact_phone"] == PHONE and older[0]["company_id"] == server.DEFAULT_COMPANY_ID
+
+
+@pytest.mark.asyncio
+async def test_bucket_days_are_archived_too(db, monkeypatch):
+    monkeypatch.setattr(server, "CONVERSATION_STORAGE", "buckets")
+    for n, timestamp in enumerate(["2024-02-28T09:00:00", "2024-02-28T10:00:00", "2024-03-01T09:00:00"]):
+        await server.store_conversation(db, record(n, timestamp))
+
+    assert await server.archive_conversation_batch(db, server.DEFAULT_COMPANY_ID, datetime(2024, 3, 1)) == 1
+
+    assert [bucket["day"] for bucket in await db.conversation_buckets.find().to_list(length=None)] == ["2024-03-01"]
+    history = await server.load_conversation(db, server.DEFAULT_COMPANY_ID, PHONE, limit=10)
+    assert [entry["id"] for entry in history] == ["r0", "r1", "r2"]
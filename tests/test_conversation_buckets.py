@@ -0,0 +1,87 @@
+import argparse
+
+import mongomock
+import pytest
+
+import migrate_conversations
+import server
+
+
+def record(n, day="2024-05-01", message_id=None, phone="5511999990000"):
+    return {
+        "id": f"r{n}", "company_id": server.DEFAULT_COMPANY_ID, "contact_phone": phone, "message_id": message_id,
+        "message": f"mensagem {n}", "direction": "incoming", "timestamp": f"{day}T10:00:{n:02d}"
+    }
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    monkeypatch.setattr(server, "CONVERSATION_STORAGE", "buckets")
+    monkeypatch.setattr(server, "CONVERSATION_BUCKET_MAX_MESSAGES", 2)
+
+
+def test_bucket_append_targets_the_open_bucket_of_the_day(buckets):
+    query, update = server.bucket_append(record(1, message_id="wamid.1"))
+    assert query == {
+        "company_id": server.DEFAULT_COMPANY_ID, "contact_phone": "5511999990000", "day": "2024-05-01",
+        "migrated": {"$ne": True}, "count": {"$lt": 2}, "message_ids": {"$ne": "wamid.1"}
+    }
+    assert update["$push"]["message_ids"] == "wamid.1"
+    assert "company_id" not in update["$push"]["messages"] and update["$inc"] == {"count": 1}
+    # Outgoing replies have no message_id and are not indexed
+    assert "message_ids" not in server.bucket_append(record(2))[0]
+
+
+@pytest.mark.asyncio
+async def test_full_bucket_rolls_over_to_a_new_one(db, buckets):
+    for n in range(5):
+        await server.store_conversation(db, record(n, message_id=f"wamid.{n}" if n % 2 else None))
+    await server.store_conversation(db, record(9, day="2024-05-02"))
+
+    stored = await db.conversation_buckets.find({}, {"_id": 0}).sort([("day", 1), ("count", -1)]).to_list(length=None)
+    assert [(bucket["day"], bucket["count"]) for bucket in stored] == [
+        ("2024-05-01", 2), ("2024-05-01", 2), ("2024-05-01", 1), ("2024-05-02", 1)
+    ]
+    assert sorted(id for bucket in stored for id in bucket.get("message_ids", [])) == ["wamid.1", "wamid.3"]
+
+    history = await server.load_conversation(db, server.DEFAULT_COMPANY_ID, "5511999990000", limit=4)
+    assert [entry["id"] for entry in history] == ["r2", "r3", "r4", "r9"]
+    assert history[0]["company_id"] == server.DEFAULT_COMPANY_ID
+
+
+def migrated_buckets(db):
+    return list(db.conversation_buckets.find({"migrated": True}, {"_id": 0}).sort([("day", 1), ("seq", 1)]))
+
+
+def test_migration_can_run_again_without_duplicating_messages(buckets):
+    db = mongomock.MongoClient()["empresas_web_test"]
+    db.conversations.insert_many([record(n, message_id=f"wamid.{n}") for n in range(3)] + [record(3, day="2024-05-02")])
+    copy = argparse.Namespace(dry_run=False, delete_source=False)
+
+    first = migrate_conversations.migrate_database(db, copy)
+    after_first = migrated_buckets(db)
+    again = migrate_conversations.migrate_database(db, copy)
+
+    assert (first["records"], first["days"], first["buckets"]) == (4, 2, 3)
+    assert again["buckets"] == first["buckets"]
+    assert migrated_buckets(db) == after_first
+    assert [(bucket["day"], bucket["seq"], bucket["count"]) for bucket in after_first] == [
+        ("2024-05-01", 0, 2), ("2024-05-01", 1, 1), ("2024-05-02", 0, 1)
+    ]
+    assert after_first[0]["message_ids"] == ["wamid.0", "wamid.1"]
+    assert "message_ids" not in after_first[2]
+
+    # Records written between the copy and the switch are merged in, then the source is deleted
+    db.conversations.insert_one(record(4, message_id="wamid.4"))
+    migrate_conversations.migrate_database(db, argparse.Namespace(dry_run=False, delete_source=True))
+    messages = [message["id"] for bucket in migrated_buckets(db) for message in bucket["messages"]]
+    assert messages == ["r0", "r1", "r2", "r4", "r3"]
+    assert db.conversations.count_documents({}) == 0
+
+
+def test_migration_dry_run_writes_nothing(buckets):
+    db = mongomock.MongoClient()["empresas_web_test"]
+    db.conversations.insert_many([record(n) for n in range(3)])
+    report = migrate_conversations.migrate_database(db, argparse.Namespace(dry_run=True, delete_source=False))
+    assert (report["records"], report["buckets"]) == (3, 2)
+    assert db.conversation_buckets.count_documents({}) == 0
@@ -0,0 +1,86 @@
+import pytest
+
+import server
+
+
+def turn(text, direction="incoming", **fields):
+    return {"direction": direction, "message": text, **fields}
+
+
+def test_window_keeps_the_latest_turns_within_the_budget():
+    history = [turn("a" * 40), turn("b" * 40, "outgoing"), turn("c" * 40), turn("d" * 40, "outgoing")]
+    last_two = sum(server.estimate_tokens(server.format_turn(record)) for record in history[-2:])
+
+    assert server.select_context_window(history, last_two, 10) == history[-2:]
+    assert server.select_context_window(history, last_two - 1, 10) == history[-1:]
+    assert server.select_context_window(history, 10_000, 3) == history[-3:]
+
+
+def test_window_stops_at_a_turn_over_the_budget():
+    # A long turn ends the window even if older, shorter turns would still fit
+    history = [turn("curta"), turn("x" * 4000, "outgoing"), turn("última")]
+    assert server.select_context_window(history, 50, 10) == history[-1:]
+    assert server.select_context_window(history, 0, 10) == []
+
+
+def test_system_message_lists_summary_and_turns_in_order():
+    message = server.build_context_system_message("BASE", "cliente quer abrir MEI", [turn("Oi"), turn("Olá!", "outgoing")])
+    assert message == "BASE\n\nRESUMO DA CONVERSA ATÉ AGORA:\ncliente quer abrir MEI\n\nMENSAGENS RECENTES:\nCliente: Oi\nAssistente: Olá!"
+    assert server.build_context_system_message("BASE", None, []) == "BASE"
+
+
+class RecordingProvider(server.LlmProvider):
+    requires_api_key = False
+
+    def __init__(self):
+        self.prompts = []
+
+    async def complete(self, provider, model, system_message, session_id, text, api_key=None):
+        self.prompts.append((text, system_message))
+        return f"resposta para {text}"
+
+
+def whatsapp_message(message_id, text, timestamp):
+    return {"phone_number": "5511999990000", "message": text, "message_id": message_id, "timestamp": timestamp}
+
+
+def context_turns(system_message):
+    return system_message.split("MENSAGENS RECENTES:\n")[1].split("\n") if "MENSAGENS RECENTES:" in system_message else []
+
+
+@pytest.mark.asyncio
+async def test_batch_context_leaves_out_later_messages(db, http, monkeypatch):
+    provider = RecordingProvider()
+    monkeypatch.setattr(server, "llm_provider", provider)
+
+    await http.post("/api/whatsapp/messages/batch", json=[
+        whatsapp_message("wamid.2", "segunda mensagem", 2),
+        whatsapp_message("wamid.1", "primeira mensagem", 1),
+        whatsapp_message("wamid.3", "terceira mensagem", 3)
+    ])
+
+    prompts = {text: context_turns(system_message) for text, system_message in provider.prompts}
+    assert list(prompts) == ["primeira mensagem", "segunda mensagem", "terceira mensagem"]
+    # Neither the message being answered nor the ones sent after it; earlier replies are already stored
+    assert prompts["primeira mensagem"] == []
+    assert prompts["segunda mensagem"] == ["Cliente: primeira mensagem", "Assistente: resposta para primeira mensagem"]
+    assert prompts["terceira mensagem"] == [
+        "Cliente: primeira mensagem", "Cliente: segunda mensagem",
+        "Assistente: resposta para primeira mensagem", "Assistente: resposta para segunda mensagem"
+    ]
+
+    incoming = await db.conversations.find({"direction": "incoming"}).sort("timestamp", 1).to_list(length=None)
+    assert [record["message_id"] for record in incoming] == ["wamid.1", "wamid.2", "wamid.3"]
+    assert await db.conversations.count_documents({"direction": "outgoing"}) == 3
+
+
+@pytest.mark.asyncio
+async def test_repeated_text_stays_in_the_context(db, http, monkeypatch):
+    provider = RecordingProvider()
+    monkeypatch.setattr(server, "llm_provider", provider)
+
+    for n in range(2):
+        await http.post("/api/whatsapp/message", json=whatsapp_message(f"wamid.{n}", "oi", n))
+
+    # Only the stored record of the message being answered is left out, not an earlier one with the same text
+    assert context_turns(provider.prompts[1][1]) == ["Cliente: oi", "Assistente: resposta para oi"]
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("text, intent", [
+    ("Oi, bom dia!", "greeting"),
+    ("Olá pessoal, tudo bem?", "greeting"),
+    ("Muito obrigada pela ajuda", "thanks"),
+    ("vlw", "thanks"),
+    ("tá bom", "ack"),
+    ("Ok, entendi", "ack"),
+    ("Tchau, até amanhã", "goodbye"),
+    ("👍", "emoji"),
+    ("👍🏽🙏", "emoji"),
+    ("❤️", "emoji"),
+    ("🇧🇷", "emoji"),
+])
+def test_trivial_intents(text, intent):
+    assert server.IntentRouter.trivial_intent(text) == intent
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "?",
+    "???",
+    "...",
+    "привет",
+    "你好",
+    "مرحبا",
+    "👍?",
+    "Oi, quanto custa abrir um MEI?",
+    "bom dia, preciso da segunda via do boleto",
+])
+def test_messages_that_need_a_real_answer(text):
+    assert server.IntentRouter.trivial_intent(text) is None
+
+
+@pytest.mark.parametrize("text, slug", [
+    ("Quero abrir um MEI", "abertura-de-empresa"),
+    ("Preciso da segunda via do boleto", "financeiro"),
+    ("Como calculo as férias do funcionário?", "rh-e-folha"),
+    ("Não consigo emitir a NFSe", "emissao-de-notas-fiscais"),
+])
+def test_keywords_route_with_full_confidence(text, slug):
+    assert server.IntentRouter().classify(text) == (slug, 1.0)
+
+
+def test_conflicting_keywords_and_unknown_words_are_left_to_the_llm():
+    router = server.IntentRouter()
+    assert router.classify("boleto da nota fiscal") is None
+    assert router.classify("Здравствуйте, нужна помощь") is None
+    assert router.classify("?") is None
+
+
+def test_model_classifies_from_trained_vocabulary():
+    router = server.IntentRouter()
+    router.fit(
+        ["fluxo de caixa e contas a receber", "contas a pagar do mes", "regime do simples nacional", "simples nacional anexo"],
+        ["financeiro", "financeiro", "tributos-e-impostos", "tributos-e-impostos"]
+    )
+    slug, confidence = router.classify("dúvida sobre o fluxo de caixa")
+    assert slug == "financeiro" and 0.5 < confidence < 1.0
+    assert router.classify("你好") is None
+
+
+async def store_addressed_message(db, company_id, slug, text, message_id):
+    department = await db.departments.find_one({"company_id": company_id, "slug": slug})
+    message_data = server.WhatsAppMessage(
+        phone_number="5511999990000", message=text, message_id=message_id, timestamp=1,
+        department_id=department["id"], company_id=company_id
+    )
+    await server.store_conversation(db, server.build_incoming_conversation(message_data))
+
+
+@pytest.mark.asyncio
+async def test_each_company_trains_on_its_own_conversations(db, monkeypatch):
+    monkeypatch.setattr(server, "intent_routers", {})
+    await db.companies.insert_many([{"id": "acme", "name": "Acme"}, {"id": "globex", "name": "Globex"}])
+    await server.seed_new_companies(db)
+    for n in range(3):
+        await store_addressed_message(db, "acme", "financeiro", "quero renegociar a parcela atrasada", f"wamid.{n}")
+
+    await server.train_intent_router("acme")
+    await server.train_intent_router("globex")
+
+    acme, _ = server.intent_routers["acme"]
+    globex, _ = server.intent_routers["globex"]
+    assert "parcela" in acme.vocabulary and "parcela" not in globex.vocabulary
+    assert acme.classify("a parcela atrasada")[0] == "financeiro"
+
+
+@pytest.mark.asyncio
+async def test_routing_starts_training_and_uses_keywords_meanwhile(db, monkeypatch):
+    monkeypatch.setattr(server, "intent_routers", {})
+    assert server.company_intent_router("acme") is server.keyword_router
+    assert "acme" in server.intent_router_trainings
+    await asyncio.gather(*server.pending_tasks)
+    assert server.company_intent_router("acme") is server.intent_routers["acme"][0]
+    assert "acme" not in server.intent_router_trainings
+
+
+@pytest.mark.asyncio
+async def test_routed_department_is_not_written_back_to_the_message(db, monkeypatch):
+    monkeypatch.setattr(server, "INTENT_ROUTER_ENABLED", True)
+    used = {}
+
+    async def generate(message, phone_number, department_id=None, company_id=server.DEFAULT_COMPANY_ID, **kwargs):
+        used["department_id"] = department_id
+        return "resposta"
+
+    monkeypatch.setattr(server, "generate_ai_response", generate)
+    message_data = server.WhatsAppMessage(
+        phone_number="5511999990000", message="Quero abrir um MEI", message_id="wamid.1", timestamp=1
+    )
+    await server.generate_message_reply(message_data, db)
+
+    abertura = await db.departments.find_one({"company_id": server.DEFAULT_COMPANY_ID, "slug": "abertura-de-empresa"})
+    assert used["department_id"] == abertura["id"]
+    assert message_data.department_id is None
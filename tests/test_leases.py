@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    """Act as the worker with the given id"""
+    def become(worker_id):
+        monkeypatch.setattr(server, "WORKER_ID", worker_id)
+    return become
+
+
+@pytest.mark.asyncio
+async def test_lease_is_held_by_one_worker_until_it_expires(db, worker):
+    worker("a")
+    assert await server.acquire_lease(db, "job", 60)
+    worker("b")
+    assert not await server.acquire_lease(db, "job", 60)
+    # The holder renews its own lease
+    worker("a")
+    assert await server.acquire_lease(db, "job", 60)
+    assert (await db.leader_leases.find_one({"_id": "job"}))["holder"] == "a"
+
+    # "a" stopped renewing
+    await db.leader_leases.update_one({"_id": "job"}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+    worker("b")
+    assert await server.acquire_lease(db, "job", 60)
+    worker("a")
+    assert not await server.acquire_lease(db, "job", 60)
+
+    lease = await db.leader_leases.find_one({"_id": "job"})
+    assert lease["holder"] == "b" and lease["expires_at"] > datetime.utcnow() + timedelta(seconds=50)
+
+
+@pytest.mark.asyncio
+async def test_leases_are_independent_per_job(db, worker):
+    worker("a")
+    assert await server.acquire_lease(db, "first", 60)
+    worker("b")
+    assert await server.acquire_lease(db, "second", 60)
+
+
+@pytest.mark.asyncio
+async def test_only_the_holder_can_release_a_lease(db, worker):
+    worker("a")
+    await server.acquire_lease(db, "job", 60)
+    worker("b")
+    await server.release_lease(db, "job")
+    assert not await server.acquire_lease(db, "job", 60)
+
+    worker("a")
+    await server.release_lease(db, "job")
+    worker("b")
+    assert await server.acquire_lease(db, "job", 60)
+
+
+@pytest.mark.asyncio
+async def test_running_job_keeps_renewing_its_lease(db, worker, monkeypatch):
+    monkeypatch.setattr(server, "LEADER_LEASE_RENEW_SECONDS", 0.01)
+    worker("a")
+    renewals = []
+
+    async def job(db):
+        for _ in range(3):
+            await asyncio.sleep(0.03)
+            renewals.append((await db.leader_leases.find_one({"_id": "job"}))["renewed_at"])
+        return "done"
+
+    await server.acquire_lease(db, "job", 60)
+    await server.run_leased_job(db, "job", 60, job)
+
+    assert len(renewals) == 3 and renewals[0] < renewals[1] < renewals[2]
+
+
+@pytest.mark.asyncio
+async def test_job_stops_once_another_worker_holds_the_lease(db, worker, monkeypatch):
+    monkeypatch.setattr(server, "LEADER_LEASE_RENEW_SECONDS", 0.01)
+    worker("a")
+    progress = []
+
+    async def job(db):
+        while True:
+            progress.append(1)
+            await asyncio.sleep(0.01)
+
+    await server.acquire_lease(db, "job", 60)
+    # "a" stalled past its lease and "b" took it over
+    await db.leader_leases.update_one({"_id": "job"}, {"$set": {"holder": "b"}})
+    await asyncio.wait_for(server.run_leased_job(db, "job", 60, job), timeout=1)
+
+    steps = len(progress)
+    await asyncio.sleep(0.05)
+    assert steps and len(progress) == steps
+
+
+@pytest.mark.asyncio
+async def test_job_errors_reach_the_job_loop(db, worker):
+    worker("a")
+
+    async def job(db):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        await server.run_leased_job(db, "job", 60, job)
@@ -0,0 +1,46 @@
+import pytest
+
+import server
+
+INSTANT = {"*": {"latency_ms": {"distribution": "fixed", "value": 0}}}
+
+
+def test_provider_without_complete_cannot_be_created():
+    class Incomplete(server.LlmProvider):
+        requires_api_key = False
+
+    with pytest.raises(TypeError, match="complete"):
+        Incomplete()
+
+
+@pytest.mark.asyncio
+async def test_fake_provider_streams_the_completion_in_pieces():
+    provider = server.FakeLlmProvider({"*": {**INSTANT["*"], "response_chars": 40, "stream_chunk_chars": 16}})
+
+    pieces = [piece async for piece in provider.stream("gemini", "gemini-1.5-flash", "sistema", "s1", "Oi")]
+
+    assert [len(piece) for piece in pieces] == [16, 16, 8]
+    assert "".join(pieces).strip() == await provider.complete("gemini", "gemini-1.5-flash", "sistema", "s2", "Oi")
+    assert provider.usage["gemini-1.5-flash"]["calls"] == 2
+
+
+@pytest.mark.asyncio
+async def test_fake_provider_errors_are_seeded_and_per_model():
+    config = {**INSTANT, "gpt-4o-mini": {"error_rate": 0.5}}
+
+    async def outcomes(seed):
+        provider = server.FakeLlmProvider(config, seed=seed)
+        results = []
+        for _ in range(20):
+            try:
+                await provider.complete("openai", "gpt-4o-mini", "sistema", "s", "Oi")
+                results.append(True)
+            except RuntimeError:
+                results.append(False)
+        return results, provider
+
+    first, provider = await outcomes(7)
+    assert first == (await outcomes(7))[0]
+    assert 0 < first.count(False) < 20 and provider.usage["gpt-4o-mini"]["errors"] == first.count(False)
+    # Models without their own entry use the "*" defaults, which never fail
+    assert await provider.complete("gemini", "gemini-1.5-flash", "sistema", "s", "Oi")
@@ -0,0 +1,102 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+class SaturatedLimiter:
+    """LLM limiter with no slot for the given scopes"""
+
+    def __init__(self, *scopes):
+        self.scopes = scopes
+        self.asked = []
+
+    @asynccontextmanager
+    async def slot(self, provider):
+        self.asked.append(provider)
+        if "global" in self.scopes:
+            raise server.LlmOverloaded("global", "queue_full")
+        if provider in self.scopes:
+            raise server.LlmOverloaded(provider, "queue_timeout")
+        yield
+
+
+@pytest.mark.asyncio
+async def test_saturated_provider_falls_back_to_the_next_one(db, monkeypatch):
+    limiter = SaturatedLimiter("gemini")
+    monkeypatch.setattr(server, "llm_limiter", limiter)
+    reply = await server.generate_ai_response("Oi", "5511999990000")
+    assert reply and reply not in server.DEPARTMENT_FALLBACK_REPLIES.values()
+    assert limiter.asked == ["gemini", "openai"]
+
+
+@pytest.mark.asyncio
+async def test_request_is_shed_only_when_every_provider_is_saturated(db, monkeypatch):
+    limiter = SaturatedLimiter("gemini", "openai")
+    monkeypatch.setattr(server, "llm_limiter", limiter)
+    with pytest.raises(server.LlmOverloaded):
+        await server.generate_ai_response("Oi", "5511999990000")
+    # The second openai model is not queued for again
+    assert limiter.asked == ["gemini", "openai"]
+
+
+@pytest.mark.asyncio
+async def test_global_saturation_sheds_at_once(db, monkeypatch):
+    limiter = SaturatedLimiter("global")
+    monkeypatch.setattr(server, "llm_limiter", limiter)
+    with pytest.raises(server.LlmOverloaded):
+        await server.generate_ai_response("Oi", "5511999990000")
+    assert limiter.asked == ["gemini"]
+
+
+@pytest.fixture
+def pushed(monkeypatch):
+    sent = []
+
+    async def push(message_data, text, last):
+        sent.append((message_data.message_id, text, last))
+        return True
+
+    monkeypatch.setattr(server, "push_whatsapp_message", push)
+    return sent
+
+
+async def store_shed_message(db, message_id, age_seconds=0):
+    message_data = server.WhatsAppMessage(
+        phone_number="5511999990000", message="Como abro um MEI?", message_id=message_id, timestamp=1,
+        company_id=server.DEFAULT_COMPANY_ID
+    )
+    record = server.build_incoming_conversation(message_data)
+    record["timestamp"] = (datetime.utcnow() - timedelta(seconds=age_seconds)).isoformat()
+    await server.store_conversation(db, record)
+    await server.mark_ai_followup(db, message_data, "openai_queue_full")
+
+
+@pytest.mark.asyncio
+async def test_followup_job_answers_shed_messages(db, pushed):
+    await store_shed_message(db, "wamid.shed")
+    await store_shed_message(db, "wamid.stale", age_seconds=server.AI_FOLLOWUP_MAX_AGE_SECONDS + 60)
+
+    await server.answer_ai_followups(db)
+
+    assert [(message_id, last) for message_id, _, last in pushed] == [("wamid.shed", True)]
+    reply = await db.conversations.find_one({"reply_to": "wamid.shed"})
+    assert reply["ai_followup"] is True and reply["message"] == pushed[0][1]
+    shed = await db.conversations.find_one({"message_id": "wamid.shed"})
+    stale = await db.conversations.find_one({"message_id": "wamid.stale"})
+    assert (shed["ai_followup_pending"], shed["ai_followup_result"]) == (False, "answered")
+    assert (stale["ai_followup_pending"], stale["ai_followup_result"]) == (False, "expired")
+    assert await db.conversations.count_documents({"reply_to": "wamid.stale"}) == 0
+
+
+@pytest.mark.asyncio
+async def test_followup_stays_pending_while_the_llm_is_saturated(db, pushed, monkeypatch):
+    monkeypatch.setattr(server, "llm_limiter", SaturatedLimiter("global"))
+    await store_shed_message(db, "wamid.shed")
+
+    await server.answer_ai_followups(db)
+
+    assert pushed == []
+    assert (await db.conversations.find_one({"message_id": "wamid.shed"}))["ai_followup_pending"] is True
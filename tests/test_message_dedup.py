@@ -0,0 +1,145 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+def whatsapp_message(message_id="wamid.1", text="Quero saber o preço"):
+    return {"phone_number": "5511999990000", "message": text, "message_id": message_id, "timestamp": 1}
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """Replace reply generation with a counter; set `delay` or `fail` to shape the next attempts"""
+    calls = {"count": 0, "delay": 0, "fail": 0}
+
+    async def generate(message_data, db, reply_stream=None):
+        calls["count"] += 1
+        await asyncio.sleep(calls["delay"])
+        if calls["fail"]:
+            calls["fail"] -= 1
+            raise RuntimeError("provider down")
+        return f"resposta {calls['count']}"
+
+    monkeypatch.setattr(server, "generate_message_reply", generate)
+    return calls
+
+
+async def reply_records(db, message_id):
+    return await db.conversations.count_documents({"reply_to": message_id})
+
+
+async def incoming_record(db, message_id):
+    return await db.conversations.find_one({"message_id": message_id})
+
+
+@pytest.mark.asyncio
+async def test_retry_is_answered_from_stored_reply(db, http, replies):
+    first = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    # Another worker: nothing in memory, the stored reply is found through the index
+    server.recent_messages = server.RecentMessageCache(1000)
+    retry = await http.post("/api/whatsapp/message", json=whatsapp_message())
+
+    assert first.json()["reply"] == retry.json()["reply"] == "resposta 1"
+    assert replies["count"] == 1
+    assert await reply_records(db, "wamid.1") == 1
+    record = await incoming_record(db, "wamid.1")
+    assert record["reply_status"] == "answered" and record["ai_processed"] is True
+
+
+@pytest.mark.asyncio
+async def test_retry_while_answering_waits_for_the_reply(db, http, replies):
+    replies["delay"] = 0.2
+    first, retry = await asyncio.gather(
+        http.post("/api/whatsapp/message", json=whatsapp_message()),
+        http.post("/api/whatsapp/message", json=whatsapp_message())
+    )
+
+    assert first.status_code == retry.status_code == 200
+    assert first.json()["reply"] == retry.json()["reply"] == "resposta 1"
+    assert replies["count"] == 1
+    assert await reply_records(db, "wamid.1") == 1
+    assert server.reply_futures == {}
+
+
+@pytest.mark.asyncio
+async def test_retry_after_failed_attempt_regenerates(db, http, replies):
+    replies["fail"] = 1
+    failed = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    assert failed.json()["success"] is False
+    assert (await incoming_record(db, "wamid.1"))["reply_status"] == "failed"
+
+    retry = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    assert retry.json() == {"reply": "resposta 2", "success": True, "streamed": False}
+    assert await reply_records(db, "wamid.1") == 1
+    assert await db.conversations.count_documents({"message_id": "wamid.1"}) == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_while_another_worker_answers_gets_409(db, http, replies):
+    record = server.build_incoming_conversation(server.WhatsAppMessage(**whatsapp_message(), company_id=server.DEFAULT_COMPANY_ID))
+    await server.store_conversation(db, record)
+
+    retry = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    assert retry.status_code == 409
+    assert retry.headers["Retry-After"] == str(server.WHATSAPP_REPLY_RETRY_AFTER_SECONDS)
+    assert replies["count"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stalled_attempt_is_answered_again(db, http, replies):
+    record = server.build_incoming_conversation(server.WhatsAppMessage(**whatsapp_message(), company_id=server.DEFAULT_COMPANY_ID))
+    record["reply_deadline"] = (datetime.utcnow() - timedelta(seconds=1)).isoformat()
+    await server.store_conversation(db, record)
+
+    retry = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    assert retry.json()["reply"] == "resposta 1"
+    assert (await incoming_record(db, "wamid.1"))["reply_status"] == "answered"
+
+
+@pytest.mark.asyncio
+async def test_legacy_record_without_reply_is_answered_again(db, http, replies):
+    await db.conversations.insert_one({
+        "id": "legacy", "company_id": server.DEFAULT_COMPANY_ID, "message_id": "wamid.1",
+        "contact_phone": "5511999990000", "message": "oi", "direction": "incoming",
+        "timestamp": datetime.utcnow().isoformat(), "ai_processed": False
+    })
+
+    retry = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    assert retry.json()["reply"] == "resposta 1"
+
+
+@pytest.mark.asyncio
+async def test_batch_retries(db, http, replies):
+    replies["fail"] = 1
+    await http.post("/api/whatsapp/message", json=whatsapp_message("wamid.failed"))
+    await http.post("/api/whatsapp/message", json=whatsapp_message("wamid.answered"))
+    server.recent_messages = server.RecentMessageCache(1000)
+
+    batch = await http.post("/api/whatsapp/messages/batch", json=[
+        whatsapp_message("wamid.answered"),
+        whatsapp_message("wamid.failed"),
+        whatsapp_message("wamid.new"),
+        whatsapp_message("wamid.new")
+    ])
+
+    results = {result["message_id"]: result for result in batch.json()["results"]}
+    assert results["wamid.answered"]["reply"] == "resposta 2"
+    assert results["wamid.failed"]["reply"] == "resposta 3"
+    assert results["wamid.new"]["reply"] == "resposta 4"
+    assert replies["count"] == 4
+    for message_id in ("wamid.answered", "wamid.failed", "wamid.new"):
+        assert await reply_records(db, message_id) == 1
+        assert (await incoming_record(db, message_id))["reply_status"] == "answered"
+
+
+@pytest.mark.asyncio
+async def test_batch_reports_messages_still_being_answered(db, http, replies):
+    record = server.build_incoming_conversation(server.WhatsAppMessage(**whatsapp_message(), company_id=server.DEFAULT_COMPANY_ID))
+    await server.store_conversation(db, record)
+
+    batch = await http.post("/api/whatsapp/messages/batch", json=[whatsapp_message()])
+    assert batch.json()["results"] == [{"message_id": "wamid.1", "reply": None, "success": False}]
+    assert replies["count"] == 0
@@ -0,0 +1,54 @@
+import pytest
+from prometheus_client import REGISTRY
+
+import server
+from tests.mongo_events import failed, started, succeeded
+
+
+def mongo_latency(collection, command, outcome):
+    labels = {"collection": collection, "command": command, "outcome": outcome}
+    count = REGISTRY.get_sample_value("mongo_operation_duration_seconds_count", labels) or 0
+    total = REGISTRY.get_sample_value("mongo_operation_duration_seconds_sum", labels) or 0
+    return count, total
+
+
+def test_mongo_commands_are_timed_per_collection_and_outcome():
+    metrics = server.MongoCommandMetrics()
+    before_success = mongo_latency("metrics_test", "find", "success")
+    before_failure = mongo_latency("metrics_test", "insert", "failure")
+
+    metrics.started(started(1, {"find": "metrics_test", "filter": {"phone_number": "5511"}}))
+    metrics.started(started(2, {"insert": "metrics_test", "documents": []}))
+    metrics.succeeded(succeeded(1, "find", 30))
+    metrics.failed(failed(2, "insert", 5))
+
+    count, total = mongo_latency("metrics_test", "find", "success")
+    assert count == before_success[0] + 1 and total == pytest.approx(before_success[1] + 0.03)
+    count, total = mongo_latency("metrics_test", "insert", "failure")
+    assert count == before_failure[0] + 1 and total == pytest.approx(before_failure[1] + 0.005)
+    # Completed commands are not kept
+    assert metrics._collections == {}
+
+
+def test_get_more_is_attributed_to_its_collection():
+    metrics = server.MongoCommandMetrics()
+    before = mongo_latency("metrics_test", "getMore", "success")
+
+    metrics.started(started(3, {"getMore": 12345, "collection": "metrics_test"}))
+    metrics.succeeded(succeeded(3, "getMore", 1))
+
+    assert mongo_latency("metrics_test", "getMore", "success")[0] == before[0] + 1
+    assert metrics._collections == {}
+
+
+@pytest.mark.asyncio
+async def test_requests_are_timed_per_route_template(http):
+    labels = {"method": "GET", "route": "/api/health/live", "status": "200"}
+    before = REGISTRY.get_sample_value("http_request_duration_seconds_count", labels) or 0
+
+    await http.get("/api/health/live")
+    response = await http.get("/metrics")
+
+    assert REGISTRY.get_sample_value("http_request_duration_seconds_count", labels) == before + 1
+    assert REGISTRY.get_sample_value("http_requests_in_flight", {"method": "GET", "route": "/api/health/live"}) == 0
+    assert "http_request_duration_seconds_bucket" in response.text
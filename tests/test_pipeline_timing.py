@@ -0,0 +1,60 @@
+import pytest
+
+import server
+
+
+def test_stage_timer_adds_up_repeated_stages():
+    timer = server.StageTimer()
+    timer.add("llm", 0.25)
+    timer.add("llm", 0.5)
+    timer.add("contact", 0.0021)
+
+    assert timer.stages == {"llm": 750.0, "contact": pytest.approx(2.1)}
+    assert timer.server_timing() == "llm;dur=750.0, contact;dur=2.1"
+    assert timer.finish()["total"] >= 0
+
+
+def test_pipeline_stage_reports_to_the_current_timer_only():
+    with server.pipeline_stage("transfer"):
+        pass  # no message being processed: nothing to record
+
+    timer = server.StageTimer()
+    token = server.current_stage_timer.set(timer)
+    try:
+        with server.pipeline_stage("transfer"):
+            pass
+    finally:
+        server.current_stage_timer.reset(token)
+    assert list(timer.stages) == ["transfer"]
+
+
+def test_percentiles_use_the_nearest_rank_within_the_window():
+    window = server.PipelineTimingWindow(window_seconds=60, max_samples=200)
+    for ms in range(1, 101):
+        window.record({"llm": float(ms), "total": float(ms) * 2})
+    # A sample older than the window is left out
+    window._samples.appendleft((window._samples[0][0] - 120, {"llm": 10_000.0}))
+
+    report = window.percentiles()
+
+    assert report["llm"] == {"count": 100, "p50": 50.0, "p95": 95.0, "p99": 99.0}
+    assert report["total"]["p50"] == 100.0
+
+
+@pytest.mark.asyncio
+async def test_message_reports_its_stages(db, http, monkeypatch):
+    monkeypatch.setattr(server, "pipeline_timings", server.PipelineTimingWindow(60, 100))
+    monkeypatch.setattr(server, "PIPELINE_TIMING_SAMPLE_RATE", 1.0)
+
+    response = await http.post("/api/whatsapp/message", json={
+        "phone_number": "5511999990000", "message": "Quanto custa abrir um MEI?", "message_id": "wamid.1", "timestamp": 1
+    })
+
+    stages = [part.split(";")[0] for part in response.headers["server-timing"].split(", ")]
+    assert {"store_incoming", "contact", "llm", "store_reply", "total"} <= set(stages)
+    reply = await db.conversations.find_one({"reply_to": "wamid.1"})
+    assert {"store_incoming", "contact", "llm", "total"} <= set(reply["timings"])
+
+    token = server.create_token("u1")
+    report = (await http.get("/api/metrics/pipeline", headers={"Authorization": f"Bearer {token}"})).json()
+    assert report["window_seconds"] == 60 and report["stages"]["total"]["count"] == 1
@@ -0,0 +1,71 @@
+import asyncio
+import base64
+from collections import OrderedDict
+
+import pytest
+
+import server
+
+pytest.importorskip("qrcode")
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Count renders per format, starting from an empty cache"""
+    monkeypatch.setattr(server, "qr_image_cache", OrderedDict())
+    counts = {}
+    render = server.render_qr_image
+
+    def counting_render(payload, image_format):
+        counts[image_format] = counts.get(image_format, 0) + 1
+        return render(payload, image_format)
+
+    monkeypatch.setattr(server, "render_qr_image", counting_render)
+    return counts
+
+
+@pytest.mark.asyncio
+async def test_png_and_svg_are_served_raw_with_an_etag(http, renders):
+    png = await http.get("/api/whatsapp/qrcode.png")
+    svg = await http.get("/api/whatsapp/qrcode.svg")
+
+    assert png.headers["content-type"] == "image/png" and png.content.startswith(b"\x89PNG")
+    assert svg.headers["content-type"].startswith("image/svg+xml") and b"<svg" in svg.content
+    assert png.headers["etag"] != svg.headers["etag"]
+
+    unchanged = await http.get("/api/whatsapp/qrcode.png", headers={"If-None-Match": png.headers["etag"]})
+    assert unchanged.status_code == 304 and unchanged.content == b""
+    assert renders == {"png": 1, "svg": 1}
+
+
+@pytest.mark.asyncio
+async def test_json_variant_wraps_the_same_png(http, renders):
+    png = (await http.get("/api/whatsapp/qrcode.png")).content
+    body = (await http.get("/api/whatsapp/qrcode")).json()
+
+    assert body["session_id"] == server.QR_SESSION_ID
+    assert body["qr_code"] == f"data:image/png;base64,{base64.b64encode(png).decode()}"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_render(renders):
+    images = await asyncio.gather(*(server.get_qr_image("payload", "png") for _ in range(5)))
+    assert len(set(images)) == 1 and renders == {"png": 1}
+    await server.get_qr_image("other payload", "png")
+    assert renders == {"png": 2}
+
+
+@pytest.mark.asyncio
+async def test_failed_render_is_not_cached(monkeypatch):
+    monkeypatch.setattr(server, "qr_image_cache", OrderedDict())
+    with pytest.raises(ValueError):
+        await server.get_qr_image("payload", "gif")
+    assert ("payload", "gif") not in server.qr_image_cache
+
+
+@pytest.mark.asyncio
+async def test_cache_keeps_the_most_recent_payloads(renders, monkeypatch):
+    monkeypatch.setattr(server, "QR_CACHE_MAX", 2)
+    for payload in ("a", "b", "a", "c"):
+        await server.get_qr_image(payload, "png")
+    assert list(server.qr_image_cache) == [("a", "png"), ("c", "png")]
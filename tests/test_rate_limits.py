@@ -0,0 +1,72 @@
+import pytest
+
+import server
+
+
+def allowed(limiter, key, now, times):
+    return [limiter.allow(key, now=now) for _ in range(times)]
+
+
+def test_burst_is_allowed_then_throttled():
+    limiter = server.TokenBucketLimiter(per_minute=60, burst=3)
+    assert allowed(limiter, "a", 0, 4) == [True, True, True, False]
+    # Each key has its own bucket
+    assert limiter.allow("b", now=0)
+
+
+def test_tokens_refill_at_the_configured_rate():
+    limiter = server.TokenBucketLimiter(per_minute=60, burst=3)
+    allowed(limiter, "a", 0, 3)
+
+    assert not limiter.allow("a", now=0.5)
+    assert limiter.allow("a", now=1.5)
+    assert not limiter.allow("a", now=1.6)
+
+
+def test_refill_is_capped_at_the_burst():
+    limiter = server.TokenBucketLimiter(per_minute=60, burst=3)
+    allowed(limiter, "a", 0, 3)
+    assert allowed(limiter, "a", 3600, 4) == [True, True, True, False]
+
+
+def test_zero_rate_or_burst_disables_the_limit():
+    for limiter in (server.TokenBucketLimiter(0, 10), server.TokenBucketLimiter(60, 0)):
+        assert all(allowed(limiter, "a", 0, 100))
+        assert len(limiter) == 0
+
+
+def test_idle_buckets_are_evicted_and_keys_stay_bounded():
+    limiter = server.TokenBucketLimiter(per_minute=60, burst=3, max_keys=2)
+    limiter.allow("a", now=0)
+    limiter.allow("b", now=1)
+    limiter.allow("c", now=2)
+    assert len(limiter) == 2
+
+    # "b" and "c" have been idle for longer than a full refill (3 seconds)
+    limiter.allow("d", now=5.5)
+    assert len(limiter) == 1
+
+
+@pytest.mark.asyncio
+async def test_throttled_contact_gets_the_canned_reply_without_an_llm_call(db, http, monkeypatch):
+    monkeypatch.setattr(server, "phone_rate_limiter", server.TokenBucketLimiter(1, 1))
+    calls = []
+
+    async def generate(message_data, db, reply_stream=None):
+        calls.append(message_data.message_id)
+        return "resposta"
+
+    monkeypatch.setattr(server, "generate_message_reply", generate)
+
+    replies = []
+    for n in range(2):
+        response = await http.post("/api/whatsapp/message", json={
+            "phone_number": "5511999990000", "message": "Oi?", "message_id": f"wamid.{n}", "timestamp": n
+        })
+        replies.append(response.json()["reply"])
+
+    assert replies == ["resposta", server.THROTTLED_REPLY]
+    assert calls == ["wamid.0"]
+    throttled = await db.conversations.find_one({"reply_to": "wamid.1"})
+    assert throttled["throttled"] is True and throttled["ai_generated"] is False
+    assert await db.conversations.count_documents({"message_id": "wamid.1"}) == 1
@@ -0,0 +1,92 @@
+import pytest
+
+import server
+
+
+def test_chunk_boundary_needs_min_chars():
+    text = "Oi! Tudo bem? Posso ajudar com o seu pedido agora mesmo. E"
+    assert server.chunk_boundary(text, 0, 100) is None
+    end = server.chunk_boundary(text, 0, 10)
+    assert text[:end] == "Oi! Tudo bem? Posso ajudar com o seu pedido agora mesmo. "
+
+
+def test_chunk_boundary_prefers_the_longest_prefix_and_paragraphs():
+    text = "Primeiro parágrafo.\n\nSegundo parágrafo, bem mais longo. Resto"
+    assert text[:server.chunk_boundary(text, 0, 5)] == "Primeiro parágrafo.\n\nSegundo parágrafo, bem mais longo. "
+    # Counting starts at `start`: the first sentence alone is too short from there
+    assert server.chunk_boundary(text, 21, 40) is None
+
+
+def test_chunk_boundary_ignores_text_without_boundaries():
+    assert server.chunk_boundary("sem pontuação nenhuma " * 10, 0, 10) is None
+
+
+class ScriptedProvider(server.LlmProvider):
+    """Streams a fixed list of deltas per model; a delta that is an exception is raised instead"""
+
+    requires_api_key = False
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+
+    async def complete(self, provider, model, system_message, session_id, text, api_key=None):
+        return "".join([delta async for delta in self.stream(provider, model, system_message, session_id, text, api_key)])
+
+    async def stream(self, provider, model, system_message, session_id, text, api_key=None):
+        for delta in self.scripts.get(model, []):
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+
+
+@pytest.fixture
+def frames(monkeypatch):
+    sent = []
+
+    async def push(message_data, text, last):
+        sent.append((text, last))
+        return True
+
+    monkeypatch.setattr(server, "push_whatsapp_message", push)
+    return sent
+
+
+def message_data():
+    return server.WhatsAppMessage(phone_number="5511999990000", message="Oi", message_id="wamid.1", timestamp=1)
+
+
+async def stream_reply(monkeypatch, scripts):
+    monkeypatch.setattr(server, "llm_provider", ScriptedProvider(scripts))
+    stream = server.ReplyStream(message_data())
+    reply = await server.generate_ai_response("Oi", "5511999990000", reply_stream=stream)
+    return stream, reply
+
+
+@pytest.mark.asyncio
+async def test_fallback_discards_text_of_a_model_that_pushed_nothing(db, monkeypatch, frames):
+    stream, reply = await stream_reply(monkeypatch, {
+        "gemini-1.5-flash": ["Texto curto do primeiro", RuntimeError("cut off")],
+        "gpt-4o-mini": ["Resposta do segundo modelo."]
+    })
+    assert reply == "Resposta do segundo modelo."
+    assert frames == [("Resposta do segundo modelo.", True)]
+    assert stream.chunks_sent == 1
+
+
+@pytest.mark.asyncio
+async def test_model_failing_after_a_chunk_closes_the_reply(db, monkeypatch, frames):
+    first = "Esta é a primeira frase, longa o bastante para ir sozinha ao contato. "
+    stream, reply = await stream_reply(monkeypatch, {
+        "gemini-1.5-flash": [first, "E esta ficou pela metade", RuntimeError("cut off")],
+        "gpt-4o-mini": ["Nunca chamado."]
+    })
+    assert reply == first + "E esta ficou pela metade"
+    assert frames == [(first.strip(), False), ("E esta ficou pela metade", True)]
+
+
+@pytest.mark.asyncio
+async def test_final_frame_is_sent_when_everything_was_pushed(db, monkeypatch, frames):
+    first = "Esta é a primeira frase, longa o bastante para ir sozinha ao contato. "
+    stream, reply = await stream_reply(monkeypatch, {"gemini-1.5-flash": [first, "\n\n"]})
+    assert reply == first.strip()
+    assert frames == [(first.strip(), False), ("", True)]
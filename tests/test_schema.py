@@ -0,0 +1,70 @@
+import argparse
+
+import mongomock
+import pytest
+
+import dedupe_users
+import server
+
+
+@pytest.fixture
+def legacy_db(monkeypatch):
+    """Shared database of a deployment whose users predate the unique indexes"""
+    from mongomock_motor import AsyncMongoMockClient
+    client = AsyncMongoMockClient()
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "database", client["empresas_web_test"])
+    return server.database
+
+
+@pytest.mark.asyncio
+async def test_duplicate_usernames_do_not_block_readiness(legacy_db, monkeypatch):
+    monkeypatch.setattr(server, "app_ready", False)
+    await legacy_db.users.insert_many([
+        {"id": "u1", "username": "ana", "email": "ana@x.com", "created_at": "2024-01-01T00:00:00"},
+        {"id": "u2", "username": "ana", "email": "ana.silva@x.com", "created_at": "2024-02-01T00:00:00"}
+    ])
+
+    await server.warm_up(legacy_db)
+
+    assert server.app_ready
+    applied = await legacy_db.app_metadata.find_one({"_id": "schema"})
+    assert applied["blocked_indexes"] == ["users: username"]
+    assert "version" not in applied
+    assert await legacy_db.departments.count_documents({"company_id": server.DEFAULT_COMPANY_ID}) == len(server.DEFAULT_DEPARTMENTS)
+
+
+def test_dedupe_users_renames_all_but_the_oldest():
+    db = mongomock.MongoClient()["empresas_web_test"]
+    db.users.insert_many([
+        {"id": "u2", "username": "ana", "email": "ana@x.com", "created_at": "2024-02-01T00:00:00"},
+        {"id": "u1", "username": "ana", "email": "ana@x.com", "created_at": "2024-01-01T00:00:00"},
+        {"id": "u1", "username": "bia", "created_at": "2024-03-01T00:00:00"}
+    ])
+    args = argparse.Namespace(dry_run=False)
+
+    first = [dedupe_users.dedupe_field(db, field, args) for field in ("id", "username", "email")]
+    again = [dedupe_users.dedupe_field(db, field, args) for field in ("id", "username", "email")]
+
+    assert [report["users"] for report in first] == [1, 1, 1]
+    assert [report["users"] for report in again] == [0, 0, 0]
+    ana = db.users.find_one({"username": "ana"})
+    assert ana["id"] == "u1" and ana["email"] == "ana@x.com"
+    duplicate = db.users.find_one({"username": "ana.duplicate-1"})
+    assert duplicate["duplicate_of"] == "u1" and duplicate["duplicate_email"] == "ana@x.com" and "email" not in duplicate
+    bia = db.users.find_one({"username": "bia"})
+    assert bia["previous_id"] == "u1" and bia["id"] != "u1"
+    for field in ("id", "username", "email"):
+        db.users.create_index(field, unique=True, sparse=True)
+
+
+@pytest.mark.asyncio
+async def test_login_covering_index_is_dropped(legacy_db, monkeypatch):
+    monkeypatch.setattr(server, "app_ready", False)
+    await legacy_db.users.create_index([(field, 1) for field in server.LOGIN_USER_FIELDS])
+
+    await server.warm_up(legacy_db)
+
+    indexes = await legacy_db.users.index_information()
+    assert not any("password_hash" in name for name in indexes)
+    assert indexes["username_1"]["unique"]
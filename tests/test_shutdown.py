@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def whatsapp_message(message_id="wamid.1"):
+    return {"phone_number": "5511999990000", "message": "Quero abrir um MEI", "message_id": message_id, "timestamp": 1}
+
+
+@pytest.fixture
+def shutdown(monkeypatch):
+    """Undo the drain once the test is over"""
+    monkeypatch.setattr(server, "draining", False)
+
+
+@pytest.fixture
+def slow_replies(monkeypatch):
+    async def generate(message_data, db, reply_stream=None):
+        await asyncio.sleep(0.1)
+        return "resposta"
+
+    monkeypatch.setattr(server, "generate_message_reply", generate)
+
+
+@pytest.mark.asyncio
+async def test_draining_rejects_new_messages(db, http, shutdown):
+    await server.drain(db, timeout=1)
+
+    single = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    batch = await http.post("/api/whatsapp/messages/batch", json=[whatsapp_message()])
+    ready = await http.get("/api/health/ready")
+
+    assert single.status_code == batch.status_code == 503
+    assert single.headers["retry-after"] == "5"
+    assert ready.status_code == 503 and ready.json()["status"] == "draining"
+    assert await db.conversations.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_messages_being_answered(db, http, shutdown, slow_replies):
+    message = asyncio.ensure_future(http.post("/api/whatsapp/message", json=whatsapp_message()))
+    while not server.inflight_work.count():
+        await asyncio.sleep(0.005)
+
+    await server.drain(db, timeout=5)
+
+    assert message.done() and (await message).json()["reply"] == "resposta"
+    assert await db.conversations.count_documents({"reply_to": "wamid.1"}) == 1
+    assert await db.shutdown_reports.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_tracked_tasks(db, shutdown):
+    finished = []
+
+    async def write():
+        await asyncio.sleep(0.1)
+        finished.append(True)
+
+    server.spawn_tracked(write(), "write")
+    await server.drain(db, timeout=5)
+
+    assert finished == [True] and not server.pending_tasks
+
+
+@pytest.mark.asyncio
+async def test_work_left_at_the_deadline_is_cancelled_and_reported(db, shutdown):
+    stuck = server.inflight_work.begin("message", "wamid.stuck")
+    task = server.spawn_tracked(asyncio.sleep(60), "summary:5511999990000")
+    try:
+        await server.drain(db, timeout=0.1)
+    finally:
+        server.inflight_work.end(stuck)
+
+    assert task.cancelled()
+    report = await db.shutdown_reports.find_one()
+    assert [(work["kind"], work["label"]) for work in report["abandoned_work"]] == [("message", "wamid.stuck")]
+    assert report["abandoned_tasks"] == ["summary:5511999990000"]
+
+
+@pytest.mark.asyncio
+async def test_admin_can_start_draining_ahead_of_shutdown(db, http, shutdown):
+    admin = {"Authorization": f"Bearer {server.create_token('admin')}"}
+    response = await http.post("/api/admin/drain", headers=admin)
+    assert response.json()["draining"] is True
+    assert (await http.post("/api/whatsapp/message", json=whatsapp_message())).status_code == 503
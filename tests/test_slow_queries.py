@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import server
+from tests.mongo_events import failed, started, succeeded
+
+
+def find(request_id, phone_number):
+    return started(request_id, {"find": "contacts", "filter": {"company_id": "acme", "phone_number": phone_number}, "sort": {"created_at": -1}})
+
+
+def test_only_commands_over_the_threshold_are_logged():
+    log = server.SlowQueryLog(threshold_ms=100, max_entries=10, max_shapes=10)
+    log.started(find(1, "5511"))
+    log.started(find(2, "5522"))
+    log.succeeded(succeeded(1, "find", 20))
+    log.succeeded(succeeded(2, "find", 250))
+
+    [entry] = log.entries
+    assert entry["collection"] == "contacts" and entry["command"] == "find"
+    assert entry["duration_ms"] == 250 and entry["outcome"] == "success"
+    assert json.loads(entry["shape"]) == {"filter": {"company_id": "?", "phone_number": "?"}, "sort": {"created_at": -1}}
+    # Fast and slow commands alike are dropped once completed
+    assert log._pending == {}
+
+
+def test_queries_differing_only_in_values_share_a_shape():
+    log = server.SlowQueryLog(threshold_ms=100, max_entries=10, max_shapes=10)
+    for request_id, (phone_number, milliseconds) in enumerate([("5511", 150), ("5522", 450)]):
+        log.started(find(request_id, phone_number))
+        log.succeeded(succeeded(request_id, "find", milliseconds))
+    log.started(started(9, {"update": "contacts", "updates": [{"q": {"id": "c1"}, "u": {"$set": {"name": "x"}}}]}))
+    log.failed(failed(9, "update", 120))
+
+    report = log.report(limit=10)
+
+    assert [entry["duration_ms"] for entry in report["recent"]] == [120, 450, 150]
+    contacts_find, contacts_update = report["shapes"]
+    assert (contacts_find["count"], contacts_find["total_ms"], contacts_find["avg_ms"], contacts_find["max_ms"]) == (2, 600, 300, 450)
+    assert contacts_update["command"] == "update" and json.loads(contacts_update["shape"]) == {"filter": [{"id": "?"}]}
+    assert report["recent"][0]["outcome"] == "failure"
+
+
+def test_log_and_shapes_stay_bounded():
+    log = server.SlowQueryLog(threshold_ms=0, max_entries=2, max_shapes=2)
+    for request_id, collection in enumerate(["a", "b", "c"]):
+        log.started(started(request_id, {"find": collection, "filter": {}}))
+        log.succeeded(succeeded(request_id, "find", 1))
+
+    report = log.report(limit=10)
+    assert [entry["collection"] for entry in report["recent"]] == ["c", "b"]
+    assert sorted(shape["collection"] for shape in report["shapes"]) == ["b", "c"]
+
+    log.reset()
+    assert log.report(limit=10)["recent"] == [] and log.report(limit=10)["shapes"] == []
+
+
+@pytest.mark.asyncio
+async def test_admin_endpoint_reports_and_resets(http, monkeypatch):
+    log = server.SlowQueryLog(threshold_ms=0, max_entries=10, max_shapes=10)
+    monkeypatch.setattr(server, "slow_query_log", log)
+    log.started(find(1, "5511"))
+    log.succeeded(succeeded(1, "find", 5))
+    admin = {"Authorization": f"Bearer {server.create_token('admin')}"}
+
+    assert (await http.get("/api/admin/slow-queries", headers=admin)).json()["shapes"][0]["collection"] == "contacts"
+    user = {"Authorization": f"Bearer {server.create_token('u1')}"}
+    assert (await http.get("/api/admin/slow-queries", headers=user)).status_code == 403
+
+    assert (await http.delete("/api/admin/slow-queries", headers=admin)).json() == {"success": True}
+    assert not log.entries
@@ -0,0 +1,79 @@
+import hashlib
+
+import pytest
+
+import server
+
+
+def whatsapp_message(message_id="wamid.1", **fields):
+    return {"phone_number": "5511999990000", "message": "Oi", "message_id": message_id, "timestamp": 1, **fields}
+
+
+@pytest.fixture
+def bridge_keys(monkeypatch):
+    keys = {"acme": "acme-secret", "globex": "globex-secret"}
+    monkeypatch.setattr(server, "bridge_key_companies", {
+        hashlib.sha256(key.encode()).hexdigest(): company_id for company_id, key in keys.items()
+    })
+    return keys
+
+
+@pytest.mark.asyncio
+async def test_inbound_message_takes_the_company_of_the_bridge_key(db, http, bridge_keys):
+    response = await http.post("/api/whatsapp/message", json=whatsapp_message(), headers={"X-Bridge-Key": "acme-secret"})
+    assert response.status_code == 200
+    assert await db.conversations.count_documents({"company_id": "acme", "message_id": "wamid.1"}) == 1
+
+
+@pytest.mark.asyncio
+async def test_inbound_message_needs_a_known_bridge_key(db, http, bridge_keys):
+    missing = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    unknown = await http.post("/api/whatsapp/message", json=whatsapp_message(), headers={"X-Bridge-Key": "guess"})
+    assert missing.status_code == unknown.status_code == 401
+    assert await db.conversations.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_inbound_message_cannot_name_another_company(db, http, bridge_keys):
+    single = await http.post(
+        "/api/whatsapp/message", json=whatsapp_message(company_id="globex"), headers={"X-Bridge-Key": "acme-secret"}
+    )
+    batch = await http.post(
+        "/api/whatsapp/messages/batch",
+        json=[whatsapp_message("wamid.1"), whatsapp_message("wamid.2", company_id="globex")],
+        headers={"X-Bridge-Key": "acme-secret"}
+    )
+    assert single.status_code == batch.status_code == 403
+    assert await db.conversations.count_documents({}) == 0
+
+
+@pytest.mark.asyncio
+async def test_without_bridge_keys_only_the_default_company_is_served(db, http):
+    default = await http.post("/api/whatsapp/message", json=whatsapp_message())
+    other = await http.post("/api/whatsapp/message", json=whatsapp_message("wamid.2", company_id="acme"))
+    assert default.status_code == 200
+    assert other.status_code == 403
+    assert await db.conversations.count_documents({"company_id": server.DEFAULT_COMPANY_ID, "direction": "incoming"}) == 1
+
+
+def test_department_rate_limit_is_kept_per_company(monkeypatch):
+    monkeypatch.setattr(server, "phone_rate_limiter", server.TokenBucketLimiter(0, 0))
+    monkeypatch.setattr(server, "department_rate_limiter", server.TokenBucketLimiter(1, 1))
+    acme = server.WhatsAppMessage(**whatsapp_message(), company_id="acme")
+    globex = server.WhatsAppMessage(**whatsapp_message(), company_id="globex")
+    assert server.ai_rate_limit_allows(acme)
+    assert not server.ai_rate_limit_allows(acme)
+    assert server.ai_rate_limit_allows(globex)
+
+
+@pytest.mark.asyncio
+async def test_company_added_after_the_schema_is_seeded(db):
+    assert await db.departments.count_documents({"company_id": "acme"}) == 0
+    await db.companies.insert_one({"id": "acme", "name": "Acme"})
+
+    await server.seed_new_companies(db)
+
+    assert await db.departments.count_documents({"company_id": "acme"}) == len(server.DEFAULT_DEPARTMENTS)
+    applied = await db.app_metadata.find_one({"_id": "schema"})
+    assert applied["version"] == server.SCHEMA_VERSION
+    assert set(applied["seeded_companies"]) == {server.DEFAULT_COMPANY_ID, "acme"}
@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+# The claim computes wait_seconds with $convert, which mongomock does not implement,
+# so these tests run against a real MongoDB (MONGO_TEST_URL) and are skipped without one
+
+
+def transfer(n, age_seconds, department="financeiro", **fields):
+    created_at = datetime.utcnow() - timedelta(seconds=age_seconds)
+    return {
+        "id": f"t{n}", "company_id": server.DEFAULT_COMPANY_ID, "to_department": department,
+        "status": "pending", "created_at": created_at.isoformat(), **fields
+    }
+
+
+async def claim(db, user, department="financeiro"):
+    return await server.claim_transfer(department, current_user=user, db=db, company_id=server.DEFAULT_COMPANY_ID)
+
+
+@pytest.mark.asyncio
+async def test_claim_takes_the_oldest_pending_transfer(mongo):
+    await mongo.transfers.insert_many([
+        transfer(1, 30), transfer(2, 90), transfer(3, 600, status="accepted"),
+        transfer(4, 900, department="rh-e-folha"), transfer(5, 900, company_id="acme")
+    ])
+
+    claimed = await claim(mongo, "agent-1")
+
+    assert claimed["id"] == "t2"
+    assert claimed["status"] == "accepted" and claimed["handled_by"] == "agent-1"
+    assert claimed["claimed_at"] >= claimed["created_at"]
+
+
+@pytest.mark.asyncio
+async def test_wait_is_measured_from_isoformat_timestamps_with_microseconds(mongo):
+    pending = transfer(1, 90.25)
+    assert "." in pending["created_at"]
+    await mongo.transfers.insert_one(pending)
+
+    claimed = await claim(mongo, "agent-1")
+
+    # Mongo dates keep milliseconds, so the microseconds are truncated
+    assert claimed["wait_seconds"] == pytest.approx(90.25, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_claims_never_take_the_same_transfer(mongo):
+    await mongo.transfers.insert_many([transfer(n, 60 + n) for n in range(5)])
+
+    results = await asyncio.gather(*[claim(mongo, f"agent-{n}") for n in range(8)], return_exceptions=True)
+
+    claimed = [result["id"] for result in results if isinstance(result, dict)]
+    assert sorted(claimed) == [f"t{n}" for n in range(5)]
+    empty = [result for result in results if isinstance(result, HTTPException)]
+    assert len(empty) == 3 and all(error.status_code == 404 for error in empty)
+    assert await mongo.transfers.count_documents({"status": "pending"}) == 0
+
+
+@pytest.mark.asyncio
+async def test_wait_is_measured_for_legacy_date_typed_created_at(mongo):
+    legacy = transfer(1, 120)
+    legacy["created_at"] = datetime.fromisoformat(legacy["created_at"])
+    await mongo.transfers.insert_many([legacy, transfer(2, 60, created_at="not a date")])
+
+    claimed = {result["id"]: result for result in [await claim(mongo, "agent-1"), await claim(mongo, "agent-2")]}
+
+    assert claimed["t1"]["wait_seconds"] == pytest.approx(120, abs=1)
+    # An unreadable created_at leaves the wait unknown instead of failing the claim
+    assert claimed["t2"]["wait_seconds"] is None
+
+
+@pytest.mark.asyncio
+async def test_metrics_read_string_and_date_typed_created_at(mongo):
+    legacy = transfer(1, 300)
+    legacy["created_at"] = datetime.fromisoformat(legacy["created_at"])
+    await mongo.transfers.insert_many([legacy, transfer(2, 60)])
+
+    metrics = await server.get_transfer_metrics(
+        window_hours=24, current_user="agent-1", db=mongo, company_id=server.DEFAULT_COMPANY_ID
+    )
+
+    [department] = metrics["departments"]
+    assert department["queue_depth"] == 2
+    assert department["oldest_pending_wait_seconds"] == pytest.approx(300, abs=1)